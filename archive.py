@@ -0,0 +1,435 @@
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import shutil
+import sqlite3
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from telethon import TelegramClient
+from telethon.extensions import BinaryReader
+from telethon.tl.types import MessageReplies
+
+from authors import author_label
+from config import Config
+from copier import is_real_media, replies_max_id
+from media import MediaSender
+from pool import SessionPool, read_messages
+from ratelimit import RateLimiter, paced_history
+from retry import RetryPolicy
+from upload_cache import file_digest, media_key, source_key
+
+log = logging.getLogger("tg_sync.archive")
+
+# сколько сообщений за раз читает ArchiveReader.iter_messages
+READ_PAGE = 100
+
+
+def archive_path(cfg: Config) -> Path:
+    """Каталог архива источника: TG_ARCHIVE_DIR/<TG_SOURCE>."""
+    return cfg.archive_dir / "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in cfg.source)
+
+
+class Archive:
+    """
+    Локальный архив одного источника:
+      messages.sqlite3 — журнал постов и комментариев, только дописывается (INSERT OR IGNORE по id).
+        Сообщение хранится целиком в TL-виде (bytes(Message): текст, сущности, grouped_id, replies),
+        рядом — отправитель (bytes(User/Channel)) и его подпись, тред комментария, sha256 медиа;
+      media/ab/abcdef... — файлы по sha256 содержимого: один файл из разных постов хранится один раз.
+    Записи копятся в открытой транзакции и коммитятся каждые commit_every сообщений и в commit()/close().
+    Сообщение дописывается только после своего файла, поэтому оборванный экспорт просто продолжается.
+    """
+
+    def __init__(self, path: Path, *, commit_every: int = 100):
+        self.path = path
+        self.media_dir = path / "media"
+        self.tmp_dir = path / "tmp"
+        self.commit_every = commit_every
+        self.media_dir.mkdir(parents=True, exist_ok=True)
+
+        self._db = sqlite3.connect(str(path / "messages.sqlite3"))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (
+                key   TEXT PRIMARY KEY,
+                value BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                kind         TEXT    NOT NULL,  -- "post" | "comment"
+                id           INTEGER NOT NULL,
+                thread       INTEGER NOT NULL,  -- id поста для комментария, 0 для поста
+                grouped_id   INTEGER,
+                date         REAL,
+                text         TEXT    NOT NULL,
+                sender_id    INTEGER,
+                sender_label TEXT,
+                media        TEXT,              -- sha256 файла в media/
+                raw          BLOB    NOT NULL,
+                sender       BLOB,
+                PRIMARY KEY (kind, id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS messages_thread ON messages (kind, thread, id);
+            CREATE TABLE IF NOT EXISTS media (
+                key  TEXT PRIMARY KEY,  -- upload_cache.source_key: id документа/фото в источнике
+                sha  TEXT    NOT NULL,
+                size INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            """
+        )
+        self._db.commit()
+        self._pending = 0
+
+    def set_source(self, entity) -> None:
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('source', ?)", (bytes(entity),))
+        self._db.commit()
+
+    def source(self):
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        return BinaryReader(row[0]).tgread_object() if row else None
+
+    def last_id(self, kind: str, thread: int = 0) -> int:
+        row = self._db.execute("SELECT MAX(id) FROM messages WHERE kind = ? AND thread = ?", (kind, thread)).fetchone()
+        return row[0] or 0
+
+    def recent_posts(self, n: int) -> list[int]:
+        rows = self._db.execute("SELECT id FROM messages WHERE kind = 'post' ORDER BY id DESC LIMIT ?", (n,))
+        return sorted(r[0] for r in rows)
+
+    def append(self, kind: str, msg, *, thread: int = 0, media: str | None = None, sender=None) -> None:
+        self._db.execute(
+            "INSERT OR IGNORE INTO messages "
+            "(kind, id, thread, grouped_id, date, text, sender_id, sender_label, media, raw, sender) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind, msg.id, thread, msg.grouped_id, msg.date.timestamp() if msg.date else None,
+                msg.message or "", msg.sender_id, author_label(sender) if sender is not None else None,
+                media, bytes(msg), bytes(sender) if sender is not None else None,
+            ),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def media_sha(self, key: str | None) -> str | None:
+        if key is None:
+            return None
+        row = self._db.execute("SELECT sha FROM media WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def media_file(self, sha: str) -> Path:
+        return self.media_dir / sha[:2] / sha
+
+    def add_media(self, key: str, path: str, digest: str) -> tuple[str, bool]:
+        """Переносит скачанный файл в media/ под его sha256; True — такого содержимого в архиве ещё не было."""
+        sha = digest.split(":", 1)[1]
+        target = self.media_file(sha)
+        size = os.path.getsize(path)
+        new = not target.exists()
+        if new:
+            target.parent.mkdir(exist_ok=True)
+            os.replace(path, target)
+        else:
+            os.remove(path)
+        self._db.execute("INSERT OR REPLACE INTO media (key, sha, size) VALUES (?, ?, ?)", (key, sha, size))
+        return sha, new
+
+    def rows(self, kind: str, *, thread: int = 0, min_id: int = 0, max_id: int = 0, ids: list[int] | None = None,
+             limit: int | None = None, reverse: bool = True) -> list[tuple]:
+        """
+        (id, raw, sender, comments, comments_max_id) по возрастанию id (reverse) или по убыванию;
+        comments/comments_max_id — сколько комментариев к посту в архиве и последний из них.
+        """
+        where = ["m.kind = ?", "m.thread = ?", "m.id > ?"]
+        args: list = [kind, thread, min_id]
+        if max_id:
+            where.append("m.id < ?")
+            args.append(max_id)
+        if ids is not None:
+            where.append(f"m.id IN ({','.join('?' * len(ids))})")
+            args.extend(ids)
+        sql = (
+            "SELECT m.id, m.raw, m.sender, COUNT(c.id), MAX(c.id) FROM messages m "
+            "LEFT JOIN messages c ON c.kind = 'comment' AND c.thread = m.id AND m.kind = 'post' "
+            f"WHERE {' AND '.join(where)} GROUP BY m.id ORDER BY m.id {'ASC' if reverse else 'DESC'}"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return self._db.execute(sql, args).fetchall()
+
+    def summary(self) -> str:
+        posts, comments = (self._db.execute("SELECT COUNT(*) FROM messages WHERE kind = ?", (k,)).fetchone()[0]
+                           for k in ("post", "comment"))
+        files, size = self._db.execute("SELECT COUNT(DISTINCT sha), COALESCE(SUM(size), 0) FROM media").fetchone()
+        return f"posts={posts} comments={comments} media_keys={files} media_bytes={size}"
+
+    def commit(self) -> None:
+        self._db.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._db.close()
+
+
+@dataclass
+class ExportStats:
+    posts: int = 0
+    comments: int = 0
+    files: int = 0        # новых файлов в media/
+    file_bytes: int = 0
+    reused: int = 0       # медиа, которые уже были в архиве (тот же id в источнике или то же содержимое)
+
+    def summary(self) -> str:
+        return (f"posts={self.posts} comments={self.comments} files={self.files} "
+                f"file_bytes={self.file_bytes} reused={self.reused}")
+
+
+class ArchiveExporter:
+    """
+    TG_ARCHIVE_MODE=export: дописывает в архив посты источника новее последнего в архиве
+    и комментарии к ним; треды последних comments_recheck постов перепроверяются по replies, как в comment_queue.
+    Медиа качаются через MediaSender (крупные — частями, с пулом — читающими аккаунтами),
+    до queue_depth сообщений одновременно; в журнал сообщения попадают строго по порядку id.
+    Ничего не публикует, поэтому упирается только в лимиты чтения.
+    """
+
+    def __init__(self, client: TelegramClient, cfg: Config, archive: Archive, *,
+                 limiter: RateLimiter | None = None, pool: SessionPool | None = None):
+        self.client = client
+        self.cfg = cfg
+        self.archive = archive
+        self.pool = pool
+        if pool is not None:
+            pool.register(cfg.source)
+        self.policy = RetryPolicy(limiter=limiter)
+        self.media = MediaSender(client, tmp_dir=archive.tmp_dir, cleanup=True, force_document=False,
+                                 policy=self.policy, item_concurrency=cfg.album_concurrency,
+                                 parallel_min=cfg.parallel_download_min, download_parts=cfg.download_parts,
+                                 readers=pool)
+        self.readers: SessionPool | None = None  # пул для чтения истории, если он видит источник
+        self.stats = ExportStats()
+
+    async def run(self, src) -> ExportStats:
+        self.archive.set_source(src)
+        if self.pool is not None and await self.pool.covers(src):
+            self.readers = self.pool
+        min_id = self.archive.last_id("post")
+        log.info("archive | export %s -> %s | min_id=%s limit=%s comments=%s",
+                 self.cfg.source, self.archive.path, min_id, self.cfg.limit, self.cfg.sync_comments)
+
+        threads: list[int] = []
+        async for m, media in self._with_media(self._history(src, min_id=min_id, limit=self.cfg.limit), ctx="post"):
+            self.archive.append("post", m, media=media)
+            self.stats.posts += 1
+            if self.cfg.sync_comments and replies_max_id([m]):
+                threads.append(m.id)
+        self.archive.commit()
+
+        if self.cfg.sync_comments:
+            threads += await self._stale_threads(src, skip=set(threads))
+            for post_id in threads:
+                await self._export_thread(src, post_id)
+            self.archive.commit()
+        return self.stats
+
+    def _history(self, src, *, min_id: int, limit: int | None, reply_to: int | None = None):
+        if self.readers is not None:
+            return self.readers.iter_history(src, min_id=min_id, limit=limit, reply_to=reply_to)
+        return paced_history(self.client.iter_messages(src, min_id=min_id, limit=limit, reverse=True,
+                                                       reply_to=reply_to),
+                             self.policy.limiter)
+
+    async def _stale_threads(self, src, *, skip: set[int]) -> list[int]:
+        """Посты из последних comments_recheck, у которых в источнике есть комментарии новее архива."""
+        ids = [i for i in self.archive.recent_posts(self.cfg.comments_recheck) if i not in skip]
+        stale = []
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            posts = await read_messages(self.readers, self.client, src, ids=chunk,
+                                        ctx=f"archive recheck posts={len(chunk)}", policy=self.policy)
+            for post in posts:
+                if post is not None and replies_max_id([post]) > self.archive.last_id("comment", post.id):
+                    stale.append(post.id)
+        log.info("archive | recheck comments | window=%s with_new_comments=%s", len(ids), len(stale))
+        return stale
+
+    async def _export_thread(self, src, post_id: int) -> None:
+        min_id = self.archive.last_id("comment", post_id)
+        history = self._history(src, min_id=min_id, limit=self.cfg.comments_limit, reply_to=post_id)
+        n = 0
+        async for c, media in self._with_media(history, ctx=f"comment post={post_id}"):
+            self.archive.append("comment", c, thread=post_id, media=media, sender=await self._sender(c))
+            n += 1
+        self.stats.comments += n
+        log.debug("archive | thread post=%s min_id=%s comments=%s", post_id, min_id, n)
+
+    async def _with_media(self, history, *, ctx: str):
+        """(сообщение, sha медиа) по порядку истории; медиа до queue_depth сообщений качаются одновременно."""
+        window: deque = deque()
+        try:
+            async for m in history:
+                window.append((m, asyncio.ensure_future(self._save_media(m, ctx=ctx))))
+                if len(window) >= max(1, self.cfg.queue_depth):
+                    m, task = window.popleft()
+                    yield m, await task
+            while window:
+                m, task = window.popleft()
+                yield m, await task
+        finally:
+            for _, task in window:
+                task.cancel()
+            await asyncio.gather(*(t for _, t in window), return_exceptions=True)
+
+    async def _save_media(self, m, *, ctx: str) -> str | None:
+        # без id документа/фото (опросы, геоточки, контакты) файла нет — сообщение хранит всё само
+        key = source_key(m) if is_real_media(m) else None
+        if key is None:
+            return None
+        sha = self.archive.media_sha(key)
+        if sha is not None:
+            self.stats.reused += 1
+            return sha
+
+        self.archive.tmp_dir.mkdir(exist_ok=True)
+        tmp = str(self.archive.tmp_dir / f"{abs(m.chat_id or 0)}_{m.id}")
+        try:
+            path = await self.media.download_file(m, tmp, ctx=f"archive {ctx}")
+            digest = await asyncio.to_thread(file_digest, path)
+        except BaseException:
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            raise
+        size = os.path.getsize(path)
+        sha, new = self.archive.add_media(key, path, digest)
+        if new:
+            self.stats.files += 1
+            self.stats.file_bytes += size
+        else:
+            self.stats.reused += 1
+        return sha
+
+    async def _sender(self, c):
+        if c.sender is not None or c.sender_id is None:
+            return c.sender
+        try:
+            return await c.get_sender()
+        except Exception as e:
+            log.debug("archive | sender of comment %s: %s: %s", c.id, type(e).__name__, e)
+            return None
+
+
+async def export_archive(client: TelegramClient, cfg: Config, *, limiter: RateLimiter | None = None,
+                         pool: SessionPool | None = None) -> ExportStats:
+    src = await client.get_entity(cfg.source)
+    archive = Archive(archive_path(cfg))
+    try:
+        stats = await ArchiveExporter(client, cfg, archive, limiter=limiter, pool=pool).run(src)
+        log.info("archive | %s | exported %s | total %s", cfg.source, stats.summary(), archive.summary())
+        return stats
+    finally:
+        archive.close()
+
+
+def open_reader(cfg: Config) -> "ArchiveReader":
+    path = archive_path(cfg)
+    if not (path / "messages.sqlite3").is_file():
+        raise RuntimeError(f"{path}: архива нет — сначала TG_ARCHIVE_MODE=export")
+    return ArchiveReader(Archive(path))
+
+
+class ArchiveReader:
+    """
+    Архив в роли источника (TG_ARCHIVE_MODE=replay) — та часть TelegramClient, которой источник читают
+    конвейер постов, CommentCopier и MediaSender: iter_messages, get_messages, download_media, iter_download.
+    Источник и сообщения помечены noforwards, поэтому медиа всегда загружаются из media/, а не по handle;
+    replies постов — по комментариям, которые есть в архиве, а не по тому, что было при экспорте поста.
+    """
+
+    def __init__(self, archive: Archive):
+        self.archive = archive
+        self.entity = archive.source()
+        if self.entity is None:
+            raise RuntimeError(f"{archive.path}: в архиве нет источника — экспорт ещё не запускался")
+        self.entity.noforwards = True
+
+    async def iter_messages(self, entity, limit=None, *, min_id: int = 0, reverse: bool = False, reply_to=None,
+                            **kw):
+        kind, thread = ("comment", reply_to) if reply_to is not None else ("post", 0)
+        max_id = 0
+        left = limit
+        while left is None or left > 0:
+            page = READ_PAGE if left is None else min(READ_PAGE, left)
+            rows = self.archive.rows(kind, thread=thread, min_id=min_id, max_id=max_id, limit=page, reverse=reverse)
+            for row in rows:
+                yield self._message(kind, row)
+            if len(rows) < page:
+                return
+            if reverse:
+                min_id = rows[-1][0]
+            else:
+                max_id = rows[-1][0]
+            if left is not None:
+                left -= len(rows)
+
+    async def get_messages(self, entity, limit=None, *, ids=None, **kw):
+        if ids is None:
+            return [m async for m in self.iter_messages(entity, limit or 1)]
+        wanted = [ids] if isinstance(ids, int) else list(ids)
+        by_id = {row[0]: self._message("post", row) for row in self.archive.rows("post", ids=wanted)}
+        if isinstance(ids, int):
+            return by_id.get(ids)
+        return [by_id.get(i) for i in wanted]
+
+    async def download_media(self, message, file=None, **kw):
+        path = self._media_file(message.media)
+        if path is None:
+            return None
+        if file is bytes:
+            return await asyncio.to_thread(path.read_bytes)
+        await asyncio.to_thread(shutil.copyfile, path, str(file))
+        return str(file)
+
+    async def iter_download(self, file, *, offset: int = 0, limit: int | None = None,
+                            request_size: int = 512 * 1024, **kw):
+        path = self._media_file(file)
+        if path is None:
+            raise FileNotFoundError(f"{self.archive.path}: нет файла для {type(file).__name__}")
+        with open(path, "rb") as f:
+            f.seek(offset)
+            n = 0
+            while limit is None or n < limit:
+                chunk = f.read(request_size)
+                if not chunk:
+                    return
+                n += 1
+                yield chunk
+
+    def close(self) -> None:
+        self.archive.close()
+
+    def _media_file(self, media) -> Path | None:
+        key = media_key(media)
+        if key is None:
+            return None
+        sha = self.archive.media_sha(key)
+        if sha is None:
+            raise FileNotFoundError(f"{self.archive.path}: {key} не скачан в архив")
+        return self.archive.media_file(sha)
+
+    def _message(self, kind: str, row: tuple):
+        _, raw, sender, comments, comments_max_id = row
+        m = BinaryReader(raw).tgread_object()
+        m.noforwards = True
+        m._client = self
+        if sender is not None:
+            m._sender = BinaryReader(sender).tgread_object()
+        if kind == "post" and (comments or m.replies is not None):
+            if m.replies is None:
+                m.replies = MessageReplies(replies=0, replies_pts=0, comments=True)
+            m.replies.replies, m.replies.max_id = comments, comments_max_id
+        return m
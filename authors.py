@@ -0,0 +1,149 @@
+from __future__ import annotations
+import copy
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from telethon.tl.types import InputMessageEntityMentionName, InputUser, InputUserFromMessage, MessageEntityBold, User
+
+log = logging.getLogger("tg_sync.authors")
+
+
+def author_label(sender) -> str:
+    if sender is None:
+        return "unknown"
+    username = getattr(sender, "username", None)
+    if username:
+        return f"@{username}"
+    fn = (getattr(sender, "first_name", "") or "").strip()
+    ln = (getattr(sender, "last_name", "") or "").strip()
+    name = (fn + (" " + ln if ln else "")).strip()
+    return name or str(getattr(sender, "id", "unknown"))
+
+
+def utf16_len(text: str) -> int:
+    # offset/length сущностей Telegram считаются в UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
+
+
+def author_mention(msg):
+    """
+    InputUser отправителя msg для ссылки на него из подписи, если у него нет username
+    (подпись @username — уже ссылка); None — сослаться не на что.
+    min-пользователь (access_hash годится только в его чате) адресуется через сообщение, где его видели.
+    """
+    sender = getattr(msg, "sender", None)
+    if not isinstance(sender, User) or sender.username:
+        return None
+    if sender.min:
+        chat = msg.input_chat
+        return InputUserFromMessage(chat, msg.id, sender.id) if chat is not None else None
+    if sender.access_hash is None:
+        return None
+    return InputUser(sender.id, sender.access_hash)
+
+
+def with_author(label: str, text: str, entities, *, user=None) -> tuple[str, list]:
+    """
+    Текст с подписью автора в начале: "**label:**\ntext"; с user (см. author_mention) label — ещё и ссылка на автора.
+    Сущности исходного текста сдвигаются на длину префикса (копии — исходное сообщение не трогаем).
+    """
+    head = f"{label}:"
+    prefix = f"{head}\n" if text else head
+    shift = utf16_len(prefix)
+
+    shifted = []
+    for e in entities or []:
+        e = copy.copy(e)
+        e.offset += shift
+        shifted.append(e)
+    own = [MessageEntityBold(offset=0, length=utf16_len(head))]
+    if user is not None:
+        own.append(InputMessageEntityMentionName(offset=0, length=utf16_len(label), user_id=user))
+    return prefix + text, own + shifted
+
+
+class AuthorCache:
+    """
+    LRU-кэш подписей авторов комментариев: sender_id -> author_label.
+    Заполняется из users/chats, которые Telegram уже вернул вместе со страницей истории
+    (c.sender после iter_messages), поэтому get_sender() по сети нужен только для тех,
+    кого на странице не было. С path подписи переживают рестарт (SQLite).
+    """
+
+    def __init__(self, path: Path | None = None, *, max_entries: int = 5000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.lookups = 0  # сколько раз пришлось идти в сеть за отправителем
+        self._labels: OrderedDict[int, str] = OrderedDict()
+
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(str(path))
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS authors (
+                    sender_id INTEGER PRIMARY KEY,
+                    label     TEXT NOT NULL,
+                    updated   REAL NOT NULL
+                )
+                """
+            )
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT sender_id, label FROM authors ORDER BY updated DESC LIMIT ?", (max_entries,)
+            ).fetchall()
+            for sender_id, label in reversed(rows):
+                self._labels[sender_id] = label
+
+    def prime(self, msgs) -> None:
+        """Берёт отправителей, пришедших вместе со страницей истории, без запросов в сеть."""
+        for m in msgs:
+            sender = getattr(m, "sender", None)
+            if m.sender_id is not None and sender is not None:
+                self._put(m.sender_id, author_label(sender))
+
+    async def label(self, msg) -> str:
+        sender_id = msg.sender_id
+        if sender_id is not None and sender_id in self._labels:
+            self._labels.move_to_end(sender_id)
+            self.hits += 1
+            return self._labels[sender_id]
+
+        sender = getattr(msg, "sender", None)
+        if sender is None:
+            self.lookups += 1
+            try:
+                sender = await msg.get_sender()
+            except Exception:
+                pass
+
+        label = author_label(sender)
+        if sender_id is not None and sender is not None:
+            self._put(sender_id, label)
+        return label
+
+    def summary(self) -> str:
+        return f"cached={len(self._labels)} hits={self.hits} lookups={self.lookups}"
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+    def _put(self, sender_id: int, label: str) -> None:
+        changed = self._labels.get(sender_id) != label
+        self._labels[sender_id] = label
+        self._labels.move_to_end(sender_id)
+        while len(self._labels) > self.max_entries:
+            self._labels.popitem(last=False)
+
+        # пишем только новое/изменившееся (сменили username) — подписи меняются редко
+        if changed and self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO authors (sender_id, label, updated) VALUES (?, ?, ?)",
+                (sender_id, label, time.time()),
+            )
+            self._db.commit()
@@ -0,0 +1,280 @@
+"""
+Бенчмарк без сети: гоняет main.run, PostCopier (+ CopyPipeline) и CommentCopier против fake_telegram
+и печатает юниты/сек, задержку юнита p50/p99 (от выдачи исходного сообщения из истории до отправки
+последнего сообщения юнита в DEST) и пиковую память.
+
+    python bench.py                       # все сценарии
+    python bench.py main --posts 500 --latency 0.02 --transfer-mode memory
+    python bench.py comments --flood-rate 0.02 --tracemalloc
+    python bench.py comments --comments-mode group
+    python bench.py main --protected --readers 2 --read-flood-rate 0.05
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import main as app
+from comments import CommentCopier
+from config import Config
+from copier import PostCopier
+from discussion import DiscussionHarvester
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient
+from metrics import UNITS_COPIED
+from pipeline import CopyPipeline
+from pool import PoolSession, SessionPool, reader_policy
+from ratelimit import RateLimiter
+from state import SqliteStateStore
+
+JOB = "bench"
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def unit_latencies(fake: FakeTelegramClient, state_db: Path, readers: list[FakeTelegramClient]) -> list[float]:
+    """
+    src->dest из id_map; юнит — все сообщения с одним fake.units (альбом целиком).
+    Историю могли читать аккаунты пула — берём самую раннюю выдачу сообщения.
+    """
+    db = sqlite3.connect(str(state_db))
+    try:
+        rows = db.execute("SELECT kind, src_id, dest_id FROM id_map").fetchall()
+    finally:
+        db.close()
+
+    started: dict[tuple[str, int], float] = {}
+    done: dict[tuple[str, int], float] = {}
+    for kind, src_id, dest_id in rows:
+        unit = (kind, fake.units.get((kind, src_id), src_id))
+        t0 = min((c.yielded_at[(kind, src_id)] for c in [fake, *readers] if (kind, src_id) in c.yielded_at),
+                 default=None)
+        t1 = fake.sent_at.get(dest_id)
+        if t0 is None or t1 is None:
+            continue
+        started[unit] = min(started.get(unit, t0), t0)
+        done[unit] = max(done.get(unit, t1), t1)
+    return [done[u] - started[u] for u in done]
+
+
+def bench_env(args, tmp: Path) -> dict[str, str]:
+    return {
+        "TG_API_ID": "1",
+        "TG_API_HASH": "bench",
+        "TG_SESSION": "",
+        "TG_SOURCE": "fake_source",
+        "TG_DEST": "fake_dest",
+        "TG_LAST_SEEN_ID": "0",
+        "TG_LIMIT": "0",
+        "TG_STATE_BACKEND": "sqlite",
+        "TG_STATE_DB": str(tmp / "state.sqlite3"),
+        "TG_TMP_DIR": str(tmp / "media"),
+        "TG_JOURNAL": str(tmp / "journal.sqlite3"),
+        "TG_UPLOAD_CACHE": str(tmp / "upload_cache.sqlite3") if args.upload_cache else "",
+        "TG_TRANSFER_MODE": args.transfer_mode,
+        "TG_PARALLEL_DOWNLOAD_MB": str(args.parallel_download_mb),
+        "TG_DOWNLOAD_PARTS": str(args.download_parts),
+        "TG_PARALLEL_UPLOAD_MB": str(args.parallel_upload_mb),
+        "TG_UPLOAD_PARTS": str(args.upload_parts),
+        "TG_WORKERS": str(args.workers),
+        "TG_SYNC_COMMENTS": "1",
+        "TG_COMMENTS_LIMIT": "0",
+        "TG_COMMENTS_AUTHOR_STYLE": args.author_style,
+        "TG_COMMENTS_QUEUE_FILE": str(tmp / "comments_queue.json"),
+        "TG_COMMENTS_MODE": args.comments_mode,
+        "TG_RATE_LIMITS": args.rate_limits,
+        "TG_DAEMON": "0",
+        "TG_JOBS_FILE": "",
+        "TG_METRICS_PORT": "0",
+        "LOG_LEVEL": args.log_level,
+        "LOG_FILE": "",
+    }
+
+
+def fake_pool(cfg: Config, readers: list[FakeTelegramClient]) -> SessionPool | None:
+    """Пул читающих аккаунтов, как pool.open_pool, но из fake-клиентов."""
+    if not readers:
+        return None
+    pool = SessionPool([
+        PoolSession(name=f"reader{i + 1}", client=c, policy=reader_policy(cfg))
+        for i, c in enumerate(readers)
+    ])
+    pool.register(cfg.source)
+    return pool
+
+
+def history_pool(fake: FakeTelegramClient, pool: SessionPool | None) -> SessionPool | None:
+    # как SourceSync._history_readers: историю через пул читаем только у защищённого источника
+    return pool if fake.source.noforwards else None
+
+
+async def run_main(fake: FakeTelegramClient, cfg: Config, tmp: Path, pool: SessionPool | None) -> Path:
+    await app.run(cfg, client=fake, pool=pool)
+    return cfg.state_db
+
+
+async def run_posts(fake: FakeTelegramClient, cfg: Config, tmp: Path, pool: SessionPool | None) -> Path:
+    limiter = RateLimiter(cfg.rate_limits)
+    upload_cache = app.open_upload_cache(cfg)
+    state = SqliteStateStore(cfg.state_db, source=JOB)
+    copier = PostCopier(fake, cfg.tmp_dir, cfg.cleanup, cfg.link_preview, cfg.force_document,
+                        transfer_mode=cfg.transfer_mode, stream_small=cfg.stream_small,
+                        stream_buffer=cfg.stream_buffer, album_concurrency=cfg.album_concurrency,
+                        upload_cache=upload_cache, limiter=limiter, parallel_min=cfg.parallel_download_min,
+                        download_parts=cfg.download_parts, parallel_upload_min=cfg.parallel_upload_min,
+                        upload_parts=cfg.upload_parts, readers=pool)
+    pipeline = CopyPipeline(fake, copier, src=fake.source, dest=fake.dest, state=state, last_seen=0, min_id=0,
+                            limit=None, workers=cfg.workers, depth=cfg.queue_depth, name=JOB,
+                            readers=history_pool(fake, pool))
+    try:
+        await pipeline.run()
+    finally:
+        state.close()
+        app.close_upload_cache(upload_cache)
+    return cfg.state_db
+
+
+async def run_comments(fake: FakeTelegramClient, cfg: Config, tmp: Path, pool: SessionPool | None) -> Path:
+    limiter = RateLimiter(cfg.rate_limits)
+    upload_cache = app.open_upload_cache(cfg)
+    state = SqliteStateStore(cfg.state_db, source=JOB)
+    copier = CommentCopier(fake, tmp_dir=cfg.tmp_dir, cleanup=cfg.cleanup, limit=None,
+                           include_author=cfg.comments_include_author, author_style=cfg.comments_author_style,
+                           force_document=cfg.force_document, link_preview=cfg.link_preview,
+                           transfer_mode=cfg.transfer_mode, stream_small=cfg.stream_small,
+                           stream_buffer=cfg.stream_buffer, album_concurrency=cfg.album_concurrency,
+                           parallel_min=cfg.parallel_download_min, download_parts=cfg.download_parts,
+                           parallel_upload_min=cfg.parallel_upload_min, upload_parts=cfg.upload_parts,
+                           state=state, upload_cache=upload_cache, limiter=limiter, job=JOB, readers=pool)
+    copier.history = history_pool(fake, pool)
+    try:
+        # треды «уже опубликованных» постов: dest id поста для комментариев не важен
+        for src_post_id in fake.comments:
+            state.register_thread(src_post_id, src_post_id)
+        if cfg.comments_mode == "group":
+            harvester = DiscussionHarvester(copier, state, src=fake.source, dest=fake.dest)
+            await harvester.run(last_seen=fake.posts[-1].id, readers=copier.history)
+        else:
+            for src_post_id in fake.comments:
+                await copier.copy_comments_for_post(fake.source, fake.dest, src_post_id=src_post_id,
+                                                    dest_post_id=src_post_id)
+    finally:
+        state.close()
+        app.close_upload_cache(upload_cache)
+    return cfg.state_db
+
+
+SCENARIOS = {"main": run_main, "posts": run_posts, "comments": run_comments}
+
+
+async def bench(name: str, args) -> dict:
+    spec = ChannelSpec(posts=args.posts, file_size=args.file_size_kb * 1024,
+                       big_file_size=args.big_file_mb * 1024 * 1024, repeat_rate=args.repeat_rate, seed=args.seed,
+                       protected=args.protected)
+    net = FakeNetwork(latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024,
+                      flood_rate=args.flood_rate, flood_seconds=args.flood_seconds,
+                      read_flood_rate=args.read_flood_rate)
+
+    with tempfile.TemporaryDirectory(prefix=f"bench_{name}_") as d:
+        tmp = Path(d)
+        os.environ.update(bench_env(args, tmp))
+        cfg = Config.from_env(tmp / ".env")
+        cfg.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+        # как в main.open_clients: FloodWait не пересыпается внутри клиента — его обрабатывают лимитер и пул
+        fake = FakeTelegramClient(spec, net, flood_sleep_threshold=0)
+        readers = [FakeTelegramClient(spec, net, flood_sleep_threshold=0) for _ in range(args.readers)]
+        pool = fake_pool(cfg, readers)
+        units_before = UNITS_COPIED.total()
+        if args.tracemalloc:
+            tracemalloc.start()
+        t0 = time.monotonic()
+        state_db = await SCENARIOS[name](fake, cfg, tmp, pool)
+        elapsed = time.monotonic() - t0
+        peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+
+        units = UNITS_COPIED.total() - units_before
+        lat = unit_latencies(fake, state_db, readers)
+        return {
+            "scenario": name,
+            "units": int(units),
+            "seconds": elapsed,
+            "units_per_s": units / elapsed if elapsed else 0.0,
+            "p50": percentile(lat, 0.5),
+            "p99": percentile(lat, 0.99),
+            "py_peak_mb": peak / 1024 / 1024 if peak is not None else None,
+            "calls": dict(sorted(fake.calls.items())),
+            "flood_waits": fake.flood_waits + sum(c.flood_waits for c in readers),
+            "reader_calls": [dict(sorted(c.calls.items())) for c in readers],
+        }
+
+
+def report(r: dict) -> None:
+    # ru_maxrss на Linux — в КиБ, пик процесса за всё время (сценарии идут подряд)
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    py_peak = f"{r['py_peak_mb']:.1f}MB" if r["py_peak_mb"] is not None else "-"
+    print(f"{r['scenario']:<9} units={r['units']:<5} time={r['seconds']:.1f}s "
+          f"units/s={r['units_per_s']:.2f} p50={r['p50']:.2f}s p99={r['p99']:.2f}s "
+          f"py_peak={py_peak} max_rss={rss_mb:.0f}MB flood_waits={r['flood_waits']}")
+    print(f"{'':<9} calls: " + " ".join(f"{k}={v}" for k, v in r["calls"].items()))
+    for i, calls in enumerate(r["reader_calls"]):
+        print(f"{'':<9} reader{i + 1}: " + " ".join(f"{k}={v}" for k, v in calls.items()))
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Бенчмарк копирования против локального fake Telegram")
+    p.add_argument("scenarios", nargs="*", help="main / posts / comments (по умолчанию — все)")
+    p.add_argument("--posts", type=int, default=200)
+    p.add_argument("--file-size-kb", type=int, default=1024)
+    p.add_argument("--big-file-mb", type=int, default=24)
+    p.add_argument("--repeat-rate", type=float, default=0.2)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--latency", type=float, default=0.05, help="секунд на вызов")
+    p.add_argument("--bandwidth-mb", type=float, default=20, help="МБ/с")
+    p.add_argument("--protected", action="store_true", help="источник с noforwards: медиа всегда перезаливается")
+    p.add_argument("--flood-rate", type=float, default=0.0)
+    p.add_argument("--flood-seconds", type=int, default=3)
+    p.add_argument("--read-flood-rate", type=float, default=0.0, help="FloodWait на чтении истории и скачивании")
+    p.add_argument("--readers", type=int, default=0, help="читающих аккаунтов в пуле (fake)")
+    p.add_argument("--transfer-mode", choices=("disk", "memory"), default="disk")
+    p.add_argument("--parallel-download-mb", type=int, default=20, help="0 — качать одним потоком")
+    p.add_argument("--download-parts", type=int, default=4)
+    p.add_argument("--parallel-upload-mb", type=int, default=20, help="0 — загружать силами Telethon, по одной части")
+    p.add_argument("--upload-parts", type=int, default=4)
+    p.add_argument("--workers", type=int, default=3)
+    p.add_argument("--author-style", choices=("message", "inline"), default="message")
+    p.add_argument("--comments-mode", choices=("threads", "group"), default="threads")
+    # без лимитов по умолчанию: меряем сам конвейер, а не заданную скорость вызовов
+    p.add_argument("--rate-limits", default="send_message=0,send_file=0,get_history=0,download=0,upload=0")
+    p.add_argument("--no-upload-cache", dest="upload_cache", action="store_false")
+    p.add_argument("--tracemalloc", action="store_true", help="пик памяти Python (медленнее)")
+    p.add_argument("--log-level", default="WARNING")
+    args = p.parse_args()
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        p.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    return args
+
+
+async def amain():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    for name in args.scenarios or list(SCENARIOS):
+        report(await bench(name, args))
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
@@ -0,0 +1,249 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from comments import CommentCopier
+from copier import replies_max_id
+from metrics import COMMENT_QUEUE_AGE, COMMENT_QUEUE_JOBS, COMMENT_QUEUE_LAG
+from pool import read_messages
+from state import StateStore
+
+log = logging.getLogger("tg_sync.comment_queue")
+
+# Сколько раз подряд повторять тред, который не скопировался; потом задание снимается
+# (recheck поставит его снова, если в треде появятся новые комментарии)
+MAX_ATTEMPTS = 5
+# Пауза перед повтором: RETRY_DELAY * номер попытки, секунд
+RETRY_DELAY = 30.0
+
+
+@dataclass
+class CommentJob:
+    src_post_id: int
+    dest_post_id: int
+    enqueued_at: float
+    attempts: int = 0  # неудачных попыток подряд
+
+
+class PostPriority:
+    """
+    Посты важнее комментариев: пока в конвейере есть неопубликованные посты,
+    комментарии ждут (CommentCopier проверяет это перед каждым комментарием).
+    """
+
+    def __init__(self):
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def acquire(self) -> None:
+        self._active += 1
+        self._idle.clear()
+
+    def release(self) -> None:
+        self._active = max(0, self._active - 1)
+        if not self._active:
+            self._idle.set()
+
+    async def wait_idle(self) -> None:
+        await self._idle.wait()
+
+
+class CommentQueue:
+    """Очередь заданий на копирование комментариев; переживает рестарт (JSON-файл)."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._jobs: list[CommentJob] = []
+        if path.is_file():
+            with open(path, encoding="utf-8") as f:
+                self._jobs = [CommentJob(**x) for x in json.load(f)]
+            if self._jobs:
+                log.info("comment queue: %s pending jobs restored from %s", len(self._jobs), path)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def pending(self) -> list[CommentJob]:
+        return list(self._jobs)
+
+    def push(self, job: CommentJob) -> None:
+        self._jobs.append(job)
+        self._save()
+
+    def done(self, job: CommentJob) -> None:
+        self._jobs = [j for j in self._jobs if j.src_post_id != job.src_post_id]
+        self._save()
+
+    def failed(self, job: CommentJob) -> None:
+        job.attempts += 1
+        self._save()
+
+    def _save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump([asdict(j) for j in self._jobs], f)
+        os.replace(tmp, self.path)
+
+
+class CommentSyncWorker:
+    """
+    Отдельные воркеры для комментариев: конвейер постов только ставит задание в очередь
+    и сразу идёт дальше, а комментарии копируются параллельно с собственным лимитом concurrency.
+    """
+
+    def __init__(
+        self,
+        comment_copier: CommentCopier,
+        queue: CommentQueue,
+        *,
+        src,
+        dest,
+        concurrency: int = 1,
+        priority: PostPriority | None = None,
+        report_every: float = 30.0,
+    ):
+        self.comment_copier = comment_copier
+        self.queue = queue
+        self.src = src
+        self.dest = dest
+        self.concurrency = max(1, concurrency)
+        self.priority = priority
+        self.report_every = report_every
+
+        self.last_post_id = 0  # последний опубликованный пост (для лага)
+        self.done_jobs = 0
+        self.failed_jobs = 0  # снято после MAX_ATTEMPTS неудач
+        self._retry_at: dict[int, float] = {}  # src_post_id -> когда (monotonic) можно повторить
+        # посты разового запуска опубликованы — повторы ждут следующего запуска
+        self._draining = asyncio.Event()
+        self._q: asyncio.Queue = asyncio.Queue()
+        for job in queue.pending():
+            self._q.put_nowait(job)
+        self._export()
+
+    def submit(self, src_post_id: int, dest_post_id: int) -> None:
+        self.last_post_id = max(self.last_post_id, src_post_id)
+        if any(j.src_post_id == src_post_id for j in self.queue.pending()):
+            return
+        job = CommentJob(src_post_id=src_post_id, dest_post_id=dest_post_id, enqueued_at=time.time())
+        self.queue.push(job)
+        self._q.put_nowait(job)
+        self._export()
+
+    async def recheck(self, state: StateStore, window: int) -> int:
+        """
+        Перепроверяет window последних скопированных постов: по replies.max_id из метаданных
+        ставит в очередь только те, где есть комментарии новее watermark треда.
+        """
+        threads = state.recent_threads(window)
+        if not threads:
+            return 0
+
+        copier = self.comment_copier
+        submitted = 0
+        for i in range(0, len(threads), 100):
+            chunk = threads[i:i + 100]
+            posts = await read_messages(copier.media.readers, copier.source_client, self.src,
+                                        ids=[t[0] for t in chunk], ctx=f"recheck comments posts={len(chunk)}",
+                                        policy=copier.policy)
+            for (src_post_id, dest_post_id, watermark), post in zip(chunk, posts):
+                if post is not None and replies_max_id([post]) > watermark:
+                    self.submit(src_post_id, dest_post_id)
+                    submitted += 1
+
+        log.info("recheck comments | window=%s threads=%s with_new_comments=%s", window, len(threads), submitted)
+        return submitted
+
+    def metrics(self) -> dict:
+        pending = self.queue.pending()
+        oldest = min(pending, key=lambda j: j.enqueued_at, default=None)
+        return {
+            "depth": len(pending),
+            "oldest_age_s": round(time.time() - oldest.enqueued_at, 1) if oldest else 0.0,
+            "lag_posts": (self.last_post_id - oldest.src_post_id) if oldest else 0,
+            "done": self.done_jobs,
+            "failed": self.failed_jobs,
+        }
+
+    def _export(self) -> None:
+        """Глубина, возраст и лаг очереди — в метрики (/metrics); возраст ещё и раз в report_every."""
+        m = self.metrics()
+        job = self.comment_copier.job
+        COMMENT_QUEUE_JOBS.set(m["depth"], job=job)
+        COMMENT_QUEUE_AGE.set(m["oldest_age_s"], job=job)
+        COMMENT_QUEUE_LAG.set(m["lag_posts"], job=job)
+
+    async def run(self, until: asyncio.Future | None = None) -> None:
+        """
+        Обрабатывает задания, пока не завершится until (например, задача конвейера постов)
+        и очередь не опустеет. Без until — работает, пока не отменят.
+        """
+        self.comment_copier.priority = self.priority
+        workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            if until is not None:
+                await asyncio.wait({until})
+                self._draining.set()
+                # если конвейер постов упал — не дожидаемся хвоста, задания останутся в файле
+                if not until.cancelled() and until.exception() is None:
+                    await self._q.join()
+            else:
+                await asyncio.gather(*workers)
+        finally:
+            for t in workers + [reporter]:
+                t.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+            log.info("comments queue | %s", self.metrics())
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._q.get()
+            try:
+                retry_at = self._retry_at.pop(job.src_post_id, None)
+                if retry_at is not None:
+                    # пауза перед повтором прерывается, когда разовый запуск заканчивается
+                    try:
+                        await asyncio.wait_for(self._draining.wait(), max(0.0, retry_at - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        pass
+                    if self._draining.is_set():
+                        continue  # задание осталось в файле
+                ok = await self.comment_copier.copy_comments_for_post(
+                    self.src, self.dest,
+                    src_post_id=job.src_post_id,
+                    dest_post_id=job.dest_post_id,
+                )
+                if ok:
+                    self.queue.done(job)
+                    self.done_jobs += 1
+                else:
+                    self._retry(job)
+                self._export()
+            finally:
+                self._q.task_done()
+
+    def _retry(self, job: CommentJob) -> None:
+        self.queue.failed(job)
+        if job.attempts >= MAX_ATTEMPTS:
+            log.warning("comments queue | post %s dropped after %s failed attempts", job.src_post_id, job.attempts)
+            self.queue.done(job)
+            self.failed_jobs += 1
+            return
+        if self._draining.is_set():
+            return  # разовый запуск не ждёт паузы перед повтором: задание остаётся в файле
+        # обратно в очередь до task_done, чтобы run() дождался и повтора
+        self._retry_at[job.src_post_id] = time.monotonic() + RETRY_DELAY * job.attempts
+        self._q.put_nowait(job)
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(self.report_every)
+            self._export()
+            log.info("comments queue | %s", self.metrics())
@@ -1,34 +1,32 @@
 from __future__ import annotations
 
 import logging
-import os
 from pathlib import Path
 from typing import Optional, List
 
 from telethon import TelegramClient, utils
 from telethon.tl.types import MessageMediaWebPage
 
+from authors import AuthorCache, author_mention, utf16_len, with_author
+from media import MediaSender
+from metrics import UNITS_COPIED
+from pool import SessionPool
+from recompress import Recompressor
+from ratelimit import RateLimiter, paced_history
 from retry import safe_call, RetryPolicy
+from state import StateStore
+from upload_cache import UploadCache
 
 log = logging.getLogger("tg_sync.comments")
 
+# лимит подписи к медиа без Premium
+CAPTION_LIMIT = 1024
+
 
 def _is_real_media(msg) -> bool:
     return bool(msg.media) and not isinstance(msg.media, MessageMediaWebPage)
 
 
-def _author_label(sender) -> str:
-    if sender is None:
-        return "unknown"
-    username = getattr(sender, "username", None)
-    if username:
-        return f"@{username}"
-    fn = (getattr(sender, "first_name", "") or "").strip()
-    ln = (getattr(sender, "last_name", "") or "").strip()
-    name = (fn + (" " + ln if ln else "")).strip()
-    return name or str(getattr(sender, "id", "unknown"))
-
-
 class CommentCopier:
     """
     Копирует комментарии (reply_to=src_post_id) в виде комментариев (comment_to=dest_post_id).
@@ -43,38 +41,108 @@ class CommentCopier:
         cleanup: bool,
         limit: int | None = None,
         include_author: bool = True,
+        author_style: str = "message",
         force_document: bool = False,
         link_preview: bool = True,
+        transfer_mode: str = "disk",
+        stream_small: int = 10 * 1024 * 1024,
+        stream_buffer: int = 16 * 1024 * 1024,
+        album_concurrency: int = 4,
+        parallel_min: int = 0,
+        download_parts: int = 4,
+        parallel_upload_min: int = 0,
+        upload_parts: int = 4,
+        state: StateStore | None = None,
+        upload_cache: UploadCache | None = None,
+        authors: AuthorCache | None = None,
+        limiter: RateLimiter | None = None,
+        job: str = "",
+        journal=None,
+        readers: SessionPool | None = None,
+        source_client=None,
+        source_policy: RetryPolicy | None = None,
+        recompressor: Recompressor | None = None,
     ):
         self.client = client
+        # откуда читать треды без пула (archive.ArchiveReader при replay), по умолчанию client
+        self.source_client = source_client or client
         self.tmp_dir = tmp_dir
         self.cleanup = cleanup
         self.limit = limit
         self.include_author = include_author
+        self.job = job  # имя пары для метрик
+        # "message" — подпись автора отдельным сообщением, "inline" — в тексте самого комментария
+        self.author_style = author_style
         self.force_document = force_document
         self.link_preview = link_preview
-        self.policy = RetryPolicy()
-
-    async def _send_author(self, dest_entity, dest_post_id: int, sender, ctx: str):
+        self.policy = RetryPolicy(limiter=limiter)
+        # PostPriority (см. comment_queue): перед каждым комментарием ждём, пока опубликуются посты
+        self.priority = None
+        # куда записывать карту src comment id -> dest comment id
+        self.state = state
+        # journal.Journal: намерение до отправки комментария, id назначения после
+        self.journal = journal
+        # pool.SessionPool для чтения тредов; SourceSync выставляет его только для защищённых источников
+        self.history: SessionPool | None = None
+        # подписи авторов; общий кэш на процесс, если передали
+        self.authors = authors or AuthorCache()
+        self.media = MediaSender(client, tmp_dir=tmp_dir, cleanup=cleanup, force_document=force_document,
+                                 policy=self.policy, transfer_mode=transfer_mode,
+                                 stream_small=stream_small, stream_buffer=stream_buffer,
+                                 item_concurrency=album_concurrency, upload_cache=upload_cache,
+                                 parallel_min=parallel_min, download_parts=download_parts,
+                                 parallel_upload_min=parallel_upload_min, upload_parts=upload_parts,
+                                 readers=readers, source_client=source_client, source_policy=source_policy,
+                                 recompressor=recompressor)
+
+    async def _send_author(self, dest_entity, dest_post_id: int, msg, ctx: str):
         if not self.include_author:
             return
-        label = _author_label(sender)
-        await safe_call(
+        if self.journal is not None and self.journal.sent_label(self.job, "comment", msg.id):
+            # подпись ушла до падения (или в прошлой попытке), а сам комментарий нет — второй раз не шлём
+            log.debug("%s: author label already sent", ctx)
+            return
+        text = f"{await self.authors.label(msg)}:"
+        if self.journal is not None:
+            self.journal.label(self.job, "comment", msg.id, text)
+        sent = await safe_call(
             lambda: self.client.send_message(
                 dest_entity,
-                f"{label}:",
+                text,
                 comment_to=dest_post_id,
             ),
             ctx=f"{ctx} send_author",
             policy=self.policy,
+            kind="send_message",
         )
+        if self.journal is not None:
+            self.journal.label(self.job, "comment", msg.id, text, sent.id)
 
-    async def _send_text_as_comment(self, dest_entity, dest_post_id: int, text: str, entities, ctx: str):
+    async def _attribute(self, dest_entity, dest_post_id: int, msg, text: str, entities, ctx: str,
+                         limit: int | None = None) -> tuple[str, list]:
+        """
+        Подпись автора перед комментарием; возвращает текст/сущности для отправки.
+        В inline-стиле подпись — жирный префикс самого текста (на один send меньше),
+        у автора без username — со ссылкой на него; если с ним текст не влезает в limit, подпись уходит отдельным сообщением, как в "message".
+        """
+        if self.include_author and self.author_style == "inline":
+            label = await self.authors.label(msg)
+            # access_hash автора действителен только для аккаунта, который прочитал сообщение
+            user = author_mention(msg) if getattr(msg, "_client", None) is self.client else None
+            prefixed = with_author(label, text, entities, user=user)
+            if limit is None or utf16_len(prefixed[0]) <= limit:
+                return prefixed
+            log.debug("%s: caption too long for inline author, separate message", ctx)
+        await self._send_author(dest_entity, dest_post_id, msg, ctx=ctx)
+        return text, entities or []
+
+    async def _send_text_as_comment(self, dest_entity, dest_post_id: int, text: str, entities, ctx: str) -> int:
         if not text:
-            return
+            return 0
+        last_sent_id = 0
         # режем длинный текст корректно
         for chunk, ents in utils.split_text(text, entities or []):
-            await safe_call(
+            sent = await safe_call(
                 lambda chunk=chunk, ents=ents: self.client.send_message(
                     dest_entity,
                     chunk,
@@ -84,25 +152,27 @@ class CommentCopier:
                 ),
                 ctx=f"{ctx} send_text_chunk",
                 policy=self.policy,
+                kind="send_message",
             )
-
-    async def _send_media_path_as_comment(self, dest_entity, dest_post_id: int, path: str, caption: str, entities, ctx: str):
-        await safe_call(
-            lambda: self.client.send_file(
-                dest_entity,
-                path,
-                caption=caption,
-                formatting_entities=entities or [],
-                force_document=self.force_document,
-                comment_to=dest_post_id,
-            ),
-            ctx=f"{ctx} send_file",
-            policy=self.policy,
+            last_sent_id = sent.id
+        return last_sent_id
+
+    async def _send_media_as_comment(self, dest_entity, dest_post_id: int, msgs: List, caption: str, entities,
+                                     ctx: str) -> dict[int, int]:
+        sent = await self.media.send(
+            dest_entity,
+            msgs,
+            ctx=ctx,
+            caption=caption,
+            formatting_entities=entities or [],
+            comment_to=dest_post_id,
         )
+        sent_list = sent if isinstance(sent, list) else [sent]
+        return dict(zip((m.id for m in msgs), (x.id for x in sent_list)))
 
-    async def _send_sticker_as_comment(self, dest_entity, dest_post_id: int, sticker, ctx: str):
+    async def _send_sticker_as_comment(self, dest_entity, dest_post_id: int, sticker, ctx: str) -> int:
         # ВАЖНО: sticker отправляем handle-ом, чтобы остался стикером (а не картинкой после скачивания)
-        await safe_call(
+        sent = await safe_call(
             lambda: self.client.send_file(
                 dest_entity,
                 sticker,
@@ -110,113 +180,111 @@ class CommentCopier:
             ),
             ctx=f"{ctx} send_sticker",
             policy=self.policy,
+            kind="send_file",
         )
+        return sent.id
 
-    async def _copy_one_comment(self, src_entity, dest_entity, *, c, dest_post_id: int):
+    async def copy_unit(self, src_entity, dest_entity, *, src_post_id: int, dest_post_id: int, unit: List) -> None:
+        """Один юнит треда — комментарий или альбом — с записью в журнал и state."""
+        base_ctx = f"src_post_id={src_post_id} -> dest_post_id={dest_post_id}"
+        gid = getattr(unit[0], "grouped_id", None)
+        self._begin(dest_entity, src_post_id, dest_post_id, unit)
+        if gid is not None:
+            id_map = await self._copy_album(dest_entity, dest_post_id, unit, ctx=f"{base_ctx} album_gid={gid}")
+        else:
+            id_map = await self._copy_one_comment(src_entity, dest_entity, c=unit[0], dest_post_id=dest_post_id)
+        self._record(src_post_id, id_map, unit)
+
+    def skip_unit(self, src_post_id: int, unit: List) -> None:
+        """Юнит, который не удалось скопировать и повторять не стоит: закрываем запись журнала и двигаем watermark."""
+        self._record(src_post_id, {}, unit)
+
+    def _begin(self, dest_entity, src_post_id: int, dest_post_id: int, unit: List) -> None:
+        if self.journal is not None:
+            self.journal.begin(self.job, "comment", unit, dest=dest_entity, thread=src_post_id,
+                               dest_thread=dest_post_id)
+
+    def _record(self, src_post_id: int, id_map: dict[int, int], unit: List) -> None:
+        if self.journal is not None:
+            self.journal.commit(self.job, "comment", unit[0].id, id_map, thread=src_post_id)
+        # юниты идут по возрастанию id, поэтому watermark треда — просто max id обработанного юнита
+        if id_map:
+            UNITS_COPIED.inc(job=self.job, kind="comment")
+        if self.state is not None:
+            self.state.record_ids("comment", id_map)
+            self.state.update_comment_watermark(src_post_id, max(m.id for m in unit))
+
+    async def _wait_turn(self):
+        if self.priority is not None:
+            await self.priority.wait_idle()
+
+    async def _copy_one_comment(self, src_entity, dest_entity, *, c, dest_post_id: int) -> dict[int, int]:
+        """Возвращает карту src comment id -> dest comment id (пустую, если комментарий пропущен)."""
         ctx = f"c_id={c.id}"
-
-        sender = None
-        try:
-            sender = await c.get_sender()
-        except Exception:
-            pass
+        await self._wait_turn()
 
         # 1) Стикер
         if getattr(c, "sticker", None):
             log.debug("%s type=sticker", ctx)
-            await self._send_author(dest_entity, dest_post_id, sender, ctx=ctx)
-            await self._send_sticker_as_comment(dest_entity, dest_post_id, c.sticker, ctx=ctx)
-            return
+            # у стикера нет подписи — автор всегда отдельным сообщением, в любом стиле
+            await self._send_author(dest_entity, dest_post_id, c, ctx=ctx)
+            return {c.id: await self._send_sticker_as_comment(dest_entity, dest_post_id, c.sticker, ctx=ctx)}
 
         # 2) Медиа (фото/видео/голосовое/файл и т.п.)
         if _is_real_media(c):
             log.debug("%s type=media", ctx)
-            await self._send_author(dest_entity, dest_post_id, sender, ctx=ctx)
-
-            self.tmp_dir.mkdir(parents=True, exist_ok=True)
-            path = await safe_call(
-                lambda: c.download_media(file=str(self.tmp_dir)),
-                ctx=f"{ctx} download_media",
-                policy=self.policy,
+            caption, entities = await self._attribute(
+                dest_entity, dest_post_id, c, c.message or "", c.entities, ctx=ctx, limit=CAPTION_LIMIT
             )
 
-            caption = c.message or ""
-            entities = c.entities or []
-
-            try:
-                await self._send_media_path_as_comment(
-                    dest_entity, dest_post_id, path, caption, entities, ctx=ctx
-                )
-            finally:
-                if self.cleanup and path and os.path.isfile(path):
-                    try:
-                        os.remove(path)
-                    except OSError:
-                        pass
-            return
+            return await self._send_media_as_comment(
+                dest_entity, dest_post_id, [c], caption, entities, ctx=ctx
+            )
 
         # 3) Текстовый комментарий
         text = (c.message or "").strip()
         if text:
             log.debug("%s type=text", ctx)
-            await self._send_author(dest_entity, dest_post_id, sender, ctx=ctx)
-            await self._send_text_as_comment(dest_entity, dest_post_id, c.message or "", c.entities, ctx=ctx)
-            return
+            text, entities = await self._attribute(dest_entity, dest_post_id, c, c.message or "", c.entities, ctx=ctx)
+            return {c.id: await self._send_text_as_comment(dest_entity, dest_post_id, text, entities, ctx=ctx)}
 
         # 4) Неподдерживаемое/пустое (например, сервисные/вебпревью без текста)
         log.debug("%s skipped (no text/media/sticker)", ctx)
+        return {}
 
-    async def _copy_album(self, dest_entity, dest_post_id: int, album_msgs: List, sender, ctx: str):
+    async def _copy_album(self, dest_entity, dest_post_id: int, album_msgs: List, ctx: str) -> dict[int, int]:
+        await self._wait_turn()
         # Стикер-альбомы в комментариях встречаются редко; считаем альбом именно медиа-альбомом
-        self.tmp_dir.mkdir(parents=True, exist_ok=True)
-
-        files = []
-        for m in album_msgs:
-            if _is_real_media(m):
-                p = await safe_call(
-                    lambda m=m: m.download_media(file=str(self.tmp_dir)),
-                    ctx=f"{ctx} download_album_item id={m.id}",
-                    policy=self.policy,
-                )
-                files.append(p)
+        media_msgs = [m for m in album_msgs if _is_real_media(m)]
 
         cap_msg = next((m for m in album_msgs if (m.message or "").strip()), None)
         caption = (cap_msg.message if cap_msg else "") or ""
         ents = (cap_msg.entities if cap_msg else None) or []
 
-        await self._send_author(dest_entity, dest_post_id, sender, ctx=ctx)
+        if not media_msgs and not cap_msg:
+            return {}
+        caption, ents = await self._attribute(
+            dest_entity, dest_post_id, album_msgs[0], caption, ents, ctx=ctx,
+            limit=CAPTION_LIMIT if media_msgs else None,
+        )
+        if not media_msgs:
+            return {cap_msg.id: await self._send_text_as_comment(dest_entity, dest_post_id, caption, ents, ctx=ctx)}
+        return await self._send_media_as_comment(
+            dest_entity, dest_post_id, media_msgs, caption, ents, ctx=f"{ctx} album files={len(media_msgs)}"
+        )
 
-        try:
-            await safe_call(
-                lambda: self.client.send_file(
-                    dest_entity,
-                    files,
-                    caption=caption,
-                    formatting_entities=ents,
-                    force_document=self.force_document,
-                    comment_to=dest_post_id,
-                ),
-                ctx=f"{ctx} send_album files={len(files)}",
-                policy=self.policy,
-            )
-        finally:
-            if self.cleanup:
-                for p in files:
-                    if p and os.path.isfile(p):
-                        try:
-                            os.remove(p)
-                        except OSError:
-                            pass
-
-    async def copy_comments_for_post(self, src_entity, dest_entity, *, src_post_id: int, dest_post_id: int) -> None:
+    async def copy_comments_for_post(self, src_entity, dest_entity, *, src_post_id: int, dest_post_id: int) -> bool:
         """
         src_entity — entity канала-источника (broadcast)
         dest_entity — entity твоего канала (broadcast)
         src_post_id — id поста в источнике
         dest_post_id — id поста в твоём канале, под которым пишем комменты
+        Возвращает False, если тред скопирован не до конца (повторить позже — продолжит с watermark треда).
         """
         base_ctx = f"src_post_id={src_post_id} -> dest_post_id={dest_post_id}"
-        log.info("start comments | %s | limit=%s", base_ctx, self.limit)
+        # инкрементально: только комментарии новее watermark треда
+        min_id = self.state.comment_watermark(src_post_id) if self.state is not None else 0
+        log.info("start comments | %s | limit=%s min_id=%s", base_ctx, self.limit, min_id)
 
         copied = 0
         scanned = 0
@@ -225,8 +293,19 @@ class CommentCopier:
         current_gid: Optional[int] = None
         album: List = []
         try:
-            async for c in self.client.iter_messages(src_entity, reply_to=src_post_id, limit=self.limit, reverse=True):
+            if self.history is not None:
+                history = self.history.iter_history(src_entity, reply_to=src_post_id, min_id=min_id,
+                                                    limit=self.limit)
+            else:
+                history = paced_history(self.source_client.iter_messages(src_entity, reply_to=src_post_id,
+                                                                         min_id=min_id, limit=self.limit,
+                                                                         reverse=True),
+                                        self.policy.limiter)
+            async for c in history:
                 scanned += 1
+                if self.include_author:
+                    # отправители уже пришли вместе со страницей истории — запоминаем без запросов
+                    self.authors.prime([c])
                 gid = getattr(c, "grouped_id", None)
 
                 if gid is not None:
@@ -237,13 +316,8 @@ class CommentCopier:
                         album.append(c)
                     else:
                         # закрываем предыдущий альбом
-                        sender = None
-                        try:
-                            sender = await album[0].get_sender()
-                        except Exception:
-                            pass
-                        ctx = f"{base_ctx} album_gid={current_gid}"
-                        await self._copy_album(dest_entity, dest_post_id, album, sender, ctx=ctx)
+                        await self.copy_unit(src_entity, dest_entity, src_post_id=src_post_id,
+                                             dest_post_id=dest_post_id, unit=album)
                         copied += 1
 
                         current_gid = gid
@@ -252,33 +326,27 @@ class CommentCopier:
 
                 # если перед одиночным был альбом — закрыть
                 if current_gid is not None and album:
-                    sender = None
-                    try:
-                        sender = await album[0].get_sender()
-                    except Exception:
-                        pass
-                    ctx = f"{base_ctx} album_gid={current_gid}"
-                    await self._copy_album(dest_entity, dest_post_id, album, sender, ctx=ctx)
+                    await self.copy_unit(src_entity, dest_entity, src_post_id=src_post_id,
+                                         dest_post_id=dest_post_id, unit=album)
                     copied += 1
                     current_gid = None
                     album = []
 
                 # одиночный комментарий
-                await self._copy_one_comment(src_entity, dest_entity, c=c, dest_post_id=dest_post_id)
+                await self.copy_unit(src_entity, dest_entity, src_post_id=src_post_id,
+                                     dest_post_id=dest_post_id, unit=[c])
                 copied += 1
 
             # финальный альбом
             if current_gid is not None and album:
-                sender = None
-                try:
-                    sender = await album[0].get_sender()
-                except Exception:
-                    pass
-                ctx = f"{base_ctx} album_gid={current_gid}"
-                await self._copy_album(dest_entity, dest_post_id, album, sender, ctx=ctx)
+                await self.copy_unit(src_entity, dest_entity, src_post_id=src_post_id,
+                                     dest_post_id=dest_post_id, unit=album)
                 copied += 1
 
             log.info("done comments | %s | scanned=%s copied=%s", base_ctx, scanned, copied)
+            return True
 
         except Exception as ex:
-            log.warning(f"something wrong: {ex}")
+            log.warning("comments stopped | %s | scanned=%s copied=%s | %s: %s", base_ctx, scanned, copied,
+                        type(ex).__name__, ex)
+            return False
@@ -4,19 +4,46 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv, find_dotenv
 
+from ratelimit import DEFAULT_RATES
+
 
 def _env_bool(name: str, default: str = "0") -> bool:
     return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "y")
 
 
+def _env_choice(name: str, default: str, choices: tuple[str, ...]) -> str:
+    value = os.getenv(name, default).strip().lower() or default
+    if value not in choices:
+        raise RuntimeError(f"{name}={value!r}: ожидается одно из {', '.join(choices)}")
+    return value
+
+
+def _env_rates(name: str) -> dict[str, float]:
+    """'send_message=0.5,download=10' -> {'send_message': 0.5, 'download': 10.0}"""
+    rates: dict[str, float] = {}
+    for item in os.getenv(name, "").split(","):
+        kind, sep, value = item.strip().partition("=")
+        if not kind:
+            continue
+        if not sep or kind.strip() not in DEFAULT_RATES:
+            raise RuntimeError(f"{name}: {item.strip()!r}: ожидается <класс>=<вызовов в секунду>, классы: {', '.join(DEFAULT_RATES)}")
+        rates[kind.strip()] = float(value)
+    return rates
+
+
 @dataclass(frozen=True)
 class Config:
     api_id: int
     api_hash: str
     session: str
+    sessions_file: Path | None  # JSON с дополнительными аккаунтами (см. pool.py); None — один аккаунт
 
     source: str
     dest: str
+    job_name: str  # ключ состояния пары; по умолчанию = source
+
+    jobs_file: Path | None  # JSON со многими парами source -> dest (см. jobs.py)
+    jobs_concurrency: int   # сколько публикаций разных пар идут одновременно
 
     last_seen_id: int
     overlap: int
@@ -26,14 +53,64 @@ class Config:
     cleanup: bool
     link_preview: bool
     force_document: bool
+    copy_mode: str  # "reupload" | "forward"
+    transfer_mode: str  # "disk" | "memory"
+    stream_small: int   # байт; файлы меньше качаются целиком в память
+    stream_buffer: int  # байт; предел буфера при потоковой перекачке
+    album_concurrency: int  # сколько элементов альбома качать одновременно
+    parallel_download_min: int  # байт; файлы от этого размера качаются частями параллельно (0 — выключено)
+    download_parts: int  # сколько частей одного файла качать одновременно
+    parallel_upload_min: int  # байт; файлы от этого размера загружаются частями параллельно (0 — выключено)
+    upload_parts: int  # сколько частей одного файла загружать одновременно
+
+    recompress: bool  # пересжимать картинки и короткие видео перед загрузкой (см. recompress.py)
+    recompress_min: int  # байт; файлы меньше не пересжимаются
+    recompress_quality: int  # JPEG quality
+    recompress_max_side: int  # пикселей; картинки и видео крупнее уменьшаются (0 — разрешение не меняем)
+    recompress_strip_metadata: bool
+    recompress_video_max: int  # байт; видео до этого размера перекодируются ffmpeg (0 — видео не трогаем)
+    recompress_video_crf: int
+    recompress_workers: int  # процессов в пуле пересжатия
+
+    workers: int      # prefetch-воркеров в конвейере
+    queue_depth: int  # сколько юнитов одновременно в работе (скачаны, но не опубликованы)
 
     sync_comments: bool
     comments_limit: int | None
     comments_include_author: bool
+    comments_author_style: str  # "message" | "inline"
+    comments_workers: int
+    comments_recheck: int  # сколько последних постов перепроверять на новые комментарии
+    comments_queue_file: Path
+    comments_mode: str  # "threads" — тред каждого поста отдельно | "group" — один проход по discussion-группе
+
+    edits_recheck: int  # сколько последних сообщений источника проверять на правки (0 — не проверять)
+
+    daemon: bool
+    daemon_catchup_sec: float
+    daemon_debounce_sec: float
 
     log_level: str
     log_file: str | None
 
+    state_backend: str  # "env" | "sqlite"
+    state_db: Path
+    journal: Path | None  # журнал публикаций (write-ahead); None — выключен
+
+    upload_cache: Path | None  # None = кэш загруженных файлов выключен
+    upload_cache_max: int      # записей, дальше вытесняются давно не использованные
+    upload_cache_ttl: float    # секунд жизни записи
+
+    author_cache: Path | None  # где хранить подписи авторов комментариев между запусками; None — только в памяти
+
+    archive_mode: str  # "off" | "export" (источник -> локальный архив) | "replay" (архив -> назначение)
+    archive_dir: Path  # у каждого источника свой подкаталог (см. archive.py)
+
+    rate_limits: dict[str, float]  # переопределения ratelimit.DEFAULT_RATES, вызовов в секунду (0 — без лимита)
+
+    metrics_host: str
+    metrics_port: int  # 0 = HTTP-эндпоинт метрик выключен
+
     dotenv_path: Path
 
     @staticmethod
@@ -43,6 +120,21 @@ class Config:
             raise RuntimeError("Не найден .env (положи .env рядом с проектом/скриптом).")
 
         load_dotenv(dotenv_path, override=True)
+        return Config.from_env(Path(dotenv_path))
+
+    @staticmethod
+    def from_env(dotenv_path: Path) -> "Config":
+        """Config из уже загруженного окружения (bench.py задаёт переменные сам, без .env)."""
+        raw_jobs_file = os.getenv("TG_JOBS_FILE", "").strip()
+        jobs_file = Path(raw_jobs_file) if raw_jobs_file else None
+        # в режиме файла заданий пары берутся из него, TG_SOURCE/TG_DEST не обязательны
+        source = os.getenv("TG_SOURCE", "") if jobs_file else os.environ["TG_SOURCE"]
+        dest = os.getenv("TG_DEST", "") if jobs_file else os.environ["TG_DEST"]
+
+        raw_upload_cache = os.getenv("TG_UPLOAD_CACHE", "upload_cache.sqlite3").strip()
+        raw_author_cache = os.getenv("TG_AUTHOR_CACHE", "").strip()
+        raw_journal = os.getenv("TG_JOURNAL", "tg_sync.journal.sqlite3").strip()
+        raw_sessions_file = os.getenv("TG_SESSIONS_FILE", "").strip()
 
         raw_limit = os.getenv("TG_LIMIT", "0").strip()
         lim = int(raw_limit)
@@ -55,26 +147,80 @@ class Config:
         return Config(
             api_id=int(os.environ["TG_API_ID"]),
             api_hash=os.environ["TG_API_HASH"],
-            session=os.environ["TG_SESSION"],
+            session=os.getenv("TG_SESSION", "") if raw_sessions_file else os.environ["TG_SESSION"],
+            sessions_file=Path(raw_sessions_file) if raw_sessions_file else None,
+
+            source=source,
+            dest=dest,
+            job_name=source,
 
-            source=os.environ["TG_SOURCE"],
-            dest=os.environ["TG_DEST"],
+            jobs_file=jobs_file,
+            jobs_concurrency=int(os.getenv("TG_JOBS_CONCURRENCY", "2")),
 
             last_seen_id=int(os.getenv("TG_LAST_SEEN_ID", "0")),
-            overlap=int(os.getenv("TG_OVERLAP", "50")),
+            overlap=int(os.getenv("TG_OVERLAP", "0")),
             limit=limit,
 
             tmp_dir=Path(os.getenv("TG_TMP_DIR", "tmp_media")),
             cleanup=_env_bool("TG_CLEANUP", "1"),
             link_preview=_env_bool("TG_LINK_PREVIEW", "1"),
             force_document=_env_bool("TG_FORCE_DOCUMENT", "0"),
+            copy_mode=_env_choice("TG_COPY_MODE", "reupload", ("reupload", "forward")),
+            transfer_mode=_env_choice("TG_TRANSFER_MODE", "disk", ("disk", "memory")),
+            stream_small=int(os.getenv("TG_STREAM_SMALL_MB", "10")) * 1024 * 1024,
+            stream_buffer=int(os.getenv("TG_STREAM_BUFFER_MB", "16")) * 1024 * 1024,
+            album_concurrency=int(os.getenv("TG_ALBUM_CONCURRENCY", "4")),
+            parallel_download_min=int(os.getenv("TG_PARALLEL_DOWNLOAD_MB", "20")) * 1024 * 1024,
+            download_parts=int(os.getenv("TG_DOWNLOAD_PARTS", "4")),
+            parallel_upload_min=int(os.getenv("TG_PARALLEL_UPLOAD_MB", "20")) * 1024 * 1024,
+            upload_parts=int(os.getenv("TG_UPLOAD_PARTS", "4")),
+
+            recompress=_env_bool("TG_RECOMPRESS", "0"),
+            recompress_min=int(os.getenv("TG_RECOMPRESS_MIN_KB", "256")) * 1024,
+            recompress_quality=int(os.getenv("TG_RECOMPRESS_QUALITY", "82")),
+            recompress_max_side=int(os.getenv("TG_RECOMPRESS_MAX_SIDE", "2560")),
+            recompress_strip_metadata=_env_bool("TG_RECOMPRESS_STRIP_METADATA", "1"),
+            recompress_video_max=int(os.getenv("TG_RECOMPRESS_VIDEO_MB", "0")) * 1024 * 1024,
+            recompress_video_crf=int(os.getenv("TG_RECOMPRESS_VIDEO_CRF", "28")),
+            recompress_workers=int(os.getenv("TG_RECOMPRESS_WORKERS", "2")),
+
+            workers=int(os.getenv("TG_WORKERS", "3")),
+            queue_depth=int(os.getenv("TG_QUEUE_DEPTH", "10")),
 
             sync_comments=_env_bool("TG_SYNC_COMMENTS", "0"),
             comments_limit=comments_limit,
             comments_include_author=_env_bool("TG_COMMENTS_INCLUDE_AUTHOR", "1"),
+            comments_author_style=_env_choice("TG_COMMENTS_AUTHOR_STYLE", "message", ("message", "inline")),
+            comments_workers=int(os.getenv("TG_COMMENTS_WORKERS", "1")),
+            comments_recheck=int(os.getenv("TG_COMMENTS_RECHECK", "20")),
+            comments_queue_file=Path(os.getenv("TG_COMMENTS_QUEUE_FILE", "comments_queue.json")),
+            comments_mode=_env_choice("TG_COMMENTS_MODE", "threads", ("threads", "group")),
+            edits_recheck=int(os.getenv("TG_EDITS_RECHECK", "0")),
+
+            daemon=_env_bool("TG_DAEMON", "0"),
+            daemon_catchup_sec=float(os.getenv("TG_DAEMON_CATCHUP_SEC", "300")),
+            daemon_debounce_sec=float(os.getenv("TG_DAEMON_DEBOUNCE_SEC", "2")),
 
             log_level=os.getenv("LOG_LEVEL", "INFO"),
             log_file=os.getenv("LOG_FILE", "").strip() or None,
 
-            dotenv_path=Path(dotenv_path),
+            state_backend=_env_choice("TG_STATE_BACKEND", "env", ("env", "sqlite")),
+            state_db=Path(os.getenv("TG_STATE_DB", "tg_sync.sqlite3")),
+            journal=Path(raw_journal) if raw_journal else None,
+
+            upload_cache=Path(raw_upload_cache) if raw_upload_cache else None,
+            upload_cache_max=int(os.getenv("TG_UPLOAD_CACHE_MAX", "10000")),
+            upload_cache_ttl=float(os.getenv("TG_UPLOAD_CACHE_TTL_H", "72")) * 3600,
+
+            author_cache=Path(raw_author_cache) if raw_author_cache else None,
+
+            archive_mode=_env_choice("TG_ARCHIVE_MODE", "off", ("off", "export", "replay")),
+            archive_dir=Path(os.getenv("TG_ARCHIVE_DIR", "archive")),
+
+            rate_limits=_env_rates("TG_RATE_LIMITS"),
+
+            metrics_host=os.getenv("TG_METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1",
+            metrics_port=int(os.getenv("TG_METRICS_PORT", "0")),
+
+            dotenv_path=dotenv_path,
         )
@@ -0,0 +1,3 @@
+# Тесты в tests/ импортируют модули из корня репозитория (плоская раскладка, без пакета).
+# comment_test.py — ручная проверка на живом аккаунте (нужен .env с сессией), не тест.
+collect_ignore = ["comment_test.py"]
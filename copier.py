@@ -1,37 +1,79 @@
 from __future__ import annotations
 import logging
-import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
-from telethon import TelegramClient, utils
+from telethon import TelegramClient, errors, utils
 from telethon.tl.types import MessageMediaWebPage
 
+from media import MediaSender, PreparedMedia
+from pool import SessionPool
+from recompress import Recompressor
+from ratelimit import RateLimiter
 from retry import safe_call, RetryPolicy
+from upload_cache import UploadCache
 
 log = logging.getLogger("tg_sync.copier")
 
+# лимит Telegram на количество id в одном messages.forwardMessages
+FORWARD_BATCH = 100
+
 
 def is_real_media(msg) -> bool:
     return bool(msg.media) and not isinstance(msg.media, MessageMediaWebPage)
 
 
+def replies_max_id(unit) -> int:
+    """replies.max_id поста — id последнего комментария в discussion-группе; 0 — комментариев нет."""
+    best = 0
+    for m in unit:
+        r = getattr(m, "replies", None)
+        if r is not None and r.replies:
+            best = max(best, r.max_id or 0)
+    return best
+
+
+def is_copyable(msg) -> bool:
+    # сервисные/пустые сообщения не копируем ни одним из способов
+    return is_real_media(msg) or bool((msg.message or "").strip())
+
+
 @dataclass
 class CopyResult:
     dest_root_post_id: int  # id поста в DEST, к которому можно комментить
     kind: str               # "single" | "album"
     src_max_id: int         # для обновления last_seen
     src_root_post_id: int
+    id_map: dict[int, int] = field(default_factory=dict)  # src_id -> dest_id
+    comments_max_id: int = 0  # см. replies_max_id; 0 — комментарии можно не запрашивать
 
 
 class PostCopier:
-    def __init__(self, client: TelegramClient, tmp_dir: Path, cleanup: bool, link_preview: bool, force_document: bool):
+    def __init__(self, client: TelegramClient, tmp_dir: Path, cleanup: bool, link_preview: bool, force_document: bool,
+                 copy_mode: str = "reupload", transfer_mode: str = "disk",
+                 stream_small: int = 10 * 1024 * 1024, stream_buffer: int = 16 * 1024 * 1024,
+                 album_concurrency: int = 4, upload_cache: UploadCache | None = None,
+                 limiter: RateLimiter | None = None, parallel_min: int = 0, download_parts: int = 4,
+                 parallel_upload_min: int = 0, upload_parts: int = 4, readers: SessionPool | None = None,
+                 source_client=None, source_policy: RetryPolicy | None = None,
+                 recompressor: Recompressor | None = None):
         self.client = client
         self.tmp_dir = tmp_dir
         self.cleanup = cleanup
         self.link_preview = link_preview
         self.force_document = force_document
-        self.policy = RetryPolicy()
+        self.copy_mode = copy_mode
+        self.policy = RetryPolicy(limiter=limiter)
+        self.media = MediaSender(client, tmp_dir=tmp_dir, cleanup=cleanup, force_document=force_document,
+                                 policy=self.policy, transfer_mode=transfer_mode,
+                                 stream_small=stream_small, stream_buffer=stream_buffer,
+                                 item_concurrency=album_concurrency, upload_cache=upload_cache,
+                                 parallel_min=parallel_min, download_parts=download_parts,
+                                 parallel_upload_min=parallel_upload_min, upload_parts=upload_parts,
+                                 readers=readers, source_client=source_client, source_policy=source_policy,
+                                 recompressor=recompressor)
+        # выставляется, если источник запрещает пересылку (protected content)
+        self.forward_blocked = False
 
     async def _send_text(self, dest, text: str, entities, ctx: str) -> int:
         if not text:
@@ -48,38 +90,36 @@ class PostCopier:
                 ),
                 ctx=f"{ctx} send_text",
                 policy=self.policy,
+                kind="send_message",
             )
             last_sent_id = sent.id
         return last_sent_id
 
-    async def copy_single(self, dest, msg) -> CopyResult | None:
+    async def prepare_unit(self, unit) -> PreparedMedia | None:
+        """Prefetch медиа юнита до публикации (см. pipeline); None — если медиа нет."""
+        media_msgs = [m for m in unit if is_real_media(m)]
+        if not media_msgs:
+            return None
+        return await self.media.prepare(media_msgs, ctx=f"prepare src_ids={media_msgs[0].id}..{media_msgs[-1].id}")
+
+    def release(self, prepared: PreparedMedia | None) -> None:
+        self.media.release(prepared)
+
+    async def copy_single(self, dest, msg, prepared: PreparedMedia | None = None) -> CopyResult | None:
         ctx = f"copy_single src_id={msg.id}"
         if is_real_media(msg):
-            self.tmp_dir.mkdir(parents=True, exist_ok=True)
-            path = await safe_call(lambda: msg.download_media(file=str(self.tmp_dir)), ctx=f"{ctx} download", policy=self.policy)
-
-            try:
-                sent = await safe_call(
-                    lambda: self.client.send_file(
-                        dest,
-                        path,
-                        caption=msg.message or "",
-                        formatting_entities=msg.entities or [],
-                        force_document=self.force_document,
-                    ),
-                    ctx=f"{ctx} send_file",
-                    policy=self.policy,
-                )
-                dest_id = sent.id if hasattr(sent, "id") else int(sent[0].id)
-                log.info("%s -> dest_id=%s (media)", ctx, dest_id)
-                return CopyResult(dest_root_post_id=dest_id, kind="single",
-                                  src_root_post_id=msg.id, src_max_id=msg.id)
-            finally:
-                if self.cleanup and path and os.path.isfile(path):
-                    try:
-                        os.remove(path)
-                    except OSError:
-                        pass
+            sent = await self.media.send(
+                dest,
+                [msg],
+                ctx=ctx,
+                prepared=prepared,
+                caption=msg.message or "",
+                formatting_entities=msg.entities or [],
+            )
+            dest_id = sent.id if hasattr(sent, "id") else int(sent[0].id)
+            log.info("%s -> dest_id=%s (media)", ctx, dest_id)
+            return CopyResult(dest_root_post_id=dest_id, kind="single",
+                              src_root_post_id=msg.id, src_max_id=msg.id, id_map={msg.id: dest_id})
         else:
             text = (msg.message or "").strip()
             if not text:
@@ -88,9 +128,9 @@ class PostCopier:
             dest_id = await self._send_text(dest, msg.message or "", msg.entities, ctx=ctx)
             log.info("%s -> dest_id=%s (text)", ctx, dest_id)
             return CopyResult(dest_root_post_id=dest_id, kind="single",
-                              src_root_post_id=msg.id, src_max_id=msg.id)
+                              src_root_post_id=msg.id, src_max_id=msg.id, id_map={msg.id: dest_id})
 
-    async def copy_album(self, dest, album_msgs) -> CopyResult | None:
+    async def copy_album(self, dest, album_msgs, prepared: PreparedMedia | None = None) -> CopyResult | None:
         gid = getattr(album_msgs[0], "grouped_id", None)
 
         src_max_id = max(m.id for m in album_msgs)
@@ -101,19 +141,9 @@ class PostCopier:
 
         ctx = f"copy_album gid={gid} src_root_post_id={src_root_post_id} src_max_id={src_max_id}"  # <-- лог полезнее
 
-        files: list[str] = []
-        self.tmp_dir.mkdir(parents=True, exist_ok=True)
-
-        for m in album_msgs:
-            if is_real_media(m):
-                p = await safe_call(
-                    lambda m=m: m.download_media(file=str(self.tmp_dir)),
-                    ctx=f"{ctx} download m={m.id}",
-                    policy=self.policy
-                )
-                files.append(p)
+        media_msgs = [m for m in album_msgs if is_real_media(m)]
 
-        if not files:
+        if not media_msgs:
             if not cap_msg:
                 log.debug("%s skipped: no files/text", ctx)
                 return None
@@ -125,44 +155,121 @@ class PostCopier:
                 dest_root_post_id=dest_id,
                 kind="album",
                 src_root_post_id=src_root_post_id,  # <-- добавь
-                src_max_id=src_max_id
+                src_max_id=src_max_id,
+                id_map={src_root_post_id: dest_id},
             )
 
         caption = (cap_msg.message if cap_msg else "") or ""
         ents = (cap_msg.entities if cap_msg else None) or []
 
+        sent = await self.media.send(
+            dest,
+            media_msgs,
+            ctx=f"{ctx} album files={len(media_msgs)}",
+            prepared=prepared,
+            caption=caption,
+            formatting_entities=ents,
+        )
+
+        sent_list = sent if isinstance(sent, list) else [sent]
+        dest_root = min(x.id for x in sent_list)
+
+        log.info("%s -> dest_root_id=%s", ctx, dest_root)
+
+        # send_file возвращает сообщения в порядке отправки, а media_msgs — в порядке альбома
+        id_map = dict(zip((m.id for m in media_msgs), (x.id for x in sent_list)))
+        id_map.setdefault(src_root_post_id, dest_root)
+
+        return CopyResult(
+            dest_root_post_id=dest_root,
+            kind="album",
+            src_root_post_id=src_root_post_id,  # <-- добавь
+            src_max_id=src_max_id,
+            id_map=id_map,
+        )
+
+    async def copy_unit(self, dest, unit, prepared: PreparedMedia | None = None) -> CopyResult | None:
+        """unit — одиночное сообщение [m] или альбом [m1, m2, ...] (см. scanner.iter_units)."""
+        if len(unit) == 1 and getattr(unit[0], "grouped_id", None) is None:
+            res = await self.copy_single(dest, unit[0], prepared=prepared)
+        else:
+            res = await self.copy_album(dest, unit, prepared=prepared)
+        if res is not None:
+            res.comments_max_id = replies_max_id(unit)
+        return res
+
+    async def forward_units(self, dest, src, units) -> list[CopyResult | None]:
+        """
+        Серверное копирование: messages.forwardMessages с drop_author,
+        пачками до FORWARD_BATCH id. Альбомы и форматирование сохраняет сам Telegram.
+        Если источник защищён от пересылки — откатываемся на copy_unit по одному юниту.
+        Результаты возвращаются в порядке units.
+        """
+        results: list[CopyResult | None] = []
+        batch: list = []
+        batch_size = 0
+
+        for unit in units:
+            n = sum(1 for m in unit if is_copyable(m))
+            if batch and batch_size + n > FORWARD_BATCH:
+                results.extend(await self._forward_batch(dest, src, batch))
+                batch, batch_size = [], 0
+            batch.append(unit)
+            batch_size += n
+
+        if batch:
+            results.extend(await self._forward_batch(dest, src, batch))
+        return results
+
+    async def _forward_batch(self, dest, src, units) -> list[CopyResult | None]:
+        if self.forward_blocked or getattr(src, "noforwards", False):
+            return [await self.copy_unit(dest, u) for u in units]
+
+        ids = [m.id for u in units for m in u if is_copyable(m)]
+        if not ids:
+            return [None] * len(units)
+
+        ctx = f"forward src_ids={ids[0]}..{ids[-1]} n={len(ids)}"
         try:
             sent = await safe_call(
-                lambda: self.client.send_file(
-                    dest,
-                    files,
-                    caption=caption,
-                    formatting_entities=ents,
-                    force_document=self.force_document,
-                ),
-                ctx=f"{ctx} send_album files={len(files)}",
+                lambda: self.client.forward_messages(dest, ids, src, drop_author=True),
+                ctx=ctx,
                 policy=self.policy,
+                kind="send_message",
             )
+        except errors.ChatForwardsRestrictedError:
+            log.warning("%s: source has protected content, falling back to download/re-upload", ctx)
+            self.forward_blocked = True
+            return [await self.copy_unit(dest, u) for u in units]
 
-            if isinstance(sent, list):
-                dest_root = min(x.id for x in sent)
-            else:
-                dest_root = sent.id
+        # ответ выровнен по ids; None — если конкретное сообщение не переслалось
+        sent_by_src = {i: s.id for i, s in zip(ids, sent) if s is not None}
+        log.info("%s -> forwarded=%s", ctx, len(sent_by_src))
 
-            log.info("%s -> dest_root_id=%s", ctx, dest_root)
+        results: list[CopyResult | None] = []
+        for u in units:
+            res = self._forward_result(u, sent_by_src)
+            if res is None and any(is_copyable(m) for m in u):
+                # не переслалось (например, отдельное сообщение с noforwards) — копируем как раньше
+                res = await self.copy_unit(dest, u)
+            results.append(res)
+        return results
 
-            return CopyResult(
-                dest_root_post_id=dest_root,
-                kind="album",
-                src_root_post_id=src_root_post_id,  # <-- добавь
-                src_max_id=src_max_id
-            )
-        finally:
-            if self.cleanup:
-                for p in files:
-                    if p and os.path.isfile(p):
-                        try:
-                            os.remove(p)
-                        except OSError:
-                            pass
+    @staticmethod
+    def _forward_result(unit, sent_by_src: dict[int, int]) -> CopyResult | None:
+        id_map = {m.id: sent_by_src[m.id] for m in unit if m.id in sent_by_src}
+        if not id_map:
+            return None
+
+        src_max_id = max(m.id for m in unit)
+        if len(unit) == 1 and getattr(unit[0], "grouped_id", None) is None:
+            return CopyResult(dest_root_post_id=id_map[unit[0].id], kind="single",
+                              src_root_post_id=unit[0].id, src_max_id=src_max_id, id_map=id_map,
+                              comments_max_id=replies_max_id(unit))
 
+        cap_msg = next((m for m in unit if (m.message or "").strip()), None)
+        src_root_post_id = cap_msg.id if cap_msg else min(m.id for m in unit)
+        dest_root = id_map.get(src_root_post_id, min(id_map.values()))
+        return CopyResult(dest_root_post_id=dest_root, kind="album",
+                          src_root_post_id=src_root_post_id, src_max_id=src_max_id, id_map=id_map,
+                          comments_max_id=replies_max_id(unit))
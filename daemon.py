@@ -0,0 +1,122 @@
+from __future__ import annotations
+import asyncio
+import logging
+
+from telethon import TelegramClient, events
+
+from discussion import linked_discussion, thread_top_id
+from retry import safe_call
+from sync import SourceSync
+
+log = logging.getLogger("tg_sync.daemon")
+
+
+async def _watch_reconnects(client: TelegramClient, wake: asyncio.Event, every: float = 5.0) -> None:
+    # Telethon переподключается сам; после обрыва делаем catch-up, чтобы не потерять посты
+    was_connected = client.is_connected()
+    while True:
+        await asyncio.sleep(every)
+        connected = client.is_connected()
+        if connected and not was_connected:
+            log.info("reconnected, scheduling catch-up")
+            wake.set()
+        was_connected = connected
+
+
+async def run_daemon(sync: SourceSync) -> None:
+    """
+    Постоянно подключённый режим: новые посты источника и комментарии в его discussion-группе
+    приходят событиями и будят catch-up от сохранённого watermark. Catch-up также выполняется
+    при старте, после переподключения и раз в daemon_catchup_sec на случай пропущенных событий.
+    """
+    cfg = sync.cfg
+    client = sync.client
+    wake = asyncio.Event()
+    handlers = []
+
+    async def on_post(event):
+        log.debug("event: new post id=%s", event.message.id)
+        sync.note_head(event.message.id)
+        wake.set()
+
+    handlers.append((on_post, events.NewMessage(chats=sync.src)))
+
+    if sync.edits is not None:
+        async def on_edit(event):
+            log.debug("event: edited post id=%s", event.message.id)
+            wake.set()
+
+        handlers.append((on_edit, events.MessageEdited(chats=sync.src)))
+
+    if not cfg.sync_comments:
+        discussion = None
+    elif sync.discussion is not None:
+        discussion = await sync.discussion.resolve()
+    else:
+        discussion = await linked_discussion(client, sync.src)
+    if discussion is not None:
+        top_to_post: dict[int, int] = {}
+
+        async def on_comment(event):
+            if sync.discussion is not None:
+                # TG_COMMENTS_MODE=group: тред определит проход по группе после catch-up
+                wake.set()
+                return
+            msg = event.message
+            if msg.fwd_from is not None and msg.fwd_from.channel_post:
+                return  # это сам пост, автоматически пересланный в группу
+            top = thread_top_id(msg)
+            if top is None:
+                return
+            if top not in top_to_post:
+                top_msg = await safe_call(lambda: client.get_messages(discussion, ids=top), ctx=f"resolve thread {top}",
+                                          policy=sync.comment_copier.policy, kind="get_history")
+                fwd = getattr(top_msg, "fwd_from", None)
+                if fwd is None or not fwd.channel_post:
+                    return
+                top_to_post[top] = fwd.channel_post
+            src_post_id = top_to_post[top]
+            dest_post_id = sync.state.thread_dest(src_post_id)
+            if dest_post_id:
+                log.debug("event: new comment id=%s post=%s", msg.id, src_post_id)
+                sync.comment_worker.submit(src_post_id, dest_post_id)
+
+        handlers.append((on_comment, events.NewMessage(chats=discussion)))
+
+    for cb, ev in handlers:
+        client.add_event_handler(cb, ev)
+
+    comments = asyncio.ensure_future(sync.comment_worker.run())
+    watcher = asyncio.ensure_future(_watch_reconnects(client, wake))
+    log.info("daemon started | discussion=%s catchup_every=%ss", getattr(discussion, "id", None), cfg.daemon_catchup_sec)
+
+    try:
+        await sync.reconcile("comment")
+        await sync.recheck_comments()
+        overlap = cfg.overlap
+        while True:
+            wake.clear()
+            try:
+                await sync.catch_up(overlap=overlap)
+                overlap = 0
+                await sync.harvest_comments()
+                await sync.recheck_edits()
+                sync.state.flush()
+            except Exception:
+                log.exception("catch-up failed, will retry")
+
+            if comments.done():
+                comments.result()  # воркер комментариев не должен завершаться сам
+
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=cfg.daemon_catchup_sec)
+            except asyncio.TimeoutError:
+                pass
+            # элементы альбома приходят отдельными событиями — даём альбому долететь целиком
+            await asyncio.sleep(cfg.daemon_debounce_sec)
+    finally:
+        for cb, ev in handlers:
+            client.remove_event_handler(cb, ev)
+        for t in (comments, watcher):
+            t.cancel()
+        await asyncio.gather(comments, watcher, return_exceptions=True)
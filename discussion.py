@@ -0,0 +1,198 @@
+from __future__ import annotations
+import logging
+
+from telethon import TelegramClient, errors, utils
+from telethon.tl.functions.channels import GetFullChannelRequest
+
+from comments import CommentCopier
+from pool import SessionPool, read_messages
+from ratelimit import paced_history
+from retry import safe_call
+from state import StateStore
+
+log = logging.getLogger("tg_sync.discussion")
+
+MAX_FAILURES = 3  # проходов подряд, после которых комментарий с временной ошибкой пропускается
+
+
+async def linked_discussion(client: TelegramClient, channel):
+    """Discussion-группа, привязанная к каналу (там живут комментарии), или None."""
+    full = await safe_call(lambda: client(GetFullChannelRequest(channel)), ctx="get_full_channel")
+    linked_id = full.full_chat.linked_chat_id
+    if not linked_id:
+        return None
+    return next((c for c in full.chats if c.id == linked_id), None)
+
+
+def thread_top_id(msg) -> int | None:
+    """id сообщения-поста в discussion-группе, к которому относится комментарий."""
+    r = msg.reply_to
+    if r is None:
+        return None
+    return r.reply_to_top_id or r.reply_to_msg_id
+
+
+class DiscussionHarvester:
+    """
+    Комментарии всех тредов одним проходом по discussion-группе источника (TG_COMMENTS_MODE=group).
+    Группа читается от своего watermark (state.get_discussion_watermark), каждый комментарий уходит в тред
+    своего поста: id верха треда -> пост источника (автопересылка канала в группу) -> пост назначения.
+    Вместо iter_messages на каждый пост с новыми комментариями — страница истории на каждые 100 сообщений группы.
+    """
+
+    def __init__(self, comment_copier: CommentCopier, state: StateStore, *, src, dest):
+        self.copier = comment_copier
+        self.state = state
+        self.src = src
+        self.dest = dest
+        self.group = None  # discussion-группа, определяется один раз при первом проходе
+        self._resolved = False
+        self._src_peer = utils.get_peer_id(src)
+        self._failures: dict[int, int] = {}  # id первого сообщения юнита -> неудачных попыток подряд
+
+        self.scanned = 0
+        self.copied = 0
+        self.skipped = 0
+
+    async def resolve(self):
+        if not self._resolved:
+            self.group = await linked_discussion(self.copier.client, self.src)
+            self._resolved = True
+            if self.group is None:
+                log.warning("discussion | %s | source has no linked discussion group, no comments to copy",
+                            self.copier.job)
+        return self.group
+
+    async def run(self, *, last_seen: int, readers: SessionPool | None = None) -> None:
+        """
+        Один проход от watermark группы до её головы. Комментарий к посту новее last_seen
+        (конвейер постов до него ещё не дошёл) останавливает проход: он и всё после него — в следующий раз.
+        readers — пул для чтения защищённого источника (как у тредов), если его аккаунты видят группу.
+        """
+        group = await self.resolve()
+        if group is None:
+            return
+        if readers is not None and not await readers.covers(group):
+            readers = None
+        wm = self.state.get_discussion_watermark()
+        log.info("start discussion | %s | group=%s min_id=%s", self.copier.job, group.id, wm)
+
+        if readers is not None:
+            history = readers.iter_history(group, min_id=wm)
+        else:
+            history = paced_history(self.copier.source_client.iter_messages(group, min_id=wm, reverse=True),
+                                    self.copier.policy.limiter)
+
+        scanned = copied = 0
+        # комментарий-альбом копится, пока идут сообщения с тем же grouped_id
+        unit: list = []
+        thread: tuple[int, int] = (0, 0)
+        try:
+            async for m in history:
+                scanned += 1
+                gid = getattr(m, "grouped_id", None)
+                if unit and gid is not None and gid == unit[0].grouped_id:
+                    unit.append(m)
+                    continue
+                if unit:
+                    wm, ok = await self._copy(unit, *thread)
+                    copied += ok
+                    unit = []
+
+                src_post_id = await self._source_post(m, group, readers)
+                if not src_post_id:
+                    wm = m.id  # служебное сообщение, автопересылка поста или разговор вне тредов
+                    continue
+                dest_post_id = self._dest_post(src_post_id)
+                if dest_post_id is None:
+                    if src_post_id > last_seen:
+                        log.info("discussion | %s | post %s is not published yet, stopping at comment %s",
+                                 self.copier.job, src_post_id, m.id)
+                        break
+                    wm = m.id  # пост не копировался (до начала синхронизации) — его комментарии не нужны
+                    continue
+                if m.id <= self.state.comment_watermark(src_post_id):
+                    wm = m.id  # уже скопирован (режимом тредов или до рестарта)
+                    continue
+
+                if self.copier.include_author:
+                    # отправители уже пришли вместе со страницей истории — запоминаем без запросов
+                    self.copier.authors.prime([m])
+                unit = [m]
+                thread = (src_post_id, dest_post_id)
+            if unit:
+                wm, ok = await self._copy(unit, *thread)
+                copied += ok
+        except Exception as ex:
+            # watermark стоит на последнем скопированном юните — следующий проход продолжит с него
+            log.warning("discussion | %s | stopped after comment %s: %s: %s", self.copier.job, wm,
+                        type(ex).__name__, ex)
+        finally:
+            self.state.set_discussion_watermark(wm)
+            self.scanned += scanned
+            self.copied += copied
+            log.info("done discussion | %s | scanned=%s copied=%s skipped=%s watermark=%s",
+                     self.copier.job, scanned, copied, self.skipped, wm)
+
+    async def _copy(self, unit: list, src_post_id: int, dest_post_id: int) -> tuple[int, bool]:
+        """Копирует юнит и двигает watermark группы за него; False — юнит пропущен после ошибки."""
+        key = unit[0].id
+        ok = True
+        try:
+            await self.copier.copy_unit(self.src, self.dest, src_post_id=src_post_id, dest_post_id=dest_post_id,
+                                        unit=unit)
+        except (errors.BadRequestError, errors.ForbiddenError) as e:
+            # повтор не поможет (медиа недоступно, тред закрыт, нет прав) — иначе комментарий держал бы всю группу
+            self._skip(unit, src_post_id, e)
+            ok = False
+        except Exception as e:
+            # сеть, FloodWait дольше лимита и т.п.: проход остановится и повторит юнит, но не бесконечно
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] < MAX_FAILURES:
+                raise
+            self._skip(unit, src_post_id, e)
+            ok = False
+        self._failures.pop(key, None)
+        wm = max(m.id for m in unit)
+        self.state.set_discussion_watermark(wm)
+        return wm, ok
+
+    def _skip(self, unit: list, src_post_id: int, e: Exception) -> None:
+        log.warning("discussion | %s | comment %s of post %s skipped after %s failure(s): %s: %s",
+                    self.copier.job, unit[0].id, src_post_id, self._failures.get(unit[0].id, 1),
+                    type(e).__name__, e)
+        self.copier.skip_unit(src_post_id, unit)
+        self.skipped += 1
+
+    async def _source_post(self, m, group, readers: SessionPool | None) -> int:
+        """id поста источника, к треду которого относится m; 0 — m не комментарий к посту источника."""
+        fwd = getattr(m, "fwd_from", None)
+        if fwd is not None and fwd.channel_post and self._from_source(fwd):
+            # автопересылка поста в группу — верх треда; запоминаем, чтобы не запрашивать его потом
+            self.state.record_ids("top", {m.id: fwd.channel_post})
+            return 0
+        top = thread_top_id(m)
+        if top is None:
+            return 0
+        src_post_id = self.state.dest_id("top", top)
+        if src_post_id is None:
+            # верх треда старше watermark группы: один запрос на тред, дальше — из state
+            top_msg = await read_messages(readers, self.copier.source_client, group, ids=top,
+                                          ctx=f"resolve thread {top}", policy=self.copier.policy)
+            fwd = getattr(top_msg, "fwd_from", None)
+            src_post_id = fwd.channel_post if fwd is not None and fwd.channel_post and self._from_source(fwd) else 0
+            self.state.record_ids("top", {top: src_post_id})
+        return src_post_id
+
+    def _from_source(self, fwd) -> bool:
+        # в группу пересылают и посты чужих каналов — верх треда только автопересылка своего
+        return fwd.from_id is not None and utils.get_peer_id(fwd.from_id) == self._src_peer
+
+    def _dest_post(self, src_post_id: int) -> int | None:
+        dest_post_id = self.state.thread_dest(src_post_id)
+        if dest_post_id is None:
+            # тред альбома висит на другом элементе, чем тот, что выбрал копировщик: comment_to примет любой
+            dest_post_id = self.state.dest_id("post", src_post_id)
+            if dest_post_id is not None:
+                self.state.register_thread(src_post_id, dest_post_id)
+        return dest_post_id
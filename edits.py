@@ -0,0 +1,171 @@
+from __future__ import annotations
+import hashlib
+import logging
+
+from telethon import errors, utils
+
+from copier import PostCopier, is_real_media
+from pool import SessionPool, read_messages
+from retry import safe_call
+from state import Fingerprint, StateStore
+from upload_cache import media_key
+
+log = logging.getLogger("tg_sync.edits")
+
+
+def unit_text(unit) -> tuple[str, list]:
+    """Текст юнита, как его публикует PostCopier: у альбома — первая непустая подпись."""
+    if len(unit) == 1:
+        return unit[0].message or "", unit[0].entities or []
+    cap_msg = next((m for m in unit if (m.message or "").strip()), None)
+    return (cap_msg.message or "", cap_msg.entities or []) if cap_msg else ("", [])
+
+
+def unit_fingerprint(unit, text_id: int) -> Fingerprint:
+    text, entities = unit_text(unit)
+    h = hashlib.sha256(text.encode("utf-8"))
+    for e in entities:
+        h.update(bytes(e))
+    if not any(is_real_media(m) for m in unit) and sum(1 for _ in utils.split_text(text, entities)) > 1:
+        text_id = 0  # длинный текст ушёл несколькими сообщениями — одним edit_message его не поправить
+    return Fingerprint(
+        unit_id=unit[0].id,
+        text_id=text_id,
+        edit_date=max(_edit_ts(m) for m in unit),
+        text_hash=h.hexdigest(),
+        media=" ".join(media_key(m.media) or "-" for m in unit),
+    )
+
+
+def _edit_ts(m) -> int:
+    return int(m.edit_date.timestamp()) if getattr(m, "edit_date", None) else 0
+
+
+def _units(msgs: list) -> list[list]:
+    # сообщения по возрастанию id -> юниты, как в scanner.iter_units
+    units: list[list] = []
+    for m in msgs:
+        gid = getattr(m, "grouped_id", None)
+        if gid is not None and units and getattr(units[-1][0], "grouped_id", None) == gid:
+            units[-1].append(m)
+        else:
+            units.append([m])
+    return units
+
+
+class EditSync:
+    """
+    Перенос правок постов источника в DEST (TG_EDITS_RECHECK): последние window сообщений до last_seen
+    читаются одним get_messages на сотню, и у каждого юнита сначала сравнивается только edit_date
+    с отпечатком, сохранённым при копировании. Если он сдвинулся и текст/сущности или медиа
+    действительно другие — правится соответствующее сообщение в DEST (edit_message), ничего не копируется заново.
+    Юнит без отпечатка (скопирован до появления отпечатков) запоминается как есть.
+    """
+
+    def __init__(self, copier: PostCopier, state: StateStore, *, src, dest, window: int, reader,
+                 pool: SessionPool | None = None, job: str = ""):
+        self.copier = copier
+        self.state = state
+        self.src = src
+        self.dest = dest
+        self.window = window
+        self.reader = reader  # откуда читать источник (client или archive.ArchiveReader)
+        self.pool = pool
+        self.job = job
+
+        self.checked = 0
+        self.edited = 0
+
+    async def run(self, *, last_seen: int) -> None:
+        msgs = await read_messages(self.pool, self.reader, self.src, limit=self.window, max_id=last_seen + 1,
+                                   ctx="edits window", policy=self.copier.policy)
+        msgs = sorted((m for m in msgs or [] if m is not None and m.id <= last_seen), key=lambda m: m.id)
+        units = _units(msgs)
+        if units and len(msgs) >= self.window and getattr(units[0][0], "grouped_id", None) is not None:
+            units = units[1:]  # начало окна могло разрезать альбом — его проверит окно побольше
+
+        checked = edited = 0
+        try:
+            for unit in units:
+                checked += 1
+                edited += await self._check(unit)
+        except Exception as ex:
+            # отпечатки проверенных юнитов уже обновлены — следующий запуск продолжит с остальных
+            log.warning("edits | %s | stopped at unit %s: %s: %s", self.job, unit[0].id, type(ex).__name__, ex)
+        finally:
+            self.checked += checked
+            self.edited += edited
+            log.info("edits | %s | window=%s checked=%s edited=%s", self.job, len(msgs), checked, edited)
+
+    async def _check(self, unit) -> bool:
+        old = self.state.fingerprint(unit[0].id)
+        if old is not None and old.edit_date == max(_edit_ts(m) for m in unit):
+            return False  # правок не было — содержимое даже не сравниваем
+
+        if old is None:
+            # текст юнита лежит в его корневом посте (к нему же цепляются комментарии)
+            cap_msg = next((m for m in unit if (m.message or "").strip()), None)
+            text_id = self.state.thread_dest(cap_msg.id if cap_msg else unit[0].id)
+            if text_id is None:
+                return False  # юнит не копировался
+            self.state.record_fingerprint(unit_fingerprint(unit, text_id))
+            return False
+
+        new = unit_fingerprint(unit, old.text_id)
+        ctx = f"edit unit={new.unit_id}"
+        text, entities = unit_text(unit)
+        done: set[int] = set()
+        if new.media != old.media:
+            done = await self._edit_media(unit, old, new, text, entities, ctx=ctx)
+        if new.text_hash != old.text_hash and new.text_id not in done:
+            if new.text_id:
+                text_ctx = f"{ctx} text dest_id={new.text_id}"
+                if await self._edit(safe_call(
+                    lambda: self.copier.client.edit_message(self.dest, new.text_id, text,
+                                                            formatting_entities=entities,
+                                                            link_preview=self.copier.link_preview),
+                    ctx=text_ctx, policy=self.copier.policy, kind="send_message",
+                ), ctx=text_ctx):
+                    done.add(new.text_id)
+            else:
+                log.warning("%s: text was sent in several messages, edit is not propagated", ctx)
+        self.state.record_fingerprint(new)
+        if done:
+            log.info("%s -> edited dest_ids=%s", ctx, sorted(done))
+        return bool(done)
+
+    async def _edit_media(self, unit, old: Fingerprint, new: Fingerprint, text: str, entities,
+                          ctx: str) -> set[int]:
+        before, after = old.media.split(" "), new.media.split(" ")
+        if len(before) != len(after):
+            log.warning("%s: album changed its size (%s -> %s), media edit is not propagated",
+                        ctx, len(before), len(after))
+            return set()
+        done: set[int] = set()
+        for m, was, now in zip(unit, before, after):
+            if was == now:
+                continue
+            dest_id = self.state.dest_id("post", m.id)
+            if dest_id is None or "-" in (was, now):
+                # медиа у текстового поста не добавить и не убрать правкой
+                log.warning("%s: media of %s changed (%s -> %s), edit is not propagated", ctx, m.id, was, now)
+                continue
+            # подпись альбома висит на одном сообщении, у остальных она пустая
+            caption, ents = (text, entities) if dest_id == new.text_id else ("", [])
+            if await self._edit(self.copier.media.edit(self.dest, dest_id, m, ctx=f"{ctx} m={m.id}",
+                                                       text=caption, formatting_entities=ents),
+                                ctx=f"{ctx} media dest_id={dest_id}"):
+                done.add(dest_id)
+        return done
+
+    @staticmethod
+    async def _edit(call, *, ctx: str) -> bool:
+        try:
+            await call
+        except errors.MessageNotModifiedError:
+            pass
+        except errors.BadRequestError as e:
+            # сообщение в DEST удалено, подпись не влезает и т.п. — повтор не поможет
+            log.warning("%s: edit failed (%s), skipped", ctx, type(e).__name__)
+            return False
+        return True
@@ -0,0 +1,431 @@
+"""
+Локальный «Telegram» для бенчмарков (см. bench.py): реализует ту часть TelegramClient,
+которой пользуется проект, поверх синтетического канала с альбомами, длинными текстами,
+повторяющимися файлами и тредами комментариев. Задержка, пропускная способность и FloodWait настраиваются.
+"""
+from __future__ import annotations
+import asyncio
+import datetime
+import hashlib
+import os
+import random
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+from telethon import errors
+from telethon.tl import types
+from telethon.tl.functions.channels import GetFullChannelRequest
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+
+_DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+SOURCE_ID = 1001
+DEST_ID = 1002
+DISCUSSION_ID = 1003
+
+
+@dataclass
+class FakeNetwork:
+    latency: float = 0.05           # секунд на любой вызов
+    bandwidth: float = 20e6         # байт/с на скачивание и загрузку
+    flood_rate: float = 0.0         # вероятность FloodWait на send_*/forward
+    flood_seconds: int = 3
+    read_flood_rate: float = 0.0    # вероятность FloodWait на страницу истории и скачивание
+
+
+@dataclass
+class ChannelSpec:
+    posts: int = 200
+    album_every: int = 7            # каждый N-й пост — альбом
+    album_size: int = 4
+    media_every: int = 2            # каждый N-й одиночный пост — с медиа
+    long_text_every: int = 15       # каждый N-й текстовый пост длиннее 4096 символов
+    file_size: int = 1024 * 1024
+    big_file_every: int = 25        # каждый N-й файл — крупный (потоковая перекачка в memory-режиме)
+    big_file_size: int = 24 * 1024 * 1024
+    repeat_rate: float = 0.2        # доля медиа, повторяющих уже встречавшийся файл (мемы, промо)
+    comments_every: int = 3         # у каждого N-го поста есть комментарии
+    comments_per_post: int = 12
+    sticker_every: int = 6          # каждый N-й комментарий — стикер
+    users: int = 30
+    unknown_sender_rate: float = 0.1  # отправители, которых нет на странице истории (нужен get_sender)
+    protected: bool = False         # noforwards: handle не переотправить, медиа идёт через download/upload
+    seed: int = 1
+
+
+class FakeMessage(types.Message):
+    async def get_sender(self):
+        if self._sender is None and self.sender_id is not None:
+            self._sender = await self._client._resolve_user(self.sender_id)
+        return self._sender
+
+
+class FakeTelegramClient:
+    """
+    Подмножество TelegramClient: start/disconnect, get_entity, iter_messages, get_messages,
+    send_message, send_file, edit_message, forward_messages, download_media, iter_download, upload_file,
+    вызов SaveFilePart/SaveBigFilePart/GetFullChannel. Как и Telethon, FloodWait не дольше
+    flood_sleep_threshold секунд клиент пересыпает сам (и на чтении, и на отправке), длиннее — бросает.
+    Клиенты с одинаковым spec видят один и тот же источник (так собирается пул аккаунтов в bench.py). Каждое отправленное сообщение и время его отправки
+    запоминаются (sent_at), время выдачи каждого исходного сообщения — тоже (yielded_at).
+    """
+
+    def __init__(self, spec: ChannelSpec | None = None, net: FakeNetwork | None = None, *,
+                 flood_sleep_threshold: int = 60):
+        self.spec = spec or ChannelSpec()
+        self.net = net or FakeNetwork()
+        self.flood_sleep_threshold = flood_sleep_threshold
+        self._rnd = random.Random(self.spec.seed)
+        self._self_id = 1
+
+        self.source = types.Channel(id=SOURCE_ID, title="source", photo=types.ChatPhotoEmpty(), date=_DATE,
+                                    broadcast=True, access_hash=1, username="fake_source",
+                                    noforwards=self.spec.protected or None)
+        self.discussion = types.Channel(id=DISCUSSION_ID, title="discussion", photo=types.ChatPhotoEmpty(),
+                                        date=_DATE, megagroup=True, access_hash=3)
+        self.dest = types.Channel(id=DEST_ID, title="dest", photo=types.ChatPhotoEmpty(), date=_DATE,
+                                  broadcast=True, access_hash=2, username="fake_dest")
+        self.users = {
+            uid: types.User(id=uid, access_hash=uid, first_name=f"User{uid}",
+                            username=f"user{uid}" if uid % 3 else None)
+            for uid in range(100, 100 + self.spec.users)
+        }
+
+        self.posts: list[FakeMessage] = []
+        self.comments: dict[int, list[FakeMessage]] = {}
+        self.group: list[FakeMessage] = []  # история discussion-группы: автопересылки постов и комментарии
+        self.units: dict[tuple[str, int], int] = {}  # (kind, src id) -> id первого сообщения юнита
+        self._doc_sizes: dict[int, int] = {}  # doc_id -> size: один документ — один и тот же файл
+        self._next_doc = 10 ** 6
+        self._build()
+
+        self.yielded_at: dict[tuple[str, int], float] = {}
+        self.sent_at: dict[int, float] = {}
+        # что лежит в DEST: посты и комментарии по id поста (для сверки журнала)
+        self.dest_posts: list[types.Message] = []
+        self.dest_comments: dict[int, list[types.Message]] = {}
+        self._next_gid = 0
+        self.calls: dict[str, int] = {}
+        self.flood_waits = 0
+        self._next_dest_id = 0
+        self._next_file_id = 0
+        self._uploaded: dict[int, int] = {}  # id загруженного InputFile -> размер
+
+    # --- синтетический канал ---
+
+    def _build(self) -> None:
+        s, rnd = self.spec, self._rnd
+        msg_id = 0
+        comment_id = 0
+        n_files = 0
+
+        def media():
+            nonlocal n_files
+            n_files += 1
+            if self._doc_sizes and rnd.random() < s.repeat_rate:
+                doc_id = rnd.choice(list(self._doc_sizes))
+            else:
+                self._next_doc += 1
+                doc_id = self._next_doc
+                self._doc_sizes[doc_id] = (s.big_file_size if s.big_file_every and n_files % s.big_file_every == 0
+                                           else s.file_size)
+            return _document(doc_id, self._doc_sizes[doc_id])
+
+        for post in range(1, s.posts + 1):
+            if s.album_every and post % s.album_every == 0:
+                gid = 5 * 10 ** 6 + post
+                first = root_id = msg_id + 1
+                for k in range(s.album_size):
+                    msg_id += 1
+                    text = f"album {post}" if k == 0 else ""
+                    self.posts.append(self._message(msg_id, SOURCE_ID, text, media=media(), grouped_id=gid))
+                    self.units[("post", msg_id)] = first
+            else:
+                msg_id += 1
+                if s.media_every and post % s.media_every == 0:
+                    m = self._message(msg_id, SOURCE_ID, f"post {post}", media=media())
+                elif s.long_text_every and post % s.long_text_every == 0:
+                    m = self._message(msg_id, SOURCE_ID, ("long text %s " % post) * 600,
+                                      entities=[types.MessageEntityBold(0, 9)])
+                else:
+                    m = self._message(msg_id, SOURCE_ID, f"text post {post}")
+                self.posts.append(m)
+                self.units[("post", msg_id)] = root_id = msg_id
+
+            # комментарии висят на посте с подписью (у альбома — на первом элементе)
+            root = next(m for m in reversed(self.posts) if m.id == root_id)
+            if s.comments_every and post % s.comments_every == 0:
+                # пост с комментариями Telegram пересылает в группу — это верх треда
+                comment_id += 1
+                top = self._message(comment_id, DISCUSSION_ID, root.message,
+                                    fwd_from=types.MessageFwdHeader(date=_DATE, from_id=types.PeerChannel(SOURCE_ID),
+                                                                    channel_post=root.id))
+                self.group.append(top)
+                thread = []
+                for k in range(s.comments_per_post):
+                    comment_id += 1
+                    uid = rnd.choice(list(self.users))
+                    if s.sticker_every and k % s.sticker_every == s.sticker_every - 1:
+                        c = self._message(comment_id, DISCUSSION_ID, "", media=_sticker(comment_id), sender=uid)
+                    elif k % 4 == 1:
+                        c = self._message(comment_id, DISCUSSION_ID, f"comment {k}", media=media(), sender=uid)
+                    else:
+                        c = self._message(comment_id, DISCUSSION_ID, f"comment {k} to {post}", sender=uid)
+                    c.reply_to = types.MessageReplyHeader(reply_to_msg_id=top.id)
+                    thread.append(c)
+                    self.units[("comment", comment_id)] = comment_id
+                self.comments[root.id] = thread
+                self.group.extend(thread)
+                root.replies = types.MessageReplies(replies=len(thread), replies_pts=0, comments=True,
+                                                    channel_id=DISCUSSION_ID, max_id=thread[-1].id)
+
+    def _message(self, msg_id: int, chat_id: int, text: str, *, media=None, grouped_id=None, entities=None,
+                 sender: int | None = None, fwd_from=None) -> FakeMessage:
+        m = FakeMessage(
+            id=msg_id,
+            peer_id=types.PeerChannel(chat_id),
+            date=_DATE,
+            message=text,
+            media=media,
+            entities=entities,
+            grouped_id=grouped_id,
+            from_id=types.PeerUser(sender) if sender else None,
+            fwd_from=fwd_from,
+            noforwards=self.spec.protected or None,
+        )
+        m._client = self
+        # отправитель «пришёл со страницей истории», кроме части неизвестных
+        if sender and self._rnd.random() >= self.spec.unknown_sender_rate:
+            m._sender = self.users[sender]
+        return m
+
+    # --- сеть ---
+
+    async def _rpc(self, name: str, nbytes: int = 0, *, flood: bool = False, read: bool = False) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.net.latency + (nbytes / self.net.bandwidth if nbytes else 0))
+        if (flood and self.net.flood_rate and self._rnd.random() < self.net.flood_rate) or \
+                (read and self.net.read_flood_rate and self._rnd.random() < self.net.read_flood_rate):
+            self.flood_waits += 1
+            if self.net.flood_seconds > self.flood_sleep_threshold:
+                raise errors.FloodWaitError(request=None, capture=self.net.flood_seconds)
+            await asyncio.sleep(self.net.flood_seconds)
+
+    def _out(self, dest, *, media=None, text: str = "", comment_to: int | None = None,
+             grouped_id: int | None = None) -> types.Message:
+        self._next_dest_id += 1
+        self.sent_at[self._next_dest_id] = time.monotonic()
+        m = types.Message(id=self._next_dest_id, peer_id=types.PeerChannel(DEST_ID), date=_DATE,
+                          message=text, media=media, grouped_id=grouped_id)
+        if comment_to is None:
+            self.dest_posts.append(m)
+        else:
+            self.dest_comments.setdefault(comment_to, []).append(m)
+        return m
+
+    def _album_gid(self, n: int) -> int | None:
+        if n < 2:
+            return None
+        self._next_gid += 1
+        return 7 * 10 ** 6 + self._next_gid
+
+    async def _resolve_user(self, uid: int):
+        await self._rpc("get_users")
+        return self.users.get(uid)
+
+    # --- TelegramClient ---
+
+    async def start(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def get_entity(self, ref):
+        await self._rpc("get_entity")
+        return self.dest if "dest" in str(ref) else self.source
+
+    def iter_messages(self, entity, limit=None, *, min_id: int = 0, reverse: bool = False, reply_to=None, **kw):
+        kind = "comment" if reply_to is not None else "post"
+        if entity is self.dest:
+            msgs = self.dest_comments.get(reply_to, []) if reply_to is not None else self.dest_posts
+        elif entity is self.discussion:
+            kind, msgs = "comment", self.group
+        else:
+            msgs = self.comments.get(reply_to, []) if reply_to is not None else self.posts
+        msgs = [m for m in msgs if m.id > min_id]
+        if not reverse:
+            msgs = msgs[::-1]
+        if limit:
+            msgs = msgs[:limit]
+        return _History(self, msgs, None if entity is self.dest else kind)
+
+    async def get_messages(self, entity, limit=None, *, ids=None, max_id: int = 0, **kw):
+        await self._rpc("get_history", read=True)
+        if entity is self.discussion:
+            by_id = {m.id: m for m in self.group}
+        else:
+            by_id = {m.id: m for m in self.posts}
+        if ids is not None:
+            if isinstance(ids, int):
+                return by_id.get(ids)
+            return [by_id.get(i) for i in ids]
+        return [m for m in reversed(self.posts) if not max_id or m.id < max_id][:limit or 1]
+
+    async def send_message(self, entity, message: str = "", **kw):
+        await self._rpc("send_message", flood=True)
+        return self._out(entity, text=message, comment_to=kw.get("comment_to"))
+
+    async def send_file(self, entity, file, **kw):
+        files = file if isinstance(file, list) else [file]
+        nbytes = sum(_local_size(f) for f in files)
+        await self._rpc("send_file", nbytes, flood=True)
+        gid = self._album_gid(len(files))
+        # подпись альбома Telegram вешает на первый элемент
+        out = [self._out(entity, media=self._dest_media(f), text=(kw.get("caption") or "") if i == 0 else "",
+                         comment_to=kw.get("comment_to"), grouped_id=gid)
+               for i, f in enumerate(files)]
+        return out if isinstance(file, list) else out[0]
+
+    async def edit_message(self, entity, message, text=None, *, file=None, **kw):
+        await self._rpc("edit_message", flood=True)
+        m = next(m for m in self.dest_posts if m.id == message)
+        if text is not None:
+            m.message = text
+        if file is not None:
+            m.media = self._dest_media(file)
+        return m
+
+    async def forward_messages(self, entity, messages, from_peer=None, **kw):
+        await self._rpc("forward_messages", flood=True)
+        by_id = {m.id: m for m in self.posts}
+        gids: dict[int, int | None] = {}
+        out = []
+        for i in messages:
+            src = by_id[i]
+            if src.grouped_id is not None and src.grouped_id not in gids:
+                gids[src.grouped_id] = self._album_gid(2)
+            out.append(self._out(entity, media=src.media, text=src.message or "",
+                                 grouped_id=gids.get(src.grouped_id)))
+        return out
+
+    async def download_media(self, message, file=None, **kw):
+        data = _content(message.media)
+        await self._rpc("download", len(data), read=True)
+        if file is bytes:
+            return data
+        with open(file, "wb") as f:
+            f.write(data)
+        return file
+
+    async def iter_download(self, file, *, offset: int = 0, limit: int | None = None, request_size: int = 512 * 1024,
+                           **kw):
+        data = _content(file)
+        for i in range(limit or (len(data) - offset + request_size - 1) // request_size):
+            chunk = data[offset + i * request_size: offset + (i + 1) * request_size]
+            if not chunk:
+                return
+            await self._rpc("download_part", len(chunk), read=True)
+            yield chunk
+
+    async def upload_file(self, file, *, file_name: str | None = None, **kw):
+        if isinstance(file, str):
+            with open(file, "rb") as f:
+                file = f.read()
+        await self._rpc("upload", len(file))
+        self._next_file_id += 1
+        self._uploaded[self._next_file_id] = len(file)
+        return types.InputFile(id=self._next_file_id, parts=1, name=file_name or "file",
+                               md5_checksum=hashlib.md5(file).hexdigest())
+
+    async def __call__(self, request):
+        if isinstance(request, (SaveFilePartRequest, SaveBigFilePartRequest)):
+            await self._rpc("upload_part", len(request.bytes))
+            # размер файла, загруженного частями, — сумма частей (как у Telegram после сборки)
+            self._uploaded[request.file_id] = self._uploaded.get(request.file_id, 0) + len(request.bytes)
+            return True
+        if isinstance(request, GetFullChannelRequest):
+            await self._rpc("get_full_channel")
+            # полный ChannelFull слишком велик — хватает того, что читает проект
+            return SimpleNamespace(full_chat=SimpleNamespace(linked_chat_id=DISCUSSION_ID), chats=[self.discussion])
+        raise NotImplementedError(type(request).__name__)
+
+    def _dest_media(self, f):
+        # по handle Telegram отправляет тот же файл; загруженный получает свой id, но имя и размер — исходные
+        if isinstance(f, types.MessageMediaDocument):
+            return f
+        if isinstance(f, types.InputMediaDocument):
+            return _document(f.id.id, self._doc_sizes.get(f.id.id, 1))
+        if isinstance(f, (types.MessageMediaPhoto, types.InputMediaPhoto, types.InputMediaUploadedPhoto)):
+            self._next_doc += 1
+            return types.MessageMediaPhoto(photo=types.Photo(
+                id=self._next_doc, access_hash=1, file_reference=b"ref", date=_DATE,
+                sizes=[types.PhotoSize("x", 1, 1, 1)], dc_id=2))
+        self._next_doc += 1
+        if isinstance(f, str):
+            return _document(self._next_doc, _local_size(f), os.path.basename(f))
+        if isinstance(f, types.InputMediaUploadedDocument):
+            name = next((a.file_name for a in f.attributes if isinstance(a, types.DocumentAttributeFilename)), None)
+            return _document(self._next_doc, self._uploaded.get(f.file.id, 1), name)
+        return _document(self._next_doc, 1)
+
+
+class _History:
+    """
+    Итератор истории как RequestIter в Telethon: запрос страницы на каждые 100 сообщений,
+    после FloodWait следующий __anext__ запрашивает ту же страницу снова.
+    """
+
+    def __init__(self, client: FakeTelegramClient, msgs: list, kind: str | None):
+        self._client = client
+        self._msgs = msgs
+        self._kind = kind  # None — история DEST, время выдачи не запоминается
+        self._i = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._i >= len(self._msgs):
+            raise StopAsyncIteration
+        if self._i % 100 == 0:
+            await self._client._rpc("get_history", read=True)
+        m = self._msgs[self._i]
+        self._i += 1
+        if self._kind is not None:
+            self._client.yielded_at.setdefault((self._kind, m.id), time.monotonic())
+        return m
+
+
+def _document(doc_id: int, size: int, name: str | None = None) -> types.MessageMediaDocument:
+    return types.MessageMediaDocument(document=types.Document(
+        id=doc_id, access_hash=doc_id, file_reference=b"ref", date=_DATE, mime_type="video/mp4",
+        size=size, dc_id=2, attributes=[types.DocumentAttributeFilename(name or f"file_{doc_id}.mp4")],
+    ))
+
+
+def _sticker(n: int) -> types.MessageMediaDocument:
+    return types.MessageMediaDocument(document=types.Document(
+        id=9 * 10 ** 6 + n % 10, access_hash=1, file_reference=b"ref", date=_DATE, mime_type="image/webp",
+        size=20_000, dc_id=2, attributes=[types.DocumentAttributeSticker(alt="🙂", stickerset=types.InputStickerSetEmpty())],
+    ))
+
+
+def _content(media) -> bytes:
+    # одинаковый документ — одинаковые байты (для кэша по хэшу содержимого)
+    doc = getattr(media, "document", None)
+    if doc is None:
+        return b"\0" * 1024
+    seed = hashlib.sha256(str(doc.id).encode()).digest()
+    return (seed * (doc.size // len(seed) + 1))[:doc.size]
+
+
+def _local_size(f) -> int:
+    # пути с диска «загружаются» внутри send_file; InputMedia и handle уже на сервере
+    if isinstance(f, str) and os.path.isfile(f):
+        return os.path.getsize(f)
+    return 0
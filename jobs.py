@@ -0,0 +1,177 @@
+from __future__ import annotations
+import asyncio
+import dataclasses
+import json
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from telethon import TelegramClient
+
+from authors import AuthorCache
+from config import Config
+from daemon import run_daemon
+from ratelimit import RateLimiter
+from state import SqliteStateStore, StateDb
+from sync import SourceSync
+from upload_cache import UploadCache
+from journal import Journal
+from pool import SessionPool
+from archive import open_reader
+
+log = logging.getLogger("tg_sync.jobs")
+
+# Что можно переопределить для отдельной пары в файле заданий
+JOB_OPTIONS = (
+    "source", "dest", "last_seen_id", "overlap", "limit",
+    "link_preview", "force_document", "copy_mode", "edits_recheck",
+    "sync_comments", "comments_limit", "comments_include_author", "comments_author_style", "comments_mode",
+    "recompress", "recompress_min", "recompress_quality", "recompress_max_side", "recompress_strip_metadata",
+    "recompress_video_max", "recompress_video_crf",
+)
+
+
+class FairScheduler:
+    """
+    Очередь публикаций между заданиями по кругу (round-robin):
+    одновременно не больше concurrency публикаций, и ни одно задание не может занять клиент целиком.
+    """
+
+    def __init__(self, concurrency: int = 1):
+        self._free = max(1, concurrency)
+        self._waiters: dict[str, deque] = {}
+        self._ring: deque[str] = deque()
+
+    @asynccontextmanager
+    async def turn(self, job: str):
+        if self._free > 0 and not self._ring:
+            self._free -= 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            q = self._waiters.setdefault(job, deque())
+            if not q:
+                self._ring.append(job)
+            q.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release()  # слот уже передали нам — отдаём дальше
+                else:
+                    q.remove(fut)
+                    if not q and job in self._ring:
+                        self._ring.remove(job)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        while self._ring:
+            job = self._ring.popleft()
+            q = self._waiters[job]
+            fut = q.popleft()
+            if q:
+                self._ring.append(job)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._free += 1
+
+
+def load_jobs(path: Path, base: Config) -> list[Config]:
+    """
+    Файл заданий — JSON-список пар, например:
+      [{"name": "news", "source": "@src", "dest": "@dst", "sync_comments": true, "comments_limit": 100}]
+    Для каждой пары возвращается копия базового Config с переопределёнными опциями.
+    """
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+
+    jobs: list[Config] = []
+    names: set[str] = set()
+    for i, item in enumerate(raw):
+        unknown = set(item) - set(JOB_OPTIONS) - {"name"}
+        if unknown:
+            raise RuntimeError(f"{path}: job #{i}: неизвестные опции {sorted(unknown)}")
+        if not item.get("source") or not item.get("dest"):
+            raise RuntimeError(f"{path}: job #{i}: нужны source и dest")
+
+        name = str(item.get("name") or item["source"])
+        if name in names:
+            raise RuntimeError(f"{path}: job name {name!r} повторяется")
+        names.add(name)
+
+        opts = {k: item[k] for k in JOB_OPTIONS if k in item}
+        # как и в .env: 0 = без лимита
+        for k in ("limit", "comments_limit"):
+            if k in opts and (opts[k] or 0) <= 0:
+                opts[k] = None
+
+        jobs.append(dataclasses.replace(
+            base,
+            **opts,
+            job_name=name,
+            comments_queue_file=base.comments_queue_file.with_name(
+                f"{base.comments_queue_file.stem}.{_safe(name)}{base.comments_queue_file.suffix}"
+            ),
+        ))
+    return jobs
+
+
+def _safe(name: str) -> str:
+    return "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in name)
+
+
+async def _run_job(client: TelegramClient, cfg: Config, scheduler: FairScheduler,
+                   upload_cache: UploadCache | None, authors: AuthorCache | None,
+                   limiter: RateLimiter | None, journal: Journal | None, pool: SessionPool | None,
+                   recompress_pool=None, state_db: StateDb | None = None) -> SourceSync:
+    reader = open_reader(cfg) if cfg.archive_mode == "replay" else None
+    state = SqliteStateStore(cfg.state_db, source=cfg.job_name, db=state_db)
+    try:
+        stored = state.get_last_seen()
+        last_seen = cfg.last_seen_id if stored is None else stored
+        log.info("job start | %s | source=%s dest=%s last_seen=%s", cfg.job_name, cfg.source, cfg.dest, last_seen)
+
+        src = reader.entity if reader is not None else await client.get_entity(cfg.source)
+        dst = await client.get_entity(cfg.dest)
+
+        sync = SourceSync(client, cfg, state, src=src, dst=dst, last_seen=last_seen, scheduler=scheduler,
+                          upload_cache=upload_cache, authors=authors, limiter=limiter, journal=journal, pool=pool,
+                          source_client=reader, recompress_pool=recompress_pool)
+        if cfg.daemon:
+            await run_daemon(sync)
+        else:
+            await sync.run_once()
+        sync.log_summary()
+        return sync
+    finally:
+        state.close()
+        if reader is not None:
+            reader.close()
+
+
+async def run_jobs(client: TelegramClient, jobs: list[Config], *, concurrency: int = 2,
+                   upload_cache: UploadCache | None = None, authors: AuthorCache | None = None,
+                   limiter: RateLimiter | None = None, journal: Journal | None = None,
+                   pool: SessionPool | None = None, recompress_pool=None) -> None:
+    """Все пары в одном процессе поверх одного клиента; ошибка одной пары не останавливает остальные."""
+    scheduler = FairScheduler(concurrency)
+    # одно соединение на всех: у каждой пары своё — открытые транзакции блокировали бы друг друга
+    state_db = StateDb(jobs[0].state_db)
+    try:
+        results = await asyncio.gather(*(_run_job(client, cfg, scheduler, upload_cache, authors, limiter, journal,
+                                                  pool, recompress_pool, state_db)
+                                         for cfg in jobs),
+                                       return_exceptions=True)
+    finally:
+        state_db.close()
+
+    failed = [(cfg.job_name, r) for cfg, r in zip(jobs, results) if isinstance(r, BaseException)]
+    for name, err in failed:
+        log.error("job failed | %s | %s: %s", name, type(err).__name__, err)
+    if failed:
+        raise failed[0][1]
@@ -0,0 +1,399 @@
+from __future__ import annotations
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from telethon import TelegramClient, utils
+from telethon.tl.types import MessageMediaPhoto
+
+from copier import is_real_media
+from recompress import media_kind
+from ratelimit import paced_history
+from retry import RetryPolicy
+from state import StateStore
+
+log = logging.getLogger("tg_sync.journal")
+
+# сколько сообщений назначения просматриваем при сверке, если отметки ещё нет
+RECONCILE_SCAN = 200
+# длина префикса текста, по которому узнаём отправленный юнит в назначении
+KEY_LEN = 64
+# done-записи, которые prune оставляет каждой паре: по ним сверка соседей по DEST не примет её сообщения за свои
+KEEP_DONE = RECONCILE_SCAN
+# допуск при сравнении пропорций картинки/видео (Telegram и TG_RECOMPRESS уменьшают, но не искажают)
+SHAPE_TOLERANCE = 0.02
+
+
+def _root(unit) -> int:
+    # как src_root_post_id в copier: сообщение с подписью, иначе первое
+    cap = next((m for m in unit if (m.message or "").strip()), None)
+    return cap.id if cap else min(m.id for m in unit)
+
+
+def unit_key(unit) -> str:
+    cap = next((m for m in unit if (m.message or "").strip()), None)
+    return (cap.message or "").strip()[:KEY_LEN] if cap else ""
+
+
+def media_sig(m) -> dict:
+    """
+    Приметы медиа для сверки: id фото/документа (совпадёт при отправке по handle), имя без расширения,
+    размер (только у файлов, которые не пересжимаются и не перекодируются Telegram) и размеры в пикселях.
+    """
+    obj = getattr(m.media, "photo", None) or getattr(m.media, "document", None)
+    f = m.file
+    photo = isinstance(m.media, MessageMediaPhoto)
+    keeps_size = not photo and media_kind(m) is None
+    return {
+        "id": getattr(obj, "id", 0),
+        "name": os.path.splitext(f.name or "")[0] if f else "",
+        "size": (f.size or 0) if f and keeps_size else 0,
+        "w": (f.width or 0) if f else 0,
+        "h": (f.height or 0) if f else 0,
+    }
+
+
+@dataclass
+class Entry:
+    kind: str                # "post" | "comment"
+    src_id: int              # первый id юнита в источнике
+    thread: int              # для комментариев — src_post_id, для постов 0
+    dest_thread: int         # для комментариев — dest_post_id, для постов 0
+    src_ids: list[int]
+    root: int                # src_root_post_id (для постов)
+    key: str                 # начало текста/подписи (см. unit_key)
+    media: int               # сколько медиа в юните
+    status: str              # "pending" — отправка начата, "done" — id назначения известны
+    id_map: dict[int, int] = field(default_factory=dict)
+    dest_root: int = 0
+    sigs: list[dict] = field(default_factory=list)  # media_sig каждого медиа юнита, по порядку
+    label: str = ""          # подпись автора, которая уходит отдельным сообщением перед юнитом
+    label_id: int = 0        # её id в назначении, когда отправка подтверждена
+
+    @property
+    def src_max_id(self) -> int:
+        return max(self.src_ids)
+
+
+class Journal:
+    """
+    Журнал публикаций (write-ahead, SQLite): перед отправкой юнита пишется намерение (pending),
+    после — id назначения (done). Записи done живут, пока state не сохранил те же изменения (prune);
+    pending после падения сверяются с назначением (reconcile), чтобы не отправить юнит второй раз.
+    Один журнал на процесс, записи разделены по имени пары (job).
+    """
+
+    def __init__(self, path: Path):
+        self._db = sqlite3.connect(str(path))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS units (
+                job         TEXT    NOT NULL,
+                kind        TEXT    NOT NULL,
+                src_id      INTEGER NOT NULL,
+                thread      INTEGER NOT NULL DEFAULT 0,
+                dest_thread INTEGER NOT NULL DEFAULT 0,
+                src_ids     TEXT    NOT NULL,
+                root        INTEGER NOT NULL DEFAULT 0,
+                key         TEXT    NOT NULL DEFAULT '',
+                media       INTEGER NOT NULL DEFAULT 0,
+                status      TEXT    NOT NULL,
+                id_map      TEXT    NOT NULL DEFAULT '{}',
+                dest_root   INTEGER NOT NULL DEFAULT 0,
+                updated     REAL    NOT NULL,
+                dest        INTEGER NOT NULL DEFAULT 0,
+                sigs        TEXT    NOT NULL DEFAULT '[]',
+                label       TEXT    NOT NULL DEFAULT '',
+                label_id    INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job, kind, src_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS marks (
+                job     TEXT    NOT NULL,
+                kind    TEXT    NOT NULL,
+                thread  INTEGER NOT NULL,
+                dest_id INTEGER NOT NULL,
+                PRIMARY KEY (job, kind, thread)
+            ) WITHOUT ROWID;
+            """
+        )
+        # журналы, созданные до колонок dest/sigs/label
+        columns = {r[1] for r in self._db.execute("PRAGMA table_info(units)")}
+        for name, ddl in (("dest", "INTEGER NOT NULL DEFAULT 0"), ("sigs", "TEXT NOT NULL DEFAULT '[]'"),
+                          ("label", "TEXT NOT NULL DEFAULT ''"), ("label_id", "INTEGER NOT NULL DEFAULT 0")):
+            if name not in columns:
+                self._db.execute(f"ALTER TABLE units ADD COLUMN {name} {ddl}")
+        self._db.commit()
+
+    def begin(self, job: str, kind: str, unit, *, dest=None, thread: int = 0, dest_thread: int = 0) -> None:
+        """
+        Намерение отправить юнит в dest (entity назначения); повторная попытка того же юнита
+        перезаписывает запись, кроме уже отправленной подписи автора.
+        """
+        media = [m for m in unit if is_real_media(m)]
+        self._db.execute(
+            "INSERT INTO units (job, kind, src_id, thread, dest_thread, src_ids, root, key, media, status, updated, "
+            "dest, sigs) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?) "
+            "ON CONFLICT(job, kind, src_id) DO UPDATE SET thread = excluded.thread, "
+            "dest_thread = excluded.dest_thread, src_ids = excluded.src_ids, root = excluded.root, "
+            "key = excluded.key, media = excluded.media, status = 'pending', id_map = '{}', dest_root = 0, "
+            "updated = excluded.updated, dest = excluded.dest, sigs = excluded.sigs",
+            (job, kind, unit[0].id, thread, dest_thread, json.dumps([m.id for m in unit]),
+             _root(unit), unit_key(unit), len(media), time.time(), _peer(dest),
+             json.dumps([media_sig(m) for m in media])),
+        )
+        self._db.commit()
+
+    def label(self, job: str, kind: str, src_id: int, text: str, dest_id: int = 0) -> None:
+        """
+        Подпись автора юнита отдельным сообщением (author_style=message): перед отправкой — её текст
+        (по нему сверка найдёт подпись, ответ на которую не дошёл), после — id в назначении.
+        """
+        self._db.execute("UPDATE units SET label = ?, label_id = ? WHERE job = ? AND kind = ? AND src_id = ?",
+                         (text, dest_id, job, kind, src_id))
+        self._db.commit()
+
+    def sent_label(self, job: str, kind: str, src_id: int) -> int:
+        """id подписи автора, уже отправленной для юнита (до рестарта или в прошлой попытке); 0 — нет."""
+        row = self._db.execute("SELECT label_id FROM units WHERE job = ? AND kind = ? AND src_id = ?",
+                               (job, kind, src_id)).fetchone()
+        return row[0] if row else 0
+
+    def claimed(self, kind: str, dest) -> set[int]:
+        """
+        id назначения, уже известные журналу в этом dest: сообщения всех пар (в том числе соседей
+        по общему DEST) и подписи авторов — сверка не должна принимать их за свой юнит.
+        """
+        ids: set[int] = set()
+        for id_map, label_id in self._db.execute(
+                "SELECT id_map, label_id FROM units WHERE kind = ? AND dest = ?", (kind, _peer(dest))):
+            ids.update(json.loads(id_map).values())
+            if label_id:
+                ids.add(label_id)
+        return ids
+
+    def commit(self, job: str, kind: str, src_id: int, id_map: dict[int, int], *, dest_root: int = 0,
+               thread: int = 0) -> None:
+        """Юнит отправлен (id_map пустой — юнит пропущен, запись удаляется)."""
+        if not id_map:
+            self._db.execute("DELETE FROM units WHERE job = ? AND kind = ? AND src_id = ?", (job, kind, src_id))
+        else:
+            self._db.execute(
+                "UPDATE units SET status = 'done', id_map = ?, dest_root = ?, updated = ? "
+                "WHERE job = ? AND kind = ? AND src_id = ?",
+                (json.dumps(id_map), dest_root, time.time(), job, kind, src_id),
+            )
+            self._mark(job, kind, thread, max(id_map.values()))
+        self._db.commit()
+
+    def entries(self, job: str, kind: str, status: str) -> list[Entry]:
+        rows = self._db.execute(
+            "SELECT kind, src_id, thread, dest_thread, src_ids, root, key, media, status, id_map, dest_root, "
+            "sigs, label, label_id FROM units WHERE job = ? AND kind = ? AND status = ? ORDER BY thread, src_id",
+            (job, kind, status),
+        ).fetchall()
+        return [
+            Entry(kind=r[0], src_id=r[1], thread=r[2], dest_thread=r[3], src_ids=json.loads(r[4]), root=r[5],
+                  key=r[6], media=r[7], status=r[8], id_map={int(k): v for k, v in json.loads(r[9]).items()},
+                  dest_root=r[10], sigs=json.loads(r[11]), label=r[12], label_id=r[13])
+            for r in rows
+        ]
+
+    def mark(self, job: str, kind: str, thread: int = 0) -> int:
+        """Последний известный id назначения, отправленный этой парой (в треде), 0 — неизвестен."""
+        row = self._db.execute(
+            "SELECT dest_id FROM marks WHERE job = ? AND kind = ? AND thread = ?", (job, kind, thread)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def drop(self, job: str, entries: list[Entry]) -> None:
+        self._db.executemany(
+            "DELETE FROM units WHERE job = ? AND kind = ? AND src_id = ?",
+            [(job, e.kind, e.src_id) for e in entries],
+        )
+        self._db.commit()
+
+    def prune(self, job: str, before: float) -> None:
+        """
+        Удаляет done-записи, которые state уже сохранил (state.flush() начат после before),
+        кроме последних KEEP_DONE каждого kind (см. claimed).
+        """
+        for (kind,) in self._db.execute("SELECT DISTINCT kind FROM units WHERE job = ?", (job,)).fetchall():
+            self._db.execute(
+                "DELETE FROM units WHERE job = ? AND kind = ? AND status = 'done' AND updated <= ? "
+                "AND src_id NOT IN (SELECT src_id FROM units WHERE job = ? AND kind = ? AND status = 'done' "
+                "ORDER BY updated DESC LIMIT ?)",
+                (job, kind, before, job, kind, KEEP_DONE),
+            )
+        self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _mark(self, job: str, kind: str, thread: int, dest_id: int) -> None:
+        self._db.execute(
+            "INSERT INTO marks (job, kind, thread, dest_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(job, kind, thread) DO UPDATE SET dest_id = max(dest_id, excluded.dest_id)",
+            (job, kind, thread, dest_id),
+        )
+
+
+def _peer(dest) -> int:
+    return utils.get_peer_id(dest) if dest is not None else 0
+
+
+def _apply(state: StateStore, e: Entry) -> None:
+    """Переносит отправленный юнит в state — так же, как это делают pipeline/CommentCopier."""
+    state.record_ids(e.kind, e.id_map)
+    if e.kind == "post":
+        state.register_thread(e.root, e.dest_root or min(e.id_map.values()))
+        state.update_last_seen(max(state.get_last_seen() or 0, e.src_max_id))
+    else:
+        state.update_comment_watermark(e.thread, max(state.comment_watermark(e.thread), e.src_max_id))
+
+
+def _match(e: Entry, candidates: list, start: int) -> tuple[dict[int, int], int] | None:
+    """
+    Ищет юнит среди сообщений назначения (по возрастанию id) начиная с start:
+    по тексту/подписи и приметам каждого медиа (media_sig). Возвращает (id_map, следующая позиция).
+    """
+    for i in range(start, len(candidates)):
+        m = candidates[i]
+        if e.key and not _text_matches(e.key, m.message):
+            continue
+        if not e.key and not (e.media and is_real_media(m)):
+            continue
+
+        gid = getattr(m, "grouped_id", None)
+        group = [x for x in candidates if getattr(x, "grouped_id", None) == gid] if gid is not None else [m]
+        if not _media_matches(e, group):
+            continue
+        if gid is None:
+            return {e.src_ids[0] if len(e.src_ids) == 1 else e.root: m.id}, i + 1
+        id_map = dict(zip(e.src_ids, (x.id for x in group)))
+        id_map.setdefault(e.root, group[0].id)
+        return id_map, candidates.index(group[-1]) + 1
+    return None
+
+
+def _text_matches(key: str, text: str | None) -> bool:
+    text = (text or "").strip()
+    if _same_start(key, text):
+        return True
+    # комментарий с подписью автора inline: "label:\nтекст"
+    head, sep, body = text.partition("\n")
+    return bool(sep) and head.endswith(":") and _same_start(key, body.strip())
+
+
+def _same_start(key: str, text: str) -> bool:
+    # короткий ключ — весь текст ("+", "👍" не должны совпадать с любым сообщением, где они встречаются);
+    # обрезанный — начало текста (длинный пост мог уйти несколькими сообщениями)
+    return text == key or (len(key) >= KEY_LEN and text.startswith(key))
+
+
+def _media_matches(e: Entry, group: list) -> bool:
+    media = [m for m in group if is_real_media(m)]
+    if not e.sigs:
+        return bool(media) == bool(e.media)  # запись без примет (журнал старой версии)
+    return len(media) == len(e.sigs) and all(_same_media(s, m) for s, m in zip(e.sigs, media))
+
+
+def _same_media(sig: dict, m) -> bool:
+    obj = getattr(m.media, "photo", None) or getattr(m.media, "document", None)
+    if sig["id"] and getattr(obj, "id", None) == sig["id"]:
+        return True  # отправлено по handle
+    f = m.file
+    if f is None:
+        return False
+    if sig["name"] and os.path.splitext(f.name or "")[0] != sig["name"]:
+        return False
+    if sig["size"]:
+        return f.size == sig["size"]
+    return _same_shape(sig["w"], sig["h"], f.width or 0, f.height or 0)
+
+
+def _same_shape(w: int, h: int, cw: int, ch: int) -> bool:
+    if not (w and h and cw and ch):
+        return True  # размеры неизвестны — решают текст, имя и порядок
+    if cw > w + 2 or ch > h + 2:
+        return False  # перезалитое не бывает больше исходника
+    return abs(cw / ch - w / h) <= SHAPE_TOLERANCE * (w / h)
+
+
+def _sent_labels(journal: Journal, job: str, kind: str, lost: list[Entry], sent: list, tail: list) -> list[Entry]:
+    """Ненайденные юниты, подпись автора которых уже в назначении (по id или, если ответ не дошёл, по тексту)."""
+    sent_ids = {m.id for m in sent}
+    used: set[int] = set()
+    kept = []
+    for e in lost:
+        if e.label and not e.label_id:
+            e.label_id = next((m.id for m in tail if m.id not in used and not is_real_media(m)
+                               and (m.message or "").strip() == e.label), 0)
+            if e.label_id:
+                journal.label(job, kind, e.src_id, e.label, e.label_id)
+        if e.label_id in sent_ids:
+            used.add(e.label_id)
+            kept.append(e)
+    return kept
+
+
+async def reconcile(journal: Journal, client: TelegramClient, dest, state: StateStore, *, job: str, kind: str,
+                    policy: RetryPolicy | None = None) -> int:
+    """
+    Сверка после рестарта для одного kind.
+    done — переносятся в state (могли не успеть сохраниться до падения);
+    pending — ищутся в назначении после последнего известного id: найденные считаются отправленными,
+    начиная с первого ненайденного (и дальше по треду) — удаляются из журнала и будут отправлены заново
+    (кроме тех, чья подпись автора уже ушла: запись остаётся, и повтор подпись не отправит).
+    Возвращает число юнитов, которые не пришлось отправлять повторно.
+    """
+    for e in journal.entries(job, kind, "done"):
+        _apply(state, e)
+
+    pending = journal.entries(job, kind, "pending")
+    threads: dict[tuple[int, int], list[Entry]] = {}
+    for e in pending:
+        threads.setdefault((e.thread, e.dest_thread), []).append(e)
+
+    limiter = policy.limiter if policy is not None else None
+    claimed = journal.claimed(kind, dest)
+    recovered = 0
+    for (thread, dest_thread), entries in threads.items():
+        after = journal.mark(job, kind, thread)
+        kw = {"reply_to": dest_thread} if kind == "comment" else {}
+        history = client.iter_messages(dest, min_id=after, limit=None if after else RECONCILE_SCAN, **kw)
+        sent = [m async for m in paced_history(history, limiter)]
+        # сообщения других пар в том же DEST и подписи авторов своими юнитами не бывают
+        candidates = sorted((m for m in sent if m.id not in claimed), key=lambda m: m.id)
+
+        pos = 0
+        found: list[Entry] = []
+        for e in entries:
+            hit = _match(e, candidates, pos)
+            if hit is None:
+                break
+            e.id_map, pos = hit
+            e.dest_root = e.id_map.get(e.root, min(e.id_map.values()))
+            found.append(e)
+
+        for e in found:
+            log.info("journal | %s %s src_id=%s already sent -> %s", job, kind, e.src_id, e.id_map)
+            journal.commit(job, kind, e.src_id, e.id_map, dest_root=e.dest_root, thread=thread)
+            _apply(state, e)
+        lost = entries[len(found):]
+        for e in lost:
+            log.info("journal | %s %s src_id=%s not found in dest, will be sent again", job, kind, e.src_id)
+        # подпись автора ушла, а сам юнит нет: запись остаётся, повтор отправит только содержимое
+        kept = _sent_labels(journal, job, kind, lost, sent, candidates[pos:])
+        journal.drop(job, [e for e in lost if e not in kept])
+        recovered += len(found)
+
+    flushed_at = time.time()
+    state.flush()
+    journal.prune(job, flushed_at)
+    return recovered
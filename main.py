@@ -4,143 +4,213 @@ import logging
 
 from config import Config
 from logging_setup import setup_logging
-from state import EnvStateStore
+from state import EnvStateStore, SqliteStateStore
 from telegram_factory import create_client
-from copier import PostCopier
-from comments import CommentCopier
+from sync import SourceSync
+from daemon import run_daemon
+from jobs import load_jobs, run_jobs
+from upload_cache import UploadCache
+from authors import AuthorCache
+import metrics
+from ratelimit import RateLimiter
+from journal import Journal
+from pool import SessionPool, load_sessions, open_pool, poster_session
+from archive import export_archive, open_reader
+from recompress import open_executor
 
 log = logging.getLogger("tg_sync.main")
 
 
-async def run():
-    cfg = Config.load()
+async def run(cfg: Config | None = None, client=None, pool: SessionPool | None = None):
+    """
+    client — готовый клиент вместо create_client(cfg) (например, fake_telegram для bench.py),
+    pool — готовый пул читающих аккаунтов вместо TG_SESSIONS_FILE.
+    """
+    if cfg is None:
+        cfg = Config.load()
     setup_logging(cfg.log_level, cfg.log_file)
 
-    log.info("start | source=%s dest=%s last_seen=%s overlap=%s limit=%s sync_comments=%s",
-             cfg.source, cfg.dest, cfg.last_seen_id, cfg.overlap, cfg.limit, cfg.sync_comments)
-
-    state = EnvStateStore(cfg.dotenv_path)
-
-    client = create_client(cfg)
+    metrics.TMP_DISK_BYTES.set_function(lambda: metrics.dir_size(cfg.tmp_dir))
+    if cfg.archive_mode != "off" and cfg.daemon:
+        raise RuntimeError("TG_ARCHIVE_MODE работает только разовым запуском, без TG_DAEMON")
+    server = await metrics.serve(cfg.metrics_host, cfg.metrics_port) if cfg.metrics_port else None
+    try:
+        if cfg.archive_mode == "export":
+            await run_export(cfg, client, pool)
+        elif cfg.jobs_file:
+            await run_many(cfg, client, pool)
+        else:
+            await run_single(cfg, client, pool)
+    finally:
+        metrics.log_summary()
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+
+async def run_single(cfg: Config, client=None, pool: SessionPool | None = None):
+    if cfg.sync_comments and cfg.comments_mode == "group" and cfg.state_backend != "sqlite":
+        # в .env карта постов не сохраняется: после рестарта комментарии к старым постам не к чему привязать
+        raise RuntimeError("TG_COMMENTS_MODE=group требует TG_STATE_BACKEND=sqlite")
+    if cfg.edits_recheck > 0 and cfg.state_backend != "sqlite":
+        # отпечатки постов в .env не сохраняются: между запусками правки не с чем сравнить
+        raise RuntimeError("TG_EDITS_RECHECK требует TG_STATE_BACKEND=sqlite")
+    if cfg.state_backend == "sqlite":
+        state = SqliteStateStore(cfg.state_db, source=cfg.job_name)
+    else:
+        state = EnvStateStore(cfg.dotenv_path)
+    stored = state.get_last_seen()
+    last_seen = cfg.last_seen_id if stored is None else stored
+
+    log.info("start | source=%s dest=%s last_seen=%s overlap=%s limit=%s sync_comments=%s copy_mode=%s workers=%s depth=%s daemon=%s",
+             cfg.source, cfg.dest, last_seen, cfg.overlap, cfg.limit, cfg.sync_comments, cfg.copy_mode,
+             cfg.workers, cfg.queue_depth, cfg.daemon)
+
+    upload_cache = open_upload_cache(cfg)
+    authors = AuthorCache(cfg.author_cache)
+    limiter = RateLimiter(cfg.rate_limits)
+    journal = Journal(cfg.journal) if cfg.journal else None
+    reader = open_reader(cfg) if cfg.archive_mode == "replay" else None
+    recompress_pool = open_recompress_pool(cfg, [cfg])
+    client, pool = open_clients(cfg, client, pool)
     await client.start()
+    if pool is not None:
+        await pool.start()
 
     try:
-        src = await client.get_entity(cfg.source)
+        src = reader.entity if reader is not None else await client.get_entity(cfg.source)
         dst = await client.get_entity(cfg.dest)
 
-        copier = PostCopier(
-            client,
-            tmp_dir=cfg.tmp_dir,
-            cleanup=cfg.cleanup,
-            link_preview=cfg.link_preview,
-            force_document=cfg.force_document,
-        )
-
-        comment_copier = CommentCopier(
-            client,
-            limit=cfg.comments_limit,
-            include_author=cfg.comments_include_author,
-            tmp_dir=cfg.tmp_dir,
-            cleanup=cfg.cleanup,
-        )
-
-        current_last_seen = cfg.last_seen_id
-        min_id = max(cfg.last_seen_id - cfg.overlap, 0)
-
-        current_gid = None
-        album_msgs = []
-
-        scanned = 0
-        copied_units = 0
-
-        async for m in client.iter_messages(src, min_id=min_id, limit=cfg.limit, reverse=True):
-            scanned += 1
-            gid = getattr(m, "grouped_id", None)
-
-            log.debug("scan #%s | id=%s gid=%s new=%s", scanned, m.id, gid, m.id > current_last_seen)
-
-            if gid is not None:
-                if current_gid is None:
-                    current_gid = gid
-                    album_msgs = [m]
-                elif gid == current_gid:
-                    album_msgs.append(m)
-                else:
-                    # закрыть прошлый альбом
-                    src_max = max(x.id for x in album_msgs)
-                    if src_max > current_last_seen:
-                        res = await copier.copy_album(dst, album_msgs)
-                        if res:
-                            copied_units += 1
-                            current_last_seen = max(current_last_seen, res.src_max_id)
-                            state.update_last_seen(current_last_seen)
-
-                            if cfg.sync_comments:
-                                await comment_copier.copy_comments_for_post(
-                                    src, dst,
-                                    src_post_id=res.src_root_post_id,  # <-- ВАЖНО
-                                    dest_post_id=res.dest_root_post_id
-                                )
-                    current_gid = gid
-                    album_msgs = [m]
-
-            else:
-                # если был альбом — закрыть
-                if current_gid is not None:
-                    src_max = max(x.id for x in album_msgs)
-                    if src_max > current_last_seen:
-                        res = await copier.copy_album(dst, album_msgs)
-                        if res:
-                            copied_units += 1
-                            current_last_seen = max(current_last_seen, res.src_max_id)
-                            state.update_last_seen(current_last_seen)
-
-                            if cfg.sync_comments:
-                                await comment_copier.copy_comments_for_post(
-                                    src, dst,
-                                    src_post_id=res.src_root_post_id,  # <-- ВАЖНО
-                                    dest_post_id=res.dest_root_post_id
-                                )
-                    current_gid = None
-                    album_msgs = []
-
-                # одиночное сообщение
-                if m.id > current_last_seen:
-                    res = await copier.copy_single(dst, m)
-                    if res:
-                        copied_units += 1
-                        current_last_seen = max(current_last_seen, res.src_max_id)
-                        state.update_last_seen(current_last_seen)
-
-                        if cfg.sync_comments:
-                            await comment_copier.copy_comments_for_post(src, dst, src_post_id=m.id, dest_post_id=res.dest_root_post_id)
-
-            if scanned % 20 == 0:
-                log.info("progress | scanned=%s copied_units=%s last_seen=%s", scanned, copied_units, current_last_seen)
-
-        # финальный альбом
-        if current_gid is not None and album_msgs:
-            src_max = max(x.id for x in album_msgs)
-            if src_max > current_last_seen:
-                res = await copier.copy_album(dst, album_msgs)
-                if res:
-                    copied_units += 1
-                    current_last_seen = max(current_last_seen, res.src_max_id)
-                    state.update_last_seen(current_last_seen)
-
-                    if cfg.sync_comments:
-                        await comment_copier.copy_comments_for_post(
-                            src, dst,
-                            src_post_id=res.src_root_post_id,  # <-- ВАЖНО
-                            dest_post_id=res.dest_root_post_id
-                        )
-        log.info("done | scanned=%s copied_units=%s last_seen=%s", scanned, copied_units, current_last_seen)
+        sync = SourceSync(client, cfg, state, src=src, dst=dst, last_seen=last_seen,
+                          upload_cache=upload_cache, authors=authors, limiter=limiter, journal=journal, pool=pool,
+                          source_client=reader, recompress_pool=recompress_pool)
+        if cfg.daemon:
+            await run_daemon(sync)
+        else:
+            await sync.run_once()
+        sync.log_summary()
+
+    finally:
+        state.close()
+        close_upload_cache(upload_cache)
+        close_authors(authors)
+        log.info("rate limit | %s", limiter.summary())
+        if journal is not None:
+            journal.close()
+        if reader is not None:
+            reader.close()
+        close_recompress_pool(recompress_pool)
+        await close_pool(pool)
+        await client.disconnect()
+        log.info("disconnected")
+
+
+async def run_many(cfg: Config, client=None, pool: SessionPool | None = None):
+    if cfg.state_backend != "sqlite":
+        raise RuntimeError("TG_JOBS_FILE требует TG_STATE_BACKEND=sqlite (состояние хранится по каждой паре)")
+    jobs = load_jobs(cfg.jobs_file, cfg)
+    log.info("start | jobs=%s file=%s concurrency=%s daemon=%s", len(jobs), cfg.jobs_file, cfg.jobs_concurrency, cfg.daemon)
+
+    upload_cache = open_upload_cache(cfg)
+    authors = AuthorCache(cfg.author_cache)
+    limiter = RateLimiter(cfg.rate_limits)
+    journal = Journal(cfg.journal) if cfg.journal else None
+    recompress_pool = open_recompress_pool(cfg, jobs)
+    client, pool = open_clients(cfg, client, pool)
+    await client.start()
+    if pool is not None:
+        await pool.start()
+    try:
+        await run_jobs(client, jobs, concurrency=cfg.jobs_concurrency,
+                       upload_cache=upload_cache, authors=authors, limiter=limiter, journal=journal, pool=pool,
+                       recompress_pool=recompress_pool)
+    finally:
+        close_recompress_pool(recompress_pool)
+        close_upload_cache(upload_cache)
+        close_authors(authors)
+        log.info("rate limit | %s", limiter.summary())
+        if journal is not None:
+            journal.close()
+        await close_pool(pool)
+        await client.disconnect()
+        log.info("disconnected")
+
 
+async def run_export(cfg: Config, client=None, pool: SessionPool | None = None):
+    """TG_ARCHIVE_MODE=export: источник (или все источники TG_JOBS_FILE) дописывается в локальный архив."""
+    jobs = load_jobs(cfg.jobs_file, cfg) if cfg.jobs_file else [cfg]
+    # у источника один архив, сколько бы назначений у него ни было
+    sources: dict[str, Config] = {}
+    for job in jobs:
+        sources.setdefault(job.source, job)
+    log.info("start | archive export | sources=%s dir=%s limit=%s sync_comments=%s",
+             len(sources), cfg.archive_dir, cfg.limit, cfg.sync_comments)
+
+    limiter = RateLimiter(cfg.rate_limits)
+    client, pool = open_clients(cfg, client, pool)
+    await client.start()
+    if pool is not None:
+        await pool.start()
+    try:
+        for job in sources.values():
+            await export_archive(client, job, limiter=limiter, pool=pool)
     finally:
+        log.info("rate limit | %s", limiter.summary())
+        await close_pool(pool)
         await client.disconnect()
         log.info("disconnected")
 
 
+def open_clients(cfg: Config, client=None, pool: SessionPool | None = None):
+    """Публикующий клиент и пул читающих аккаунтов (TG_SESSIONS_FILE), если их не передали готовыми."""
+    if client is not None:
+        return client, pool
+    sessions = load_sessions(cfg.sessions_file) if cfg.sessions_file else []
+    poster = poster_session(cfg, sessions)
+    # FloodWait не пересыпается внутри Telethon: его ловит safe_call, и лимитер ставит общую паузу
+    # и снижает скорость (иначе каждая корутина молча ждёт сама, а RateLimiter о флуде не узнаёт)
+    client = create_client(cfg, poster, flood_sleep_threshold=0)
+    return client, pool or open_pool(cfg, sessions, poster=poster)
+
+
+async def close_pool(pool: SessionPool | None) -> None:
+    if pool is not None:
+        log.info("pool | %s", pool.summary())
+        await pool.close()
+
+
+def open_recompress_pool(cfg: Config, jobs: list[Config]):
+    """Пул процессов пересжатия медиа (TG_RECOMPRESS), если он нужен хоть одной паре."""
+    if not any(job.recompress for job in jobs):
+        return None
+    if cfg.transfer_mode != "disk":
+        log.warning("recompress | TG_RECOMPRESS works with TG_TRANSFER_MODE=disk only, disabled")
+        return None
+    return open_executor(cfg.recompress_workers)
+
+
+def close_recompress_pool(executor) -> None:
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
+
+
+def open_upload_cache(cfg: Config) -> UploadCache | None:
+    if cfg.upload_cache is None:
+        return None
+    return UploadCache(cfg.upload_cache, max_entries=cfg.upload_cache_max, ttl=cfg.upload_cache_ttl)
+
+
+def close_upload_cache(upload_cache: UploadCache | None) -> None:
+    if upload_cache is not None:
+        log.info("upload cache | %s", upload_cache.summary())
+        upload_cache.close()
+
+
+def close_authors(authors: AuthorCache) -> None:
+    log.info("authors | %s", authors.summary())
+    authors.close()
+
+
 def main():
     asyncio.run(run())
 
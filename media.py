@@ -0,0 +1,465 @@
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from telethon import TelegramClient, errors
+from telethon.tl.types import MessageMediaDocument, MessageMediaPhoto
+
+from metrics import BYTES_DOWNLOADED, BYTES_UPLOADED, file_size
+from pool import SessionPool
+from recompress import Recompressed, Recompressor, recompressed_media, recompressed_name
+from retry import safe_call, RetryPolicy
+from transfer import download_parallel, media_name, media_size, stream_media, upload_parallel, uploaded_media
+from upload_cache import UploadCache, bytes_digest, file_digest, source_key
+
+log = logging.getLogger("tg_sync.media")
+
+# Ошибки, при которых Telegram не принимает чужой handle — тогда качаем и грузим заново
+HANDLE_FALLBACK_ERRORS = (
+    errors.FileReferenceExpiredError,
+    errors.FileReferenceInvalidError,
+    errors.ChatForwardsRestrictedError,
+    errors.MediaEmptyError,
+)
+
+
+def media_handle(msg, force_document: bool):
+    """
+    MessageMedia, который можно переотправить как есть (без скачивания), или None.
+    Фото с force_document так не отправить — его нужно перезалить документом.
+    """
+    if getattr(msg, "noforwards", False):
+        return None
+    media = msg.media
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return media
+    if isinstance(media, MessageMediaPhoto) and media.photo and not force_document:
+        return media
+    return None
+
+
+@dataclass
+class TransferStats:
+    zero_copy_units: int = 0  # отправлено по handle, без скачивания
+    reupload_units: int = 0   # скачано и загружено заново (через диск или в памяти)
+    cached_units: int = 0     # отправлено по handle из UploadCache, без скачивания
+
+
+@dataclass
+class PreparedMedia:
+    msgs: list
+    files: list | None = None  # пути (disk) или InputMedia (memory); None — пробовать отправку по handle
+    digests: dict[int, str] = field(default_factory=dict)  # m.id -> хэш содержимого (для UploadCache)
+    cached: dict[int, str] = field(default_factory=dict)  # m.id -> ключ UploadCache, если в files его handle
+    recompressed: dict[int, Recompressed] = field(default_factory=dict)  # m.id -> пересжатый файл
+
+
+class MediaSender:
+    """
+    Отправка медиа одного юнита (одиночное сообщение или альбом):
+    сначала по существующему handle, при отказе Telegram — download + re-upload.
+    Re-upload идёт через tmp_dir (transfer_mode="disk") или целиком в памяти (transfer_mode="memory"):
+    мелкие файлы качаются в bytes, крупные стримятся частями через буфер не больше stream_buffer байт.
+    Файлы от parallel_min байт качаются частями по download_parts одновременно (transfer.download_parallel),
+    от parallel_upload_min — так же загружаются, по upload_parts частей (transfer.upload_parallel).
+    С readers (pool.SessionPool) файлы качаются читающими аккаунтами пула, загружаются — своим клиентом.
+    source_client/source_policy — откуда качать без пула (например, archive.ArchiveReader), по умолчанию client.
+    С recompressor (disk) скачанные картинки и короткие видео перед загрузкой пересжимаются;
+    пересжатые файлы в upload_cache не попадают: кэш общий для заданий с разными настройками пересжатия.
+    С upload_cache уже загруженные файлы (тот же id в источнике или то же содержимое)
+    отправляются по сохранённому handle; протухший handle выкидывается из кэша и файл перезаливается.
+    """
+
+    def __init__(self, client: TelegramClient, *, tmp_dir: Path, cleanup: bool, force_document: bool,
+                 policy: RetryPolicy | None = None, transfer_mode: str = "disk",
+                 stream_small: int = 10 * 1024 * 1024, stream_buffer: int = 16 * 1024 * 1024,
+                 item_concurrency: int = 4, upload_cache: UploadCache | None = None,
+                 parallel_min: int = 0, download_parts: int = 4, parallel_upload_min: int = 0,
+                 upload_parts: int = 4, readers: SessionPool | None = None, source_client=None,
+                 source_policy: RetryPolicy | None = None, recompressor: Recompressor | None = None):
+        self.client = client
+        self.tmp_dir = tmp_dir
+        self.cleanup = cleanup
+        self.force_document = force_document
+        self.policy = policy or RetryPolicy()
+        self.transfer_mode = transfer_mode
+        self.stream_small = stream_small
+        self.stream_buffer = stream_buffer
+        self.parallel_min = parallel_min  # 0 — крупные файлы качаются одним потоком
+        self.download_parts = download_parts
+        self.parallel_upload_min = parallel_upload_min  # 0 — крупные файлы загружает сам Telethon, по одной части
+        self.upload_parts = upload_parts
+        self.readers = readers
+        self.source_client = source_client or client
+        self.source_policy = source_policy or self.policy
+        # общий лимит одновременных скачиваний элементов (альбомы качаются параллельно)
+        self._item_slots = asyncio.Semaphore(max(1, item_concurrency))
+        self.upload_cache = upload_cache
+        self.recompressor = recompressor
+        self.stats = TransferStats()
+
+    async def prepare(self, msgs: list, *, ctx: str) -> PreparedMedia:
+        """
+        Заранее готовит медиа к отправке (prefetch): если переотправка по handle невозможна,
+        скачивает (disk) или сразу загружает (memory) файлы. Handle-путь и попадание в кэш ничего не качают.
+        """
+        if all(media_handle(m, self.force_document) is not None for m in msgs):
+            return PreparedMedia(msgs)
+        return await self._reupload(msgs, ctx=ctx)
+
+    def release(self, prepared: PreparedMedia | None) -> None:
+        if prepared is not None and prepared.files:
+            self._remove(prepared.files)
+
+    async def send(self, dest, msgs: list, *, ctx: str, prepared: PreparedMedia | None = None, **kwargs):
+        """
+        msgs — сообщения с медиа в порядке отправки; kwargs уходят в send_file
+        (caption, formatting_entities, comment_to, ...). Возвращает результат send_file.
+        prepared — результат prepare() для этих же msgs, если медиа готовили заранее.
+        """
+        if prepared is None or prepared.files is None:
+            handles = [media_handle(m, self.force_document) for m in msgs]
+            if all(h is not None for h in handles):
+                try:
+                    sent = await safe_call(
+                        lambda: self.client.send_file(
+                            dest,
+                            handles if len(handles) > 1 else handles[0],
+                            force_document=self.force_document,
+                            **kwargs,
+                        ),
+                        ctx=f"{ctx} send_handle",
+                        policy=self.policy,
+                        kind="send_file",
+                    )
+                    self.stats.zero_copy_units += 1
+                    return sent
+                except HANDLE_FALLBACK_ERRORS as e:
+                    log.info("%s: handle rejected (%s), fallback to download", ctx, type(e).__name__)
+            else:
+                log.debug("%s: no reusable handle, download", ctx)
+
+            prepared = await self._reupload(msgs, ctx=ctx)
+
+        try:
+            try:
+                sent = await self._send_files(dest, prepared.msgs, prepared.files, ctx=ctx,
+                                              recompressed=prepared.recompressed, **kwargs)
+            except HANDLE_FALLBACK_ERRORS as e:
+                if not prepared.cached:
+                    raise
+                # file_reference из кэша протух — забываем handle и перезаливаем честно
+                log.info("%s: cached handle rejected (%s), re-upload", ctx, type(e).__name__)
+                self._evict(prepared)
+                self._remove(prepared.files)
+                prepared = await self._reupload(msgs, ctx=ctx, use_cache=False)
+                sent = await self._send_files(dest, prepared.msgs, prepared.files, ctx=ctx,
+                                              recompressed=prepared.recompressed, **kwargs)
+        finally:
+            self._remove(prepared.files)
+
+        if len(prepared.cached) == len(msgs):
+            self.stats.cached_units += 1
+        else:
+            self.stats.reupload_units += 1
+            self._remember(prepared, sent)
+        return sent
+
+    async def edit(self, dest, dest_id: int, m, *, ctx: str, **kwargs):
+        """
+        Заменяет медиа уже отправленного сообщения dest_id на медиа m (пост в источнике правили):
+        по handle, при отказе Telegram — download + re-upload. kwargs уходят в edit_message (text, formatting_entities).
+        """
+        handle = media_handle(m, self.force_document)
+        if handle is not None:
+            try:
+                return await safe_call(
+                    lambda: self.client.edit_message(dest, dest_id, file=handle, force_document=self.force_document,
+                                                     **kwargs),
+                    ctx=f"{ctx} edit_handle",
+                    policy=self.policy,
+                    kind="send_file",
+                )
+            except HANDLE_FALLBACK_ERRORS as e:
+                log.info("%s: handle rejected (%s), fallback to download", ctx, type(e).__name__)
+
+        # handle из кэша мог протухнуть, а правка редкая — перезаливаем честно
+        prepared = await self._reupload([m], ctx=ctx, use_cache=False)
+        try:
+            file = await self._upload_path(m, prepared.files[0], ctx=ctx, recompressed=prepared.recompressed)
+            return await safe_call(
+                lambda: self.client.edit_message(dest, dest_id, file=file,
+                                                 force_document=self.force_document, **kwargs),
+                ctx=f"{ctx} edit_file",
+                policy=self.policy,
+                kind="send_file",
+            )
+        finally:
+            self._remove(prepared.files)
+
+    async def _send_files(self, dest, msgs: list, files: list, *, ctx: str,
+                          recompressed: dict[int, Recompressed] | None = None, **kwargs):
+        # крупные и пересжатые файлы с диска загружаем сами; остальные пути Telethon загружает
+        # внутри send_file; InputMedia уже загружены или взяты из кэша
+        recompressed = recompressed or {}
+        if any(isinstance(f, str) and (m.id in recompressed or self._upload_size(m)) for m, f in zip(msgs, files)):
+            files = await self._gather_items(list(zip(msgs, files)),
+                                              lambda mf: self._upload_path(*mf, ctx=ctx, recompressed=recompressed))
+        upload_bytes = sum(file_size(f) for f in files if isinstance(f, str))
+        sent = await safe_call(
+            lambda: self.client.send_file(
+                dest,
+                files if len(files) > 1 else files[0],
+                force_document=self.force_document,
+                **kwargs,
+            ),
+            ctx=f"{ctx} send_file files={len(files)}",
+            policy=self.policy,
+            kind="send_file",
+        )
+        BYTES_UPLOADED.inc(upload_bytes)
+        return sent
+
+    async def _upload_path(self, m, f, *, ctx: str, recompressed: dict[int, Recompressed]):
+        if not isinstance(f, str):
+            return f
+        if m.id in recompressed:
+            return await self._upload_recompressed(m, recompressed[m.id], ctx=ctx)
+        size = self._upload_size(m)
+        if not size:
+            return f
+        input_file = await upload_parallel(self.client, f, size=size, name=media_name(m), parts=self.upload_parts,
+                                           ctx=f"{ctx} m={m.id}", policy=self.policy)
+        return uploaded_media(m, input_file, self.force_document)
+
+    async def _upload_recompressed(self, m, rc: Recompressed, *, ctx: str):
+        # атрибуты исходного сообщения с размерами результата (recompress.recompressed_media)
+        ctx = f"{ctx} m={m.id}"
+        size = file_size(rc.path)
+        name = recompressed_name(m, rc)
+        if self.parallel_upload_min and size >= self.parallel_upload_min:
+            input_file = await upload_parallel(self.client, rc.path, size=size, name=name, parts=self.upload_parts,
+                                               ctx=ctx, policy=self.policy)
+        else:
+            input_file = await safe_call(
+                lambda: self.client.upload_file(rc.path, file_name=name),
+                ctx=f"{ctx} upload",
+                policy=self.policy,
+                kind="upload",
+            )
+            BYTES_UPLOADED.inc(size)
+        return recompressed_media(m, input_file, rc, self.force_document)
+
+    def _evict(self, prepared: PreparedMedia) -> None:
+        for key in prepared.cached.values():
+            self.upload_cache.evict(key)
+
+    def _remember(self, prepared: PreparedMedia, sent) -> None:
+        if self.upload_cache is None:
+            return
+        sent_list = sent if isinstance(sent, list) else [sent]
+        # send_file возвращает сообщения в порядке отправки
+        for m, s in zip(prepared.msgs, sent_list):
+            # пересжатое зависит от настроек задания — под ключом исходника его получили бы и другие задания
+            if m.id not in prepared.cached and m.id not in prepared.recompressed:
+                self.upload_cache.store(m, s, prepared.digests.get(m.id))
+
+    async def _reupload(self, msgs: list, *, ctx: str, use_cache: bool = True) -> PreparedMedia:
+        """
+        Файлы для send_file: пути (disk) или InputMedia (memory).
+        При use_cache элементы, уже загруженные ранее, берутся из UploadCache —
+        по id в источнике ещё до скачивания, по хэшу содержимого — после.
+        """
+        cache = self.upload_cache if use_cache else None
+        prepared = PreparedMedia(msgs)
+
+        if self.transfer_mode == "memory":
+            async def fetch(m):
+                return self._cached(m, cache, prepared) or await self._upload_in_memory(
+                    m, ctx=ctx, cache=cache, prepared=prepared)
+
+            prepared.files = await self._gather_items(msgs, fetch)
+            return prepared
+
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        paths: dict[int, str] = {}
+
+        async def download(m):
+            h = self._cached(m, cache, prepared)
+            if h is not None:
+                return h
+            paths[m.id] = self._tmp_path(m)
+            path = await self.download_file(m, paths[m.id], ctx=ctx)
+            if self.upload_cache is not None:
+                digest = await asyncio.to_thread(file_digest, path)
+                h = self._cached_digest(m, digest, cache, prepared)
+                if h is not None:
+                    self._remove([path], force=True)
+                    return h
+            return await self._recompress(m, path, ctx=ctx, prepared=prepared)
+
+        try:
+            prepared.files = await self._gather_items(msgs, download)
+            return prepared
+        except BaseException:
+            # недокачанные файлы Telethon не удаляет — чистим по заранее известным путям
+            self._remove(list(paths.values()) + [rc.path for rc in prepared.recompressed.values()], force=True)
+            raise
+
+    def _tmp_path(self, m) -> str:
+        # у каждого файла свой каталог: задания с общим TG_TMP_DIR (и один пост, идущий в два DEST)
+        # не пишут в один путь, а файл уходит в DEST под исходным именем
+        item_dir = tempfile.mkdtemp(prefix=f"{abs(m.chat_id or 0)}_{m.id}_", dir=self.tmp_dir)
+        return os.path.join(item_dir, os.path.basename(media_name(m)))
+
+    async def _recompress(self, m, path: str, *, ctx: str, prepared: PreparedMedia) -> str:
+        if self.recompressor is None:
+            return path
+        rc = await self.recompressor.apply(m, path, ctx=f"{ctx} m={m.id}")
+        if rc is None:
+            return path
+        prepared.recompressed[m.id] = rc
+        self._remove([path], force=True)
+        return rc.path
+
+    async def download_file(self, m, path: str, *, ctx: str) -> str:
+        """Скачивание медиа m в path: крупные файлы частями, с пулом — читающим аккаунтом."""
+        size = self._parallel_size(m)
+
+        async def fetch(client, msg, policy):
+            if size:
+                return await download_parallel(client, msg, size=size, parts=self.download_parts,
+                                               ctx=f"{ctx} m={m.id}", policy=policy, path=path)
+            done = await safe_call(
+                lambda: client.download_media(msg, file=path),
+                ctx=f"{ctx} download m={m.id}",
+                policy=policy,
+                kind="download",
+            )
+            BYTES_DOWNLOADED.inc(file_size(done))
+            return done
+
+        return await self._download(m, fetch, ctx=f"{ctx} m={m.id}")
+
+    def _cached(self, m, cache: UploadCache | None, prepared: PreparedMedia):
+        if cache is None:
+            return None
+        h = cache.lookup(m, self.force_document)
+        if h is not None:
+            prepared.cached[m.id] = source_key(m)
+        return h
+
+    def _cached_digest(self, m, digest: str, cache: UploadCache | None, prepared: PreparedMedia):
+        prepared.digests[m.id] = digest
+        if cache is None:
+            return None
+        h = cache.lookup_digest(digest, self.force_document, size=media_size(m))
+        if h is not None:
+            prepared.cached[m.id] = digest
+        return h
+
+    async def _gather_items(self, msgs: list, fetch) -> list:
+        """Параллельно (под item_slots) обрабатывает элементы; результат — в порядке msgs."""
+        async def one(m):
+            async with self._item_slots:
+                return await fetch(m)
+
+        tasks = [asyncio.ensure_future(one(m)) for m in msgs]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def _upload_in_memory(self, m, *, ctx: str, cache: UploadCache | None, prepared: PreparedMedia):
+        ctx = f"{ctx} m={m.id}"
+        size = media_size(m)
+
+        if size is not None and size > self.stream_small and not isinstance(m.media, MessageMediaPhoto):
+            # потоковый файл целиком в памяти не бывает — хэш не считаем, в кэш попадёт по id источника
+            # части качает читающий аккаунт, загружает свой клиент; сбой чтения — перекачка целиком
+            input_file = await self._download(m, lambda client, msg, policy: stream_media(
+                self.client, msg, size=size, buffer_bytes=self.stream_buffer, ctx=ctx, policy=self.policy,
+                parts=self.download_parts if self._parallel_size(m) else 1,
+                upload_concurrency=self.upload_parts if self._upload_size(m) else 1,
+                reader=client, reader_policy=policy,
+            ), ctx=ctx)
+        else:
+            async def fetch(client, msg, policy):
+                if self._parallel_size(m):
+                    return await download_parallel(client, msg, size=size, parts=self.download_parts,
+                                                   ctx=ctx, policy=policy)
+                data = await safe_call(lambda: client.download_media(msg, file=bytes), ctx=f"{ctx} download",
+                                       policy=policy, kind="download")
+                BYTES_DOWNLOADED.inc(len(data))
+                return data
+
+            data = await self._download(m, fetch, ctx=ctx)
+            if self.upload_cache is not None:
+                h = self._cached_digest(m, await asyncio.to_thread(bytes_digest, data), cache, prepared)
+                if h is not None:
+                    return h
+            if self._upload_size(m):
+                input_file = await upload_parallel(self.client, data, size=len(data), name=media_name(m),
+                                                   parts=self.upload_parts, ctx=ctx, policy=self.policy)
+            else:
+                input_file = await safe_call(
+                    lambda: self.client.upload_file(data, file_name=media_name(m)),
+                    ctx=f"{ctx} upload",
+                    policy=self.policy,
+                    kind="upload",
+                )
+                BYTES_UPLOADED.inc(len(data))
+        return uploaded_media(m, input_file, self.force_document)
+
+    async def _download(self, m, fetch, *, ctx: str):
+        """fetch(client, msg, policy) — скачивание m: на аккаунте пула, если он есть, иначе source_client."""
+        if self.readers is not None:
+            try:
+                return await self.readers.fetch(m, fetch, ctx=ctx)
+            except LookupError as e:
+                log.info("%s: %s, download with the main session", ctx, e)
+        return await fetch(self.source_client, m, self.source_policy)
+
+    def _parallel_size(self, m) -> int | None:
+        """Размер файла, если его стоит качать частями параллельно; фото маленькие и частями не качаются."""
+        size = media_size(m)
+        if not self.parallel_min or not size or size < self.parallel_min or isinstance(m.media, MessageMediaPhoto):
+            return None
+        return size
+
+    def _upload_size(self, m) -> int | None:
+        """Размер файла, если его стоит загружать частями параллельно (см. _parallel_size)."""
+        size = media_size(m)
+        if not self.parallel_upload_min or not size or size < self.parallel_upload_min \
+                or isinstance(m.media, MessageMediaPhoto):
+            return None
+        return size
+
+    def _remove(self, files: list, force: bool = False) -> None:
+        if not (self.cleanup or force):
+            return
+        for p in files:
+            if not isinstance(p, str):
+                continue
+            if os.path.isfile(p):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            self._remove_dir(os.path.dirname(p))
+
+    def _remove_dir(self, path: str) -> None:
+        # каталог из _tmp_path уходит вместе с последним файлом в нём
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.tmp_dir):
+            return
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
@@ -0,0 +1,238 @@
+from __future__ import annotations
+import asyncio
+import bisect
+import logging
+import os
+from pathlib import Path
+
+log = logging.getLogger("tg_sync.metrics")
+
+# границы гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels_text(self.labels, k)} {v:g}" for k, v in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple, float] = {}
+        self._fn = None
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+    def set_function(self, fn) -> None:
+        """Значение считается в момент чтения (например, размер tmp_dir)."""
+        self._fn = fn
+
+    def collect(self) -> dict[tuple, float]:
+        if self._fn is not None:
+            try:
+                return {(): float(self._fn())}
+            except Exception as e:
+                log.debug("gauge %s: %s", self.name, e)
+                return {}
+        return dict(self.values)
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels_text(self.labels, k)} {v:g}" for k, v in sorted(self.collect().items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # key -> [счётчики по корзинам (последняя — +Inf), сумма, количество]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        v = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        v[0][bisect.bisect_left(self.buckets, value)] += 1
+        v[1] += value
+        v[2] += 1
+
+    def quantile(self, q: float, **labels) -> float:
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        v = self.values.get(self._key(labels))
+        if not v or not v[2]:
+            return 0.0
+        rank = q * v[2]
+        seen = 0
+        for bound, n in zip(self.buckets + (float("inf"),), v[0]):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> list[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            seen = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                seen += n
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, key, le)} {seen}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (exposition format 0.0.4)."""
+        lines: list[str] = []
+        for m in self.metrics:
+            lines += m.header() + m.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UNITS_COPIED = REGISTRY.counter("tg_sync_units_copied_total", "Скопировано юнитов (пост/альбом/комментарий)",
+                                ("job", "kind"))
+BYTES_DOWNLOADED = REGISTRY.counter("tg_sync_bytes_downloaded_total", "Скачано байт медиа")
+BYTES_UPLOADED = REGISTRY.counter("tg_sync_bytes_uploaded_total", "Загружено байт медиа")
+CALL_SECONDS = REGISTRY.histogram("tg_sync_call_seconds", "Длительность вызовов safe_call по классам методов",
+                                  ("kind",))
+RETRIES = REGISTRY.counter("tg_sync_retries_total", "Повторы вызовов после ошибок сети/таймаутов", ("kind", "error"))
+FLOOD_WAITS = REGISTRY.counter("tg_sync_flood_waits_total", "Полученные FloodWait", ("kind",))
+FLOOD_WAIT_SECONDS = REGISTRY.counter("tg_sync_flood_wait_seconds_total", "Суммарное ожидание по FloodWait, секунды",
+                                      ("kind",))
+TMP_DISK_BYTES = REGISTRY.gauge("tg_sync_tmp_disk_bytes", "Занято временными файлами в TG_TMP_DIR, байт")
+SOURCE_LAG = REGISTRY.gauge("tg_sync_source_lag_messages", "Голова источника минус last_seen, сообщений", ("job",))
+COMMENT_QUEUE_JOBS = REGISTRY.gauge("tg_sync_comment_queue_jobs", "Заданий в очереди комментариев", ("job",))
+COMMENT_QUEUE_AGE = REGISTRY.gauge("tg_sync_comment_queue_oldest_age_seconds",
+                                   "Возраст самого старого задания очереди комментариев, секунды", ("job",))
+COMMENT_QUEUE_LAG = REGISTRY.gauge("tg_sync_comment_queue_lag_posts",
+                                   "Последний опубликованный пост минус пост самого старого задания", ("job",))
+POOL_SESSIONS = REGISTRY.gauge("tg_sync_pool_sessions_available", "Читающие аккаунты пула в ротации")
+RECOMPRESS_SAVED = REGISTRY.counter("tg_sync_recompress_saved_bytes_total",
+                                    "Байт, которые не пришлось загружать благодаря пересжатию медиа", ("kind",))
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY):
+    """Минимальный HTTP-эндпоинт: GET /metrics -> текстовый формат Prometheus."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), timeout=5)
+            # заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+                status, body = "200 OK", registry.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info("metrics: http://%s:%s/metrics", host, port)
+    return server
+
+
+def log_summary() -> None:
+    """Итог по метрикам в конце запуска."""
+    for (job, kind), n in sorted(UNITS_COPIED.values.items()):
+        log.info("metrics | units | %s %s=%g", job, kind, n)
+    log.info("metrics | bytes | downloaded_mb=%.1f uploaded_mb=%.1f recompress_saved_mb=%.1f",
+             BYTES_DOWNLOADED.total() / 1024 / 1024, BYTES_UPLOADED.total() / 1024 / 1024,
+             RECOMPRESS_SAVED.total() / 1024 / 1024)
+    for (kind,), (_, total, count) in sorted(CALL_SECONDS.values.items()):
+        log.info("metrics | calls | %s n=%s avg=%.2fs p50<=%gs p99<=%gs retries=%g flood_waits=%g flood_wait_s=%g",
+                 kind, count, total / count, CALL_SECONDS.quantile(0.5, kind=kind),
+                 CALL_SECONDS.quantile(0.99, kind=kind),
+                 sum(n for (k, _), n in RETRIES.values.items() if k == kind),
+                 FLOOD_WAITS.values.get((kind,), 0), FLOOD_WAIT_SECONDS.values.get((kind,), 0))
@@ -0,0 +1,241 @@
+from __future__ import annotations
+import asyncio
+import contextlib
+import logging
+
+from telethon import TelegramClient
+
+from copier import PostCopier, FORWARD_BATCH
+from edits import unit_fingerprint
+from metrics import UNITS_COPIED
+from scanner import iter_units
+
+log = logging.getLogger("tg_sync.pipeline")
+
+_NOTHING = object()
+
+
+class CopyPipeline:
+    """
+    Конвейер копирования постов:
+      scan (iter_units) -> prefetch-воркеры (prepare_unit, N штук) -> публикатор в порядке источника.
+    Стадии связаны ограниченными очередями: одновременно в работе не больше depth юнитов.
+    Публикация строго последовательная, поэтому last_seen двигается только по
+    непрерывному префиксу полностью опубликованных юнитов.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        copier: PostCopier,
+        *,
+        src,
+        dest,
+        state,
+        last_seen: int,
+        min_id: int,
+        limit: int | None,
+        workers: int = 3,
+        depth: int = 10,
+        on_published=None,
+        priority=None,
+        scheduler=None,
+        name: str = "",
+        reopened: list | None = None,
+        journal=None,
+        readers=None,
+        fingerprints: bool = False,
+    ):
+        self.client = client
+        self.copier = copier
+        self.src = src
+        self.dest = dest
+        self.state = state
+        self.last_seen = last_seen
+        self.min_id = min_id
+        self.limit = limit
+        self.workers = max(1, workers)
+        self.depth = max(1, depth)
+        self.on_published = on_published  # async (CopyResult) -> None, после обновления last_seen
+        self.priority = priority  # comment_queue.PostPriority: пока есть посты в работе, комментарии ждут
+        self.scheduler = scheduler  # jobs.FairScheduler: очередь публикаций между парами
+        self.name = name
+        self.reopened = reopened  # начало альбома, открытого в прошлом проходе (scanner.reopen_album)
+        self.journal = journal  # journal.Journal: намерение до отправки, id назначения после
+        self.readers = readers  # pool.SessionPool: история читается его аккаунтами
+        self.fingerprints = fingerprints  # отпечатки постов для edits.EditSync (только при TG_EDITS_RECHECK)
+
+        self.scanned = 0
+        self.copied_units = 0
+        self.tail = None  # последний прочитанный юнит
+        self._in_flight = 0
+
+    def open_album(self) -> tuple[int, int] | None:
+        """
+        (grouped_id, max id), если проход закончился альбомом: он мог быть обрезан limit
+        или ещё дописываться — в следующий раз его элементы перечитываются одним get_messages.
+        """
+        gid = getattr(self.tail[-1], "grouped_id", None) if self.tail else None
+        if gid is None:
+            return None
+        return gid, max(m.id for m in self.tail)
+
+    def _forwarding(self) -> bool:
+        return self.copier.copy_mode == "forward" and not self.copier.forward_blocked
+
+    async def run(self) -> None:
+        # в forward-режиме юниты ничего не качают, а пачка пересылки — до FORWARD_BATCH сообщений
+        slots = asyncio.Semaphore(max(self.depth, FORWARD_BATCH) if self._forwarding() else self.depth)
+        prefetch_q: asyncio.Queue = asyncio.Queue()
+        order_q: asyncio.Queue = asyncio.Queue()
+
+        async def scan():
+            async for unit in iter_units(self.client, self.src, min_id=self.min_id, limit=self.limit,
+                                         limiter=self.copier.policy.limiter, reopened=self.reopened,
+                                         readers=self.readers):
+                self.tail = unit
+                prev = self.scanned
+                self.scanned += len(unit)
+                if self.scanned // 20 != prev // 20:
+                    log.info("progress | scanned=%s copied_units=%s last_seen=%s",
+                             self.scanned, self.copied_units, self.last_seen)
+
+                if max(m.id for m in unit) <= self.last_seen:
+                    continue
+
+                await slots.acquire()
+                self._in_flight += 1
+                if self.priority is not None:
+                    self.priority.acquire()
+                fut = asyncio.get_running_loop().create_future()
+                await prefetch_q.put((unit, fut))
+                await order_q.put((unit, fut))
+
+            for _ in range(self.workers):
+                await prefetch_q.put(None)
+            await order_q.put(None)
+
+        async def prefetch():
+            while (item := await prefetch_q.get()) is not None:
+                unit, fut = item
+                try:
+                    prepared = None if self._forwarding() else await self.copier.prepare_unit(unit)
+                except Exception as e:
+                    # ошибку поднимет публикатор, когда дойдёт до этого юнита по порядку
+                    fut.set_exception(e)
+                else:
+                    fut.set_result(prepared)
+
+        tasks = [asyncio.ensure_future(scan())]
+        tasks += [asyncio.ensure_future(prefetch()) for _ in range(self.workers)]
+        publisher = asyncio.ensure_future(self._publish(order_q, slots))
+        try:
+            # scan/prefetch могут упасть раньше публикатора — тогда останавливаем всё
+            while not publisher.done():
+                done, _ = await asyncio.wait(tasks + [publisher], return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t is not publisher and t.exception() is not None:
+                        publisher.cancel()
+                        raise t.exception()
+                tasks = [t for t in tasks if not t.done()]
+            publisher.result()
+        finally:
+            tasks.append(publisher)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._release_pending(order_q)
+            # конвейер остановлен — комментарии больше не ждут его незавершённые юниты
+            while self._in_flight:
+                self._in_flight -= 1
+                if self.priority is not None:
+                    self.priority.release()
+
+    async def _publish(self, order_q: asyncio.Queue, slots: asyncio.Semaphore) -> None:
+        carry = _NOTHING
+        while True:
+            item = carry if carry is not _NOTHING else await order_q.get()
+            carry = _NOTHING
+            if item is None:
+                return
+
+            unit, fut = item
+            prepared = await fut
+
+            if not self._forwarding():
+                try:
+                    async with self._turn():
+                        self._begin(unit)
+                        res = await self.copier.copy_unit(self.dest, unit, prepared=prepared)
+                finally:
+                    self.copier.release(prepared)
+                    self._unit_done(slots)
+                await self._on_copied(unit, res)
+                continue
+
+            self.copier.release(prepared)
+            # forward: добираем в пачку уже готовые юниты, пока влезают в FORWARD_BATCH
+            batch = [unit]
+            size = len(unit)
+            while not order_q.empty():
+                nxt = order_q.get_nowait()
+                if nxt is None or size + len(nxt[0]) > FORWARD_BATCH:
+                    carry = nxt
+                    break
+                self.copier.release(await nxt[1])
+                batch.append(nxt[0])
+                size += len(nxt[0])
+
+            try:
+                async with self._turn():
+                    for u in batch:
+                        self._begin(u)
+                    results = await self.copier.forward_units(self.dest, self.src, batch)
+            finally:
+                for _ in batch:
+                    self._unit_done(slots)
+            for u, res in zip(batch, results):
+                await self._on_copied(u, res)
+
+    def _turn(self):
+        return self.scheduler.turn(self.name) if self.scheduler is not None else contextlib.nullcontext()
+
+    def _unit_done(self, slots: asyncio.Semaphore) -> None:
+        slots.release()
+        self._in_flight -= 1
+        if self.priority is not None:
+            self.priority.release()
+
+    def _begin(self, unit) -> None:
+        if self.journal is not None:
+            self.journal.begin(self.name, "post", unit, dest=self.dest)
+
+    async def _on_copied(self, unit, res) -> None:
+        if self.journal is not None:
+            # до state: после падения между ними сверка возьмёт id из журнала
+            self.journal.commit(self.name, "post", unit[0].id, res.id_map if res else {},
+                                dest_root=res.dest_root_post_id if res else 0)
+        if not res:
+            return
+        self.copied_units += 1
+        UNITS_COPIED.inc(job=self.name, kind="post")
+        self.last_seen = max(self.last_seen, res.src_max_id)
+        self.state.record_ids("post", res.id_map)
+        self.state.register_thread(res.src_root_post_id, res.dest_root_post_id)
+        if self.fingerprints:
+            # текст юнита в DEST — в корневом посте (у альбома — с подписью); по отпечатку потом видны правки
+            self.state.record_fingerprint(unit_fingerprint(unit, res.dest_root_post_id))
+        self.state.update_last_seen(self.last_seen)
+
+        if self.on_published is not None:
+            await self.on_published(res)
+
+    def _release_pending(self, order_q: asyncio.Queue) -> None:
+        # всё, что успели скачать, но не опубликовали
+        while not order_q.empty():
+            item = order_q.get_nowait()
+            if item is None:
+                continue
+            _, fut = item
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.copier.release(fut.result())
@@ -0,0 +1,309 @@
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from telethon import TelegramClient, errors, utils
+from telethon.tl.functions.channels import GetFullChannelRequest
+
+from config import Config
+from metrics import POOL_SESSIONS
+from ratelimit import RateLimiter, paced_history
+from retry import RetryPolicy, safe_call
+from telegram_factory import create_client
+
+log = logging.getLogger("tg_sync.pool")
+
+# Что можно задать для аккаунта в TG_SESSIONS_FILE
+SESSION_OPTIONS = ("name", "session", "post")
+# после стольких сбоев подряд (уже после ретраев safe_call) аккаунт выводится из ротации
+MAX_FAILURES = 3
+# на сколько секунд выводится из ротации аккаунт со сбоями (умножается на число сбоев)
+FAILURE_COOLDOWN = 60.0
+# ретраи сетевых ошибок на читающем аккаунте: дальше быстрее переключиться на другой
+READER_RETRIES = 2
+# короткий FloodWait читающий аккаунт пережидает сам (чтобы не перекачивать файл заново на другом),
+# новые вызовы тем временем идут другим аккаунтам; длиннее — вызов переходит на другой аккаунт
+READER_FLOOD_SLEEP = 10
+
+NETWORK_ERRORS = (asyncio.TimeoutError, TimeoutError, OSError, ConnectionError)
+
+
+def load_sessions(path: Path) -> list[dict]:
+    """
+    Файл аккаунтов — JSON-список, например:
+      [{"name": "main", "session": "1Aa...", "post": true}, {"name": "reader1", "session": "1Bb..."}]
+    post — аккаунт может публиковать в DEST (без него — только чтение).
+    """
+    with open(path, encoding="utf-8") as f:
+        raw = json.load(f)
+
+    entries: list[dict] = []
+    names: set[str] = set()
+    for i, item in enumerate(raw):
+        unknown = set(item) - set(SESSION_OPTIONS)
+        if unknown:
+            raise RuntimeError(f"{path}: session #{i}: неизвестные опции {sorted(unknown)}")
+        if not item.get("session"):
+            raise RuntimeError(f"{path}: session #{i}: нужна session (StringSession)")
+        name = str(item.get("name") or f"session{i}")
+        if name in names:
+            raise RuntimeError(f"{path}: session name {name!r} повторяется")
+        names.add(name)
+        entries.append({"name": name, "session": item["session"], "post": bool(item.get("post", False))})
+    return entries
+
+
+async def read_messages(pool: SessionPool | None, client: TelegramClient, entity, *, ctx: str,
+                        policy: RetryPolicy | None = None, **kwargs):
+    """get_messages ради метаданных (голова канала, replies постов): аккаунтом пула, если он видит чат."""
+    if pool is not None and await pool.covers(entity):
+        return await pool.run(utils.get_peer_id(entity), lambda s, chat: safe_call(
+            lambda: s.client.get_messages(chat, **kwargs), ctx=ctx, policy=s.policy, kind="get_history"), ctx=ctx)
+    return await safe_call(lambda: client.get_messages(entity, **kwargs), ctx=ctx, policy=policy,
+                           kind="get_history")
+
+
+def poster_session(cfg: Config, entries: list[dict]) -> str:
+    """Аккаунт, от которого публикуем: TG_SESSION, а если он пуст — первый аккаунт с post из TG_SESSIONS_FILE."""
+    if cfg.session or not entries:
+        return cfg.session
+    poster = next((e for e in entries if e["post"]), None)
+    if poster is None:
+        raise RuntimeError(f"{cfg.sessions_file}: TG_SESSION пуст, и ни у одного аккаунта нет post")
+    return poster["session"]
+
+
+def open_pool(cfg: Config, entries: list[dict], *, poster: str) -> SessionPool | None:
+    """Пул из всех аккаунтов файла, кроме публикующего; None — читать больше некому."""
+    readers = [
+        PoolSession(
+            name=e["name"],
+            # FloodWait решают safe_call и пул (READER_FLOOD_SLEEP), а не Telethon
+            client=create_client(cfg, e["session"], flood_sleep_threshold=0),
+            post=e["post"],
+            policy=reader_policy(cfg),
+        )
+        for e in entries
+        if e["session"] != poster
+    ]
+    return SessionPool(readers) if readers else None
+
+
+def reader_policy(cfg: Config) -> RetryPolicy:
+    return RetryPolicy(max_retries=READER_RETRIES, limiter=RateLimiter(cfg.rate_limits),
+                       flood_sleep_max=READER_FLOOD_SLEEP)
+
+
+@dataclass
+class PoolSession:
+    name: str
+    client: TelegramClient
+    policy: RetryPolicy  # свой лимитер: у каждого аккаунта свои лимиты Telegram
+    post: bool = False
+    resume_at: float = 0.0  # до этого момента (time.monotonic) аккаунт вне ротации
+    failures: int = 0       # сбоев подряд
+    calls: int = 0
+    flood_waits: int = 0
+    chats: dict[int, object] = field(default_factory=dict)  # peer id -> entity, как её видит этот аккаунт
+    resolved: set[str] = field(default_factory=set)         # ссылки (register), уже разрешённые этим аккаунтом
+    resolving: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def available(self, now: float) -> bool:
+        # пауза лимитера — аккаунт пережидает короткий FloodWait
+        limiter = self.policy.limiter
+        return now >= self.resume_at and (limiter is None or now >= limiter.resume_at)
+
+
+class SessionPool:
+    """
+    Читающие аккаунты: скачивание медиа и чтение истории/комментариев распределяются между ними по кругу,
+    чтобы не упираться в лимиты одного аккаунта. Публикация остаётся за основным клиентом:
+    загруженные файлы и handle принадлежат аккаунту, который их получил.
+    Аккаунт с FloodWait выводится из ротации на время ожидания, с повторяющимися сбоями сети — на
+    FAILURE_COOLDOWN; по истечении сам возвращается. Сообщения и чаты у каждого аккаунта свои
+    (file_reference, access_hash), поэтому сообщение перечитывается по id тем аккаунтом, который его качает.
+    """
+
+    def __init__(self, sessions: list[PoolSession]):
+        self.sessions = sessions
+        self._next = 0
+        self._refs: list[str] = []
+        self._covers: dict[int, bool] = {}
+        POOL_SESSIONS.set_function(lambda: self.available_count())
+
+    def register(self, ref: str) -> None:
+        """Источник (как в TG_SOURCE): по нему аккаунты пула находят канал и его discussion-группу."""
+        if ref and ref not in self._refs:
+            self._refs.append(ref)
+
+    async def start(self) -> None:
+        for s in self.sessions:
+            await s.client.start()
+        log.info("pool | %s reader sessions: %s", len(self.sessions), ", ".join(s.name for s in self.sessions))
+
+    async def close(self) -> None:
+        for s in self.sessions:
+            await s.client.disconnect()
+
+    def available_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for s in self.sessions if s.available(now))
+
+    async def acquire(self) -> PoolSession:
+        """Следующий аккаунт в ротации; если все выведены — ждём ближайшего."""
+        while True:
+            now = time.monotonic()
+            n = len(self.sessions)
+            for i in range(n):
+                s = self.sessions[(self._next + i) % n]
+                if s.available(now):
+                    self._next = (self._next + i + 1) % n
+                    s.calls += 1
+                    return s
+            wait = max(0.1, min(max(s.resume_at, s.policy.limiter.resume_at if s.policy.limiter else 0)
+                                for s in self.sessions) - now)
+            log.warning("pool | all sessions out of rotation, waiting %.0fs", wait)
+            await asyncio.sleep(wait)
+
+    async def covers(self, entity) -> bool:
+        """Видят ли чат все аккаунты пула (иначе историю этого чата читает основной клиент)."""
+        peer_id = utils.get_peer_id(entity)
+        if peer_id not in self._covers:
+            for s in self.sessions:
+                try:
+                    await self.entity(s, peer_id)
+                except LookupError as e:
+                    log.warning("pool | %s", e)
+                    self._covers[peer_id] = False
+                    return False
+                except (errors.FloodWaitError, *NETWORK_ERRORS) as e:
+                    # временно: проверим в следующий раз
+                    log.warning("pool | %s cannot check chat %s now: %s", s.name, peer_id, type(e).__name__)
+                    return False
+            self._covers[peer_id] = True
+        return self._covers[peer_id]
+
+    async def entity(self, s: PoolSession, peer_id: int):
+        """Чат глазами аккаунта s: канал из register или его discussion-группа."""
+        if peer_id in s.chats:
+            return s.chats[peer_id]
+        async with s.resolving:
+            return await self._resolve(s, peer_id)
+
+    async def _resolve(self, s: PoolSession, peer_id: int):
+        if peer_id in s.chats:
+            return s.chats[peer_id]
+        for ref in self._refs:
+            if ref in s.resolved:
+                continue
+            try:
+                channel = await safe_call(lambda: s.client.get_entity(ref), ctx=f"pool {s.name} resolve {ref}",
+                                          policy=s.policy)
+            except ValueError as e:
+                log.warning("pool | %s cannot resolve %s: %s", s.name, ref, e)
+                s.resolved.add(ref)
+                continue
+            s.chats[utils.get_peer_id(channel)] = channel
+            full = await safe_call(lambda: s.client(GetFullChannelRequest(channel)),
+                                   ctx=f"pool {s.name} get_full_channel {ref}", policy=s.policy)
+            linked_id = full.full_chat.linked_chat_id
+            for c in full.chats:
+                if linked_id and c.id == linked_id:
+                    s.chats[utils.get_peer_id(c)] = c
+            s.resolved.add(ref)
+            if peer_id in s.chats:
+                return s.chats[peer_id]
+        raise LookupError(f"session {s.name} does not see chat {peer_id}")
+
+    async def run(self, peer_id: int, fn, *, ctx: str):
+        """
+        fn(session, entity) на очередном аккаунте; при FloodWait или сбоях сети — на следующем.
+        LookupError (аккаунт не видит чат, сообщения нет) уходит вызывающему — тот сделает то же основным клиентом.
+        """
+        failed = 0
+        while True:
+            s = await self.acquire()
+            try:
+                result = await fn(s, await self.entity(s, peer_id))
+            except errors.FloodWaitError as e:
+                self._flood(s, e.seconds, ctx)
+                continue
+            except NETWORK_ERRORS as e:
+                self._failed(s, e, ctx)
+                failed += 1
+                if failed >= MAX_FAILURES * len(self.sessions):
+                    raise
+                continue
+            s.failures = 0
+            return result
+
+    async def fetch(self, msg, fn, *, ctx: str):
+        """
+        Скачивание: fn(client, msg, policy) на аккаунте пула. Сообщение перечитывается этим аккаунтом по id
+        (кроме случая, когда он сам его и прочитал) — чужой file_reference Telegram не примет.
+        """
+        async def on(s: PoolSession, chat):
+            local = msg
+            if getattr(msg, "_client", None) is not s.client:
+                local = await safe_call(lambda: s.client.get_messages(chat, ids=msg.id), ctx=f"{ctx} refetch",
+                                        policy=s.policy, kind="get_history")
+                if local is None or local.media is None:
+                    raise LookupError(f"session {s.name}: message {msg.id} not found")
+            return await fn(s.client, local, s.policy)
+
+        return await self.run(msg.chat_id, on, ctx=f"{ctx} pool")
+
+    async def iter_history(self, entity, *, min_id: int = 0, limit: int | None = None, reply_to: int | None = None):
+        """
+        iter_messages(reverse=True) на аккаунтах пула: после FloodWait или сбоя чтение продолжается
+        с последнего выданного id другим аккаунтом. Страницы идут через лимитер читающего аккаунта.
+        """
+        peer_id = utils.get_peer_id(entity)
+        kw = {"reply_to": reply_to} if reply_to is not None else {}
+        read = 0
+        failed = 0
+        while limit is None or read < limit:
+            s = await self.acquire()
+            try:
+                chat = await self.entity(s, peer_id)
+                history = s.client.iter_messages(chat, min_id=min_id, limit=limit - read if limit else None,
+                                                 reverse=True, **kw)
+                async for m in paced_history(history, s.policy.limiter, flood_sleep_max=s.policy.flood_sleep_max):
+                    min_id = m.id
+                    read += 1
+                    yield m
+            except errors.FloodWaitError as e:
+                self._flood(s, e.seconds, f"history {peer_id}")
+                continue
+            except NETWORK_ERRORS as e:
+                self._failed(s, e, f"history {peer_id}")
+                failed += 1
+                if failed >= MAX_FAILURES * len(self.sessions):
+                    raise
+                continue
+            s.failures = 0
+            return
+
+    def summary(self) -> str:
+        now = time.monotonic()
+        return " ".join(
+            f"{s.name}:calls={s.calls},flood_waits={s.flood_waits}"
+            f"{'' if s.available(now) else f',out={s.resume_at - now:.0f}s'}"
+            for s in self.sessions
+        )
+
+    def _flood(self, s: PoolSession, seconds: int, ctx: str) -> None:
+        s.flood_waits += 1
+        s.resume_at = max(s.resume_at, time.monotonic() + seconds + 1)
+        log.warning("pool | %s FloodWait %ss, out of rotation | %s", s.name, seconds, ctx)
+
+    def _failed(self, s: PoolSession, e: BaseException, ctx: str) -> None:
+        s.failures += 1
+        log.warning("pool | %s %s: %s (%s in a row) | %s", s.name, type(e).__name__, e, s.failures, ctx)
+        if s.failures >= MAX_FAILURES:
+            s.resume_at = time.monotonic() + FAILURE_COOLDOWN * s.failures
+            log.warning("pool | %s out of rotation for %.0fs", s.name, FAILURE_COOLDOWN * s.failures)
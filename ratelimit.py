@@ -0,0 +1,156 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+
+from telethon import errors
+
+from metrics import FLOOD_WAITS, FLOOD_WAIT_SECONDS
+
+log = logging.getLogger("tg_sync.ratelimit")
+
+# Стартовые (и максимальные) скорости, вызовов в секунду, по классам методов
+DEFAULT_RATES = {
+    "send_message": 1.0,
+    "send_file": 1.0,
+    "get_history": 3.0,
+    "download": 20.0,
+    "upload": 20.0,
+}
+
+# размер страницы iter_messages: один запрос messages.getHistory
+HISTORY_PAGE = 100
+
+
+class TokenBucket:
+    """
+    Token bucket с адаптивной скоростью (AIMD): FloodWait делит скорость пополам (не ниже min_rate),
+    каждый успешный вызов понемногу возвращает её к max_rate.
+    """
+
+    def __init__(self, rate: float, *, burst: float | None = None, min_factor: float = 0.05, recover_calls: int = 50):
+        self.max_rate = rate
+        self.min_rate = rate * min_factor
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.step = rate / max(1, recover_calls)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # под замком — ожидающие получают токены по очереди, а не все разом
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def slow_down(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def hold(self, until: float) -> None:
+        """Не копить токены до until: после общей паузы вызовы идут с заданной скоростью, а не пачкой."""
+        self._tokens = min(self._tokens, 0)
+        self._stamp = max(self._stamp, until)
+
+    def speed_up(self) -> None:
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+
+class RateLimiter:
+    """
+    Общий для всех копировщиков лимитер вызовов Telegram: свой TokenBucket на класс методов
+    (send_message, send_file, get_history, download, upload) и одна глобальная пауза на FloodWait —
+    вместо того чтобы каждая корутина отдельно упиралась в ту же стену.
+    """
+
+    def __init__(self, rates: dict[str, float] | None = None):
+        rates = {**DEFAULT_RATES, **(rates or {})}
+        # скорость 0 — класс не ограничиваем
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in rates.items() if rate > 0}
+        self.flood_waits = 0
+        self._resume_at = 0.0
+
+    async def acquire(self, kind: str | None) -> None:
+        await self.wait_pause()
+        bucket = self.buckets.get(kind) if kind else None
+        if bucket is not None:
+            await bucket.acquire()
+            # за время ожидания токена мог прилететь FloodWait
+            await self.wait_pause()
+
+    async def wait_pause(self) -> None:
+        while True:
+            delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    @property
+    def resume_at(self) -> float:
+        """До какого момента (time.monotonic) действует пауза после FloodWait."""
+        return self._resume_at
+
+    def on_flood(self, kind: str | None, seconds: float) -> None:
+        self.flood_waits += 1
+        resume_at = time.monotonic() + seconds
+        if resume_at > self._resume_at:
+            self._resume_at = resume_at
+            log.warning("rate limit: global pause %.0fs (FloodWait on %s)", seconds, kind or "?")
+            for b in self.buckets.values():
+                b.hold(resume_at)
+        bucket = self.buckets.get(kind) if kind else None
+        if bucket is not None:
+            bucket.slow_down()
+            log.info("rate limit: %s -> %.2f/s", kind, bucket.rate)
+
+    def on_success(self, kind: str | None) -> None:
+        bucket = self.buckets.get(kind) if kind else None
+        if bucket is not None:
+            bucket.speed_up()
+
+    def summary(self) -> str:
+        rates = " ".join(f"{k}={b.rate:.2f}/{b.max_rate:g}" for k, b in self.buckets.items())
+        return f"flood_waits={self.flood_waits} {rates}"
+
+
+async def paced_history(messages, limiter: RateLimiter | None, page: int = HISTORY_PAGE, *,
+                        flood_sleep_max: float | None = None):
+    """
+    Обёртка над iter_messages: токен get_history перед каждой страницей истории.
+    FloodWait на странице (клиенты создаются с flood_sleep_threshold=0) — общая пауза лимитера,
+    затем итератор Telethon запрашивает ту же страницу снова; длиннее flood_sleep_max — пробрасываем (см. pool).
+    """
+    n = 0
+    it = messages.__aiter__()
+    while True:
+        if limiter is not None and n % page == 0:
+            await limiter.acquire("get_history")
+        try:
+            m = await it.__anext__()
+        except StopAsyncIteration:
+            return
+        except errors.FloodWaitError as e:
+            wait_s = int(getattr(e, "seconds", 0)) + 1
+            log.warning("FloodWait %ss | history page after %s messages", wait_s, n)
+            FLOOD_WAITS.inc(kind="get_history")
+            FLOOD_WAIT_SECONDS.inc(wait_s, kind="get_history")
+            if limiter is not None:
+                limiter.on_flood("get_history", wait_s)
+            if flood_sleep_max is not None and wait_s > flood_sleep_max:
+                raise
+            if limiter is not None:
+                await limiter.wait_pause()
+            else:
+                await asyncio.sleep(wait_s)
+            continue
+        if limiter is not None and n % page == 0:
+            limiter.on_success("get_history")
+        n += 1
+        yield m
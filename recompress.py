@@ -0,0 +1,284 @@
+from __future__ import annotations
+import asyncio
+import copy
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+
+from telethon.tl.types import (
+    DocumentAttributeAnimated,
+    DocumentAttributeFilename,
+    DocumentAttributeImageSize,
+    DocumentAttributeSticker,
+    DocumentAttributeVideo,
+    InputMediaUploadedDocument,
+    InputMediaUploadedPhoto,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+)
+
+from config import Config
+from metrics import RECOMPRESS_SAVED
+from transfer import media_name
+
+log = logging.getLogger("tg_sync.recompress")
+
+# Результат меньше исходника меньше чем на эту долю — не стоит потери качества, шлём исходник
+MIN_GAIN = 0.1
+# Форматы, которые Pillow пересжимает без потерь смысла; GIF/WEBP (анимация, стикеры) не трогаем
+IMAGE_MIMES = ("image/jpeg", "image/png", "image/bmp", "image/tiff")
+# Сколько ждать ffmpeg на одном ролике
+VIDEO_TIMEOUT = 600
+# mime результата по расширению, которое выбрал recompress_file
+OUTPUT_MIMES = {".jpg": "image/jpeg", ".png": "image/png", ".mp4": "video/mp4"}
+
+
+@dataclass(frozen=True)
+class RecompressOptions:
+    min_size: int        # байт; файлы меньше не трогаем
+    quality: int         # JPEG quality для картинок
+    max_side: int        # пикселей; больше — уменьшаем с сохранением пропорций (0 — разрешение не меняем)
+    strip_metadata: bool  # выкинуть EXIF/ICC и метаданные контейнера
+    video_max: int       # байт; ролики до этого размера перекодируются ffmpeg (0 — видео не трогаем)
+    video_crf: int       # x264 CRF для видео
+
+
+@dataclass(frozen=True)
+class Recompressed:
+    path: str
+    width: int   # размеры результата; 0 — неизвестны (нет ffprobe), остаются размеры исходника
+    height: int
+
+
+def recompress_options(cfg: Config) -> RecompressOptions | None:
+    if not cfg.recompress:
+        return None
+    return RecompressOptions(
+        min_size=cfg.recompress_min,
+        quality=cfg.recompress_quality,
+        max_side=cfg.recompress_max_side,
+        strip_metadata=cfg.recompress_strip_metadata,
+        video_max=cfg.recompress_video_max,
+        video_crf=cfg.recompress_video_crf,
+    )
+
+
+def open_executor(workers: int) -> ProcessPoolExecutor:
+    # forkserver/spawn: не форкаем процесс с открытыми соединениями Telethon и потоками asyncio
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context(method))
+
+
+def media_kind(msg) -> str | None:
+    """"image" | "video" — что можно пересжать; None — отправляем как есть (стикеры, GIF, голосовые, файлы)."""
+    media = msg.media
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        return "image"
+    doc = media.document if isinstance(media, MessageMediaDocument) else None
+    if doc is None or any(isinstance(a, (DocumentAttributeSticker, DocumentAttributeAnimated))
+                          for a in doc.attributes):
+        return None
+    if doc.mime_type in IMAGE_MIMES:
+        return "image"
+    video = next((a for a in doc.attributes if isinstance(a, DocumentAttributeVideo)), None)
+    if doc.mime_type.startswith("video/") and video is not None and not video.round_message:
+        return "video"
+    return None
+
+
+def recompress_file(kind: str, src: str, dst_stem: str, opts: RecompressOptions) -> Recompressed:
+    """
+    Выполняется в процессе пула: пересжимает src в dst_stem + расширение, возвращает путь и размеры результата.
+    Расширение выбирает формат: картинка с прозрачностью остаётся PNG, остальные — JPEG, видео — MP4.
+    """
+    try:
+        if kind == "image":
+            return _recompress_image(src, dst_stem, opts)
+        return _recompress_video(src, dst_stem + ".mp4", opts)
+    except BaseException:
+        for ext in (".jpg", ".png", ".mp4"):
+            _discard(dst_stem + ext)
+        raise
+
+
+def _recompress_image(src: str, dst_stem: str, opts: RecompressOptions) -> Recompressed:
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as img:
+        exif = img.info.get("exif")
+        if opts.strip_metadata:
+            # поворот из EXIF применяем к пикселям, иначе без метаданных картинка ляжет набок
+            img = ImageOps.exif_transpose(img)
+        if opts.max_side and max(img.size) > opts.max_side:
+            img.thumbnail((opts.max_side, opts.max_side), Image.LANCZOS)
+        extra = {} if opts.strip_metadata or not exif else {"exif": exif}
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # прозрачность в JPEG не влезает — только пережимаем PNG
+            dst = dst_stem + ".png"
+            img.save(dst, "PNG", optimize=True, **extra)
+        else:
+            dst = dst_stem + ".jpg"
+            img.convert("RGB").save(dst, "JPEG", quality=opts.quality, optimize=True, progressive=True, **extra)
+        width, height = img.size
+    return Recompressed(dst, width, height)
+
+
+def _recompress_video(src: str, dst: str, opts: RecompressOptions) -> Recompressed:
+    cmd = ["ffmpeg", "-v", "error", "-y", "-i", src, "-c:v", "libx264", "-preset", "veryfast",
+           "-crf", str(opts.video_crf), "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "128k",
+           "-movflags", "+faststart"]
+    if opts.max_side:
+        cmd += ["-vf", f"scale='min(iw,{opts.max_side})':'min(ih,{opts.max_side})'"
+                       ":force_original_aspect_ratio=decrease:force_divisible_by=2"]
+    if opts.strip_metadata:
+        cmd += ["-map_metadata", "-1"]
+    subprocess.run(cmd + [dst], check=True, capture_output=True, timeout=VIDEO_TIMEOUT)
+    return Recompressed(dst, *_video_size(dst))
+
+
+def _video_size(path: str) -> tuple[int, int]:
+    try:
+        out = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+                              "stream=width,height", "-of", "csv=p=0:s=x", path],
+                             check=True, capture_output=True, text=True, timeout=60).stdout
+        width, height = out.split()[0].split("x")[:2]
+        return int(width), int(height)
+    except (OSError, subprocess.SubprocessError, IndexError, ValueError):
+        return 0, 0
+
+
+def recompressed_name(msg, rc: Recompressed) -> str:
+    """Имя файла в DEST: исходное, с расширением нового формата."""
+    return os.path.splitext(media_name(msg))[0] + os.path.splitext(rc.path)[1]
+
+
+def recompressed_media(msg, input_file, rc: Recompressed, force_document: bool):
+    """
+    InputMedia для загруженного пересжатого файла. Путь Telethon подписал бы атрибутами самого файла
+    (без hachoir у видео 0x1x1 и нулевая длительность, документ-PNG после JPEG уходит фото),
+    поэтому атрибуты берутся у исходного сообщения, а mime, имя и размеры — у результата.
+    """
+    if isinstance(msg.media, MessageMediaPhoto) and not force_document:
+        return InputMediaUploadedPhoto(file=input_file)
+
+    doc = getattr(msg.media, "document", None)
+    attributes = []
+    for a in doc.attributes if doc is not None else []:
+        if isinstance(a, (DocumentAttributeVideo, DocumentAttributeImageSize)):
+            a = copy.copy(a)
+            a.w, a.h = rc.width or a.w, rc.height or a.h
+        elif isinstance(a, DocumentAttributeFilename):
+            a = DocumentAttributeFilename(recompressed_name(msg, rc))
+        attributes.append(a)
+    if not any(isinstance(a, DocumentAttributeFilename) for a in attributes):
+        attributes.append(DocumentAttributeFilename(recompressed_name(msg, rc)))
+    if doc is None and rc.width:
+        attributes.append(DocumentAttributeImageSize(rc.width, rc.height))  # фото, отправляемое документом
+    return InputMediaUploadedDocument(
+        file=input_file,
+        mime_type=OUTPUT_MIMES.get(os.path.splitext(rc.path)[1], "application/octet-stream"),
+        attributes=attributes,
+        force_file=force_document or None,
+    )
+
+
+@dataclass
+class RecompressStats:
+    files: int = 0        # отправлено пересжатых файлов
+    skipped: int = 0      # пересжатие не дало выигрыша MIN_GAIN
+    failed: int = 0
+    bytes_saved: int = 0
+
+
+class Recompressor:
+    """
+    Необязательная стадия между скачиванием и send_file: картинки пересжимаются Pillow (JPEG quality,
+    уменьшение до max_side, без метаданных), короткие ролики — ffmpeg (x264 CRF).
+    CPU-работа идёт в ProcessPoolExecutor, общем на процесс, и не блокирует event loop.
+    Если пересжатие не помогло или упало — отправляется исходный файл.
+    Без Pillow картинки и без ffmpeg видео не трогаются (одно предупреждение в лог).
+    """
+
+    def __init__(self, executor: Executor | None, options: RecompressOptions):
+        self.executor = executor
+        self.options = options
+        self.stats = RecompressStats()
+        self._available: dict[str, bool] = {}
+
+    async def apply(self, m, path: str, *, ctx: str) -> Recompressed | None:
+        """Пересжатый файл (исходник тогда можно удалять) или None — отправлять сам path."""
+        kind = media_kind(m)
+        if kind is None or self.executor is None or not self._supported(kind):
+            return None
+        size = os.path.getsize(path)
+        if size < self.options.min_size or (kind == "video" and size > self.options.video_max):
+            return None
+
+        # результат рядом с исходником, под другим именем: путь исходника уже уникален (media.MediaSender._tmp_path)
+        out = os.path.splitext(path)[0] + ".recompressed"
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, recompress_file, kind, path, out,
+                                                         self.options)
+        try:
+            rc = await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # процесс пула доделает файл и после отмены — удаляем результат, когда он появится
+            fut.add_done_callback(_discard_result)
+            raise
+        except BrokenExecutor as e:
+            # упавший пул процессов сам не поднимется — дальше отправляем файлы как есть
+            self.stats.failed += 1
+            self.executor = None
+            log.warning("%s: recompress pool is broken (%s), recompression disabled", ctx, e)
+            return None
+        except Exception as e:
+            self.stats.failed += 1
+            log.warning("%s: recompress %s failed (%s: %s), sending original", ctx, kind, type(e).__name__, e)
+            return None
+
+        new_size = os.path.getsize(rc.path)
+        if new_size > size * (1 - MIN_GAIN):
+            self.stats.skipped += 1
+            log.debug("%s: recompress %s %s -> %s bytes, not worth it", ctx, kind, size, new_size)
+            _discard(rc.path)
+            return None
+        self.stats.files += 1
+        self.stats.bytes_saved += size - new_size
+        RECOMPRESS_SAVED.inc(size - new_size, kind=kind)
+        log.debug("%s: recompress %s %s -> %s bytes", ctx, kind, size, new_size)
+        return rc
+
+    def summary(self) -> str:
+        s = self.stats
+        return f"files={s.files} skipped={s.skipped} failed={s.failed} saved_mb={s.bytes_saved / 1024 / 1024:.1f}"
+
+    def _supported(self, kind: str) -> bool:
+        if kind not in self._available:
+            if kind == "video":
+                ok = bool(self.options.video_max) and shutil.which("ffmpeg") is not None
+                if self.options.video_max and not ok:
+                    log.warning("recompress: ffmpeg not found, videos are sent as is")
+            else:
+                try:
+                    import PIL  # noqa: F401
+                    ok = True
+                except ImportError:
+                    ok = False
+                    log.warning("recompress: Pillow is not installed (pip install pillow), images are sent as is")
+            self._available[kind] = ok
+        return self._available[kind]
+
+
+def _discard_result(fut: asyncio.Future) -> None:
+    if not fut.cancelled() and fut.exception() is None:
+        _discard(fut.result().path)
+
+
+def _discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,40 +1,71 @@
 from __future__ import annotations
 import asyncio
 import logging
+import time
 from telethon import errors
 
+from metrics import CALL_SECONDS, FLOOD_WAITS, FLOOD_WAIT_SECONDS, RETRIES
+from ratelimit import RateLimiter
+
 log = logging.getLogger("tg_sync.retry")
 
 
 class RetryPolicy:
-    def __init__(self, max_retries: int = 10, base_sleep: float = 2.0, max_sleep: float = 30.0):
+    def __init__(self, max_retries: int = 10, base_sleep: float = 2.0, max_sleep: float = 30.0,
+                 limiter: RateLimiter | None = None, flood_sleep_max: float | None = None):
         self.max_retries = max_retries
         self.base_sleep = base_sleep
         self.max_sleep = max_sleep
+        self.limiter = limiter  # общий на процесс; None — без проактивного ограничения
+        # FloodWait дольше этого не ждём, а отдаём вызывающему (пул переключит аккаунт); None — ждём любой
+        self.flood_sleep_max = flood_sleep_max
 
 
-async def safe_call(coro_factory, *, ctx: str = "", policy: RetryPolicy | None = None):
+async def safe_call(coro_factory, *, ctx: str = "", policy: RetryPolicy | None = None, kind: str | None = None):
     """
     coro_factory: () -> coroutine
-    FloodWait ждём сколько скажут.
+    kind — класс метода для RateLimiter ("send_message", "send_file", "get_history", "download", "upload").
+    FloodWait ждём сколько скажут (с лимитером — общей паузой для всех вызовов),
+    длиннее policy.flood_sleep_max — пробрасываем (см. pool.SessionPool).
     Timeout/Network ретраим ограниченное число раз.
     """
     policy = policy or RetryPolicy()
+    limiter = policy.limiter
+    label = kind or "other"
     attempt = 0
 
     while True:
         try:
             if attempt:
                 log.warning("retry #%s | %s", attempt, ctx)
-            return await coro_factory()
+            if limiter is not None:
+                await limiter.acquire(kind)
+            started = time.monotonic()
+            try:
+                result = await coro_factory()
+            finally:
+                CALL_SECONDS.observe(time.monotonic() - started, kind=label)
+            if limiter is not None:
+                limiter.on_success(kind)
+            return result
 
         except errors.FloodWaitError as e:
             wait_s = int(getattr(e, "seconds", 0)) + 1
             log.warning("FloodWait %ss | %s", wait_s, ctx)
-            await asyncio.sleep(wait_s)
+            FLOOD_WAITS.inc(kind=label)
+            FLOOD_WAIT_SECONDS.inc(wait_s, kind=label)
+            if limiter is not None:
+                limiter.on_flood(kind, wait_s)
+            if policy.flood_sleep_max is not None and wait_s > policy.flood_sleep_max:
+                raise
+            if limiter is not None:
+                await limiter.wait_pause()
+            else:
+                await asyncio.sleep(wait_s)
 
         except (asyncio.TimeoutError, TimeoutError, OSError, ConnectionError) as e:
             attempt += 1
+            RETRIES.inc(kind=label, error=type(e).__name__)
             if attempt > policy.max_retries:
                 log.error("give up after %s retries | %s | %s: %s", policy.max_retries, ctx, type(e).__name__, e)
                 raise
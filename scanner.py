@@ -0,0 +1,118 @@
+from __future__ import annotations
+import asyncio
+import logging
+
+from telethon import TelegramClient
+
+from pool import SessionPool
+from ratelimit import HISTORY_PAGE, RateLimiter, paced_history
+from retry import RetryPolicy, safe_call
+
+log = logging.getLogger("tg_sync.scanner")
+
+# сколько страниц истории читаем впрок, пока идёт обработка
+PREFETCH_PAGES = 2
+# больше элементов в альбоме Telegram не бывает
+ALBUM_MAX = 10
+
+
+async def prefetched(messages, size: int):
+    """Читает асинхронный итератор в фоне, держа до size элементов наготове."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, size))
+    done = object()
+
+    async def pump():
+        try:
+            async for m in messages:
+                await queue.put(m)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(done)
+
+    task = asyncio.ensure_future(pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+async def reopen_album(client: TelegramClient, entity, open_album: tuple[int, int] | None, *, min_id: int,
+                       policy: RetryPolicy | None = None) -> list:
+    """
+    Элементы альбома, которым закончился прошлый проход (он мог быть обрезан limit или ещё дописываться).
+    Один get_messages(ids=...) по последним ALBUM_MAX id вместо пересканирования overlap-окна.
+    Возвращает только то, что не попадёт в окно min_id.
+    """
+    if open_album is None:
+        return []
+    gid, last_id = open_album
+    ids = [i for i in range(last_id - ALBUM_MAX + 1, last_id + 1) if 0 < i <= min_id]
+    if not ids:
+        return []
+    msgs = await safe_call(lambda: client.get_messages(entity, ids=ids), ctx=f"reopen album gid={gid}",
+                           policy=policy, kind="get_history")
+    album = [m for m in msgs or [] if m is not None and getattr(m, "grouped_id", None) == gid]
+    log.debug("scan | reopen album gid=%s last_id=%s -> %s messages", gid, last_id, len(album))
+    return album
+
+
+async def iter_units(client: TelegramClient, entity, *, min_id: int, limit: int | None,
+                     limiter: RateLimiter | None = None, reopened: list | None = None,
+                     readers: SessionPool | None = None):
+    """
+    Читает историю канала (от старых к новым) и группирует её в «юниты»:
+    одиночное сообщение -> [m], альбом -> [m1, m2, ...] (по grouped_id).
+    reopened — уже обработанная часть открытого альбома (см. reopen_album): если история
+    продолжает тот же grouped_id, альбом собирается целиком.
+    Альбом, на котором историю обрезал limit, не отдаётся (если до него были другие юниты):
+    следующий проход прочитает его целиком.
+    readers — pool.SessionPool: историю читают его аккаунты, а не client.
+    """
+    current_gid = None
+    album_msgs: list = []
+    read = 0
+    units = 0
+    if reopened:
+        current_gid = reopened[0].grouped_id
+        album_msgs = list(reopened)
+
+    if readers is not None:
+        history = readers.iter_history(entity, min_id=min_id, limit=limit)
+    else:
+        history = paced_history(client.iter_messages(entity, min_id=min_id, limit=limit, reverse=True), limiter)
+    async for m in prefetched(history, PREFETCH_PAGES * HISTORY_PAGE):
+        read += 1
+        gid = getattr(m, "grouped_id", None)
+        log.debug("scan | id=%s gid=%s", m.id, gid)
+
+        if gid is not None and gid == current_gid:
+            album_msgs.append(m)
+            continue
+
+        # закрыть прошлый альбом
+        if current_gid is not None and album_msgs:
+            units += 1
+            yield album_msgs
+
+        if gid is not None:
+            current_gid = gid
+            album_msgs = [m]
+        else:
+            current_gid = None
+            album_msgs = []
+            units += 1
+            yield [m]
+
+    # финальный альбом
+    if current_gid is not None and album_msgs:
+        if limit and read >= limit and units:
+            log.info("scan | album gid=%s cut by limit, left for the next run", current_gid)
+            return
+        yield album_msgs
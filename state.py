@@ -1,16 +1,397 @@
 from __future__ import annotations
 import os
 import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from dotenv import set_key
 from pathlib import Path
 
 log = logging.getLogger("tg_sync.state")
 
-class EnvStateStore:
+
+@dataclass(frozen=True)
+class Fingerprint:
+    """Отпечаток скопированного юнита: по нему видно, что пост в источнике правили (см. edits)."""
+    unit_id: int    # id первого сообщения юнита в источнике
+    text_id: int    # id сообщения в DEST с текстом/подписью юнита; 0 — текст ушёл несколькими сообщениями
+    edit_date: int  # последний edit_date среди сообщений юнита (unix time), 0 — не правился
+    text_hash: str  # текст и сущности
+    media: str      # media_key сообщений юнита по порядку, через пробел ("-" — без медиа)
+
+
+class StateStore(ABC):
+    """
+    Состояние синхронизации одного источника:
+    watermark (last_seen) и карта source id -> dest id для постов и комментариев (kind="post"/"comment");
+    kind="top" — верх треда в discussion-группе -> пост источника (0 — не пост источника).
+    """
+
+    @abstractmethod
+    def get_last_seen(self) -> int | None:
+        ...
+
+    @abstractmethod
+    def update_last_seen(self, value: int) -> None:
+        ...
+
+    @abstractmethod
+    def record_ids(self, kind: str, id_map: dict[int, int]) -> None:
+        ...
+
+    @abstractmethod
+    def dest_id(self, kind: str, src_id: int) -> int | None:
+        ...
+
+    # --- треды комментариев: пост источника -> пост назначения + watermark комментариев ---
+
+    @abstractmethod
+    def register_thread(self, src_post_id: int, dest_post_id: int) -> None:
+        ...
+
+    @abstractmethod
+    def thread_dest(self, src_post_id: int) -> int | None:
+        ...
+
+    @abstractmethod
+    def comment_watermark(self, src_post_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def update_comment_watermark(self, src_post_id: int, value: int) -> None:
+        ...
+
+    @abstractmethod
+    def recent_threads(self, limit: int) -> list[tuple[int, int, int]]:
+        """Последние limit тредов: (src_post_id, dest_post_id, comment_watermark), новые первыми."""
+
+    # --- альбом, которым закончился прошлый проход: (grouped_id, max id) ---
+
+    @abstractmethod
+    def get_open_album(self) -> tuple[int, int] | None:
+        ...
+
+    @abstractmethod
+    def set_open_album(self, value: tuple[int, int] | None) -> None:
+        ...
+
+    # --- отпечатки скопированных юнитов по id первого сообщения (правки постов, TG_EDITS_RECHECK) ---
+
+    @abstractmethod
+    def record_fingerprint(self, fp: Fingerprint) -> None:
+        ...
+
+    @abstractmethod
+    def fingerprint(self, unit_id: int) -> Fingerprint | None:
+        ...
+
+    # --- discussion-группа источника (TG_COMMENTS_MODE=group): id последнего разобранного сообщения ---
+
+    @abstractmethod
+    def get_discussion_watermark(self) -> int:
+        ...
+
+    @abstractmethod
+    def set_discussion_watermark(self, value: int) -> None:
+        ...
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+
+class EnvStateStore(StateStore):
+    """Исходный вариант: TG_LAST_SEEN_ID в .env; карта id живёт только в памяти процесса."""
+
     def __init__(self, dotenv_path: Path):
         self.dotenv_path = dotenv_path
+        self._ids: dict[tuple[str, int], int] = {}
+        self._threads: dict[int, list[int]] = {}  # src_post_id -> [dest_post_id, watermark]
+        self._fingerprints: dict[int, Fingerprint] = {}
+        self._discussion_wm = 0
+
+    def get_last_seen(self) -> int | None:
+        raw = os.getenv("TG_LAST_SEEN_ID", "").strip()
+        return int(raw) if raw else None
 
     def update_last_seen(self, value: int) -> None:
         set_key(str(self.dotenv_path), "TG_LAST_SEEN_ID", str(value))
         os.environ["TG_LAST_SEEN_ID"] = str(value)
         log.info("state: TG_LAST_SEEN_ID=%s (saved to .env)", value)
+
+    def record_ids(self, kind: str, id_map: dict[int, int]) -> None:
+        for src_id, dest_id in id_map.items():
+            self._ids[(kind, src_id)] = dest_id
+
+    def dest_id(self, kind: str, src_id: int) -> int | None:
+        return self._ids.get((kind, src_id))
+
+    def register_thread(self, src_post_id: int, dest_post_id: int) -> None:
+        self._threads.setdefault(src_post_id, [dest_post_id, 0])[0] = dest_post_id
+
+    def thread_dest(self, src_post_id: int) -> int | None:
+        t = self._threads.get(src_post_id)
+        return t[0] if t else None
+
+    def comment_watermark(self, src_post_id: int) -> int:
+        return self._threads.get(src_post_id, [0, 0])[1]
+
+    def update_comment_watermark(self, src_post_id: int, value: int) -> None:
+        if src_post_id in self._threads:
+            self._threads[src_post_id][1] = value
+
+    def recent_threads(self, limit: int) -> list[tuple[int, int, int]]:
+        return [(s, d, w) for s, (d, w) in sorted(self._threads.items(), reverse=True)[:limit]]
+
+    def get_open_album(self) -> tuple[int, int] | None:
+        gid, sep, last_id = os.getenv("TG_OPEN_ALBUM", "").strip().partition(":")
+        return (int(gid), int(last_id)) if sep else None
+
+    def set_open_album(self, value: tuple[int, int] | None) -> None:
+        raw = f"{value[0]}:{value[1]}" if value else ""
+        if raw == os.getenv("TG_OPEN_ALBUM", "").strip():
+            return
+        set_key(str(self.dotenv_path), "TG_OPEN_ALBUM", raw)
+        os.environ["TG_OPEN_ALBUM"] = raw
+
+    def record_fingerprint(self, fp: Fingerprint) -> None:
+        # только на время процесса: TG_EDITS_RECHECK с этим бэкендом не запускается
+        self._fingerprints[fp.unit_id] = fp
+
+    def fingerprint(self, unit_id: int) -> Fingerprint | None:
+        return self._fingerprints.get(unit_id)
+
+    def get_discussion_watermark(self) -> int:
+        # только на время процесса, как и карта постов: TG_COMMENTS_MODE=group с этим бэкендом не запускается
+        return self._discussion_wm
+
+    def set_discussion_watermark(self, value: int) -> None:
+        self._discussion_wm = value
+
+
+# сколько ждать, если базу держит другой процесс (второй экземпляр, sqlite3 в консоли)
+BUSY_TIMEOUT = 10.0
+
+
+class StateDb:
+    """
+    Соединение с базой состояния, одно на процесс: пары TG_JOBS_FILE пишут в него по очереди
+    (event loop один), так что друг друга не блокируют. Записи копятся в открытой транзакции
+    и коммитятся пачкой — каждые commit_every изменений или commit_interval секунд, а также в flush()/close().
+    """
+
+    def __init__(self, path: Path, *, commit_every: int = 50, commit_interval: float = 2.0):
+        self.path = path
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+
+        self.conn = sqlite3.connect(str(path), timeout=BUSY_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS watermarks (
+                source    TEXT PRIMARY KEY,
+                last_seen INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS id_map (
+                source  TEXT    NOT NULL,
+                kind    TEXT    NOT NULL,
+                src_id  INTEGER NOT NULL,
+                dest_id INTEGER NOT NULL,
+                PRIMARY KEY (source, kind, src_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS comment_threads (
+                source          TEXT    NOT NULL,
+                src_post_id     INTEGER NOT NULL,
+                dest_post_id    INTEGER NOT NULL,
+                last_comment_id INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (source, src_post_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS open_albums (
+                source     TEXT PRIMARY KEY,
+                grouped_id INTEGER NOT NULL,
+                last_id    INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                source    TEXT    NOT NULL,
+                unit_id   INTEGER NOT NULL,
+                text_id   INTEGER NOT NULL,
+                edit_date INTEGER NOT NULL,
+                text_hash TEXT    NOT NULL,
+                media     TEXT    NOT NULL,
+                PRIMARY KEY (source, unit_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS discussion_watermarks (
+                source  TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL
+            );
+            """
+        )
+        self.conn.commit()
+
+        self.pending = 0
+        self._last_commit = time.monotonic()
+
+    def written(self, n: int) -> bool:
+        """Учитывает n изменений; True — пачка набралась и закоммичена."""
+        self.pending += n
+        if self.pending >= self.commit_every or time.monotonic() - self._last_commit >= self.commit_interval:
+            self.commit()
+            return True
+        return False
+
+    def commit(self) -> int:
+        """Коммитит открытую транзакцию; возвращает, сколько изменений в ней было."""
+        n = self.pending
+        if n:
+            self.conn.commit()
+        self.pending = 0
+        self._last_commit = time.monotonic()
+        return n
+
+    def close(self) -> None:
+        self.commit()
+        self.conn.close()
+
+
+class SqliteStateStore(StateStore):
+    """
+    SQLite (WAL): watermark по источнику и полная карта id, строки — по source.
+    Без db открывает свою базу path; с db (StateDb) — пишет в общее соединение процесса
+    и не закрывает его в close().
+    """
+
+    def __init__(self, path: Path, source: str, *, commit_every: int = 50, commit_interval: float = 2.0,
+                 db: StateDb | None = None):
+        self.path = path
+        self.source = source
+        self._own = db is None
+        self.db = db or StateDb(path, commit_every=commit_every, commit_interval=commit_interval)
+        self._db = self.db.conn
+
+    def get_last_seen(self) -> int | None:
+        row = self._db.execute("SELECT last_seen FROM watermarks WHERE source = ?", (self.source,)).fetchone()
+        return row[0] if row else None
+
+    def update_last_seen(self, value: int) -> None:
+        self._db.execute(
+            "INSERT INTO watermarks (source, last_seen) VALUES (?, ?) "
+            "ON CONFLICT(source) DO UPDATE SET last_seen = excluded.last_seen",
+            (self.source, value),
+        )
+        log.debug("state: last_seen=%s source=%s", value, self.source)
+        self._written(1)
+
+    def record_ids(self, kind: str, id_map: dict[int, int]) -> None:
+        if not id_map:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO id_map (source, kind, src_id, dest_id) VALUES (?, ?, ?, ?)",
+            [(self.source, kind, s, d) for s, d in id_map.items()],
+        )
+        self._written(len(id_map))
+
+    def dest_id(self, kind: str, src_id: int) -> int | None:
+        row = self._db.execute(
+            "SELECT dest_id FROM id_map WHERE source = ? AND kind = ? AND src_id = ?",
+            (self.source, kind, src_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def register_thread(self, src_post_id: int, dest_post_id: int) -> None:
+        self._db.execute(
+            "INSERT INTO comment_threads (source, src_post_id, dest_post_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(source, src_post_id) DO UPDATE SET dest_post_id = excluded.dest_post_id",
+            (self.source, src_post_id, dest_post_id),
+        )
+        self._written(1)
+
+    def thread_dest(self, src_post_id: int) -> int | None:
+        row = self._db.execute(
+            "SELECT dest_post_id FROM comment_threads WHERE source = ? AND src_post_id = ?",
+            (self.source, src_post_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def comment_watermark(self, src_post_id: int) -> int:
+        row = self._db.execute(
+            "SELECT last_comment_id FROM comment_threads WHERE source = ? AND src_post_id = ?",
+            (self.source, src_post_id),
+        ).fetchone()
+        return row[0] if row else 0
+
+    def update_comment_watermark(self, src_post_id: int, value: int) -> None:
+        self._db.execute(
+            "UPDATE comment_threads SET last_comment_id = ? WHERE source = ? AND src_post_id = ?",
+            (value, self.source, src_post_id),
+        )
+        self._written(1)
+
+    def recent_threads(self, limit: int) -> list[tuple[int, int, int]]:
+        return self._db.execute(
+            "SELECT src_post_id, dest_post_id, last_comment_id FROM comment_threads "
+            "WHERE source = ? ORDER BY src_post_id DESC LIMIT ?",
+            (self.source, limit),
+        ).fetchall()
+
+    def get_open_album(self) -> tuple[int, int] | None:
+        row = self._db.execute(
+            "SELECT grouped_id, last_id FROM open_albums WHERE source = ?", (self.source,)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def set_open_album(self, value: tuple[int, int] | None) -> None:
+        if value is None:
+            self._db.execute("DELETE FROM open_albums WHERE source = ?", (self.source,))
+        else:
+            self._db.execute(
+                "INSERT OR REPLACE INTO open_albums (source, grouped_id, last_id) VALUES (?, ?, ?)",
+                (self.source, value[0], value[1]),
+            )
+        self._written(1)
+
+    def record_fingerprint(self, fp: Fingerprint) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO fingerprints (source, unit_id, text_id, edit_date, text_hash, media) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.source, fp.unit_id, fp.text_id, fp.edit_date, fp.text_hash, fp.media),
+        )
+        self._written(1)
+
+    def fingerprint(self, unit_id: int) -> Fingerprint | None:
+        row = self._db.execute(
+            "SELECT unit_id, text_id, edit_date, text_hash, media FROM fingerprints WHERE source = ? AND unit_id = ?",
+            (self.source, unit_id),
+        ).fetchone()
+        return Fingerprint(*row) if row else None
+
+    def get_discussion_watermark(self) -> int:
+        row = self._db.execute(
+            "SELECT last_id FROM discussion_watermarks WHERE source = ?", (self.source,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_discussion_watermark(self, value: int) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO discussion_watermarks (source, last_id) VALUES (?, ?)",
+            (self.source, value),
+        )
+        self._written(1)
+
+    def flush(self) -> None:
+        n = self.db.commit()
+        if n:
+            log.info("state: committed %s changes (last_seen=%s)", n, self.get_last_seen())
+
+    def close(self) -> None:
+        if self._own:
+            self.db.close()
+        else:
+            self.flush()
+
+    def _written(self, n: int) -> None:
+        self.db.written(n)
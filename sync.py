@@ -0,0 +1,282 @@
+from __future__ import annotations
+import asyncio
+import logging
+import time
+
+from telethon import TelegramClient
+
+from config import Config
+from copier import PostCopier
+from metrics import SOURCE_LAG
+from pipeline import CopyPipeline
+from ratelimit import RateLimiter
+from retry import RetryPolicy
+from authors import AuthorCache
+from comments import CommentCopier
+from comment_queue import CommentQueue, CommentSyncWorker, PostPriority
+from discussion import DiscussionHarvester
+from edits import EditSync
+from journal import Journal, reconcile
+from pool import SessionPool, read_messages
+from recompress import Recompressor, recompress_options
+from scanner import reopen_album
+from state import StateStore
+from upload_cache import UploadCache
+
+log = logging.getLogger("tg_sync.sync")
+
+
+class SourceSync:
+    """
+    Всё, что нужно для синхронизации одной пары source -> dest:
+    копировщики постов и комментариев, очередь комментариев и текущий watermark.
+    Используется и разовым запуском (main.run), и демоном (daemon.run_daemon).
+    """
+
+    def __init__(self, client: TelegramClient, cfg: Config, state: StateStore, *, src, dst, last_seen: int,
+                 scheduler=None, upload_cache: UploadCache | None = None, authors: AuthorCache | None = None,
+                 limiter: RateLimiter | None = None, journal: Journal | None = None,
+                 pool: SessionPool | None = None, source_client=None, recompress_pool=None):
+        self.client = client
+        self.cfg = cfg
+        self.state = state
+        self.src = src
+        self.dst = dst
+        self.last_seen = last_seen
+        self.scheduler = scheduler  # jobs.FairScheduler, если пар несколько
+        self.upload_cache = upload_cache  # общий для всех пар процесса
+        self.journal = journal  # общий для всех пар процесса, записи по cfg.job_name
+        # source_client — откуда читать источник вместо client (archive.ArchiveReader при replay);
+        # архив читается с диска: пул не нужен, а скачивания не тратят токены download
+        self.reader = source_client or client
+        source_policy = RetryPolicy() if source_client is not None else None
+        if source_client is not None:
+            pool = None
+        self.pool = pool  # читающие аккаунты, общие для всех пар процесса
+        if pool is not None:
+            pool.register(cfg.source)
+        # пул процессов пересжатия общий на процесс, пороги — свои у каждой пары
+        options = recompress_options(cfg)
+        self.recompressor = Recompressor(recompress_pool, options) if recompress_pool and options else None
+
+        self.copier = PostCopier(
+            client,
+            tmp_dir=cfg.tmp_dir,
+            cleanup=cfg.cleanup,
+            link_preview=cfg.link_preview,
+            force_document=cfg.force_document,
+            copy_mode=cfg.copy_mode,
+            transfer_mode=cfg.transfer_mode,
+            stream_small=cfg.stream_small,
+            stream_buffer=cfg.stream_buffer,
+            album_concurrency=cfg.album_concurrency,
+            parallel_min=cfg.parallel_download_min,
+            download_parts=cfg.download_parts,
+            parallel_upload_min=cfg.parallel_upload_min,
+            upload_parts=cfg.upload_parts,
+            upload_cache=upload_cache,
+            limiter=limiter,
+            readers=pool,
+            source_client=source_client,
+            source_policy=source_policy,
+            recompressor=self.recompressor,
+        )
+
+        self.comment_copier = CommentCopier(
+            client,
+            limit=cfg.comments_limit,
+            include_author=cfg.comments_include_author,
+            author_style=cfg.comments_author_style,
+            tmp_dir=cfg.tmp_dir,
+            cleanup=cfg.cleanup,
+            transfer_mode=cfg.transfer_mode,
+            stream_small=cfg.stream_small,
+            stream_buffer=cfg.stream_buffer,
+            album_concurrency=cfg.album_concurrency,
+            parallel_min=cfg.parallel_download_min,
+            download_parts=cfg.download_parts,
+            parallel_upload_min=cfg.parallel_upload_min,
+            upload_parts=cfg.upload_parts,
+            state=state,
+            upload_cache=upload_cache,
+            authors=authors,
+            limiter=limiter,
+            job=cfg.job_name,
+            journal=journal,
+            readers=pool,
+            source_client=source_client,
+            source_policy=source_policy,
+            recompressor=self.recompressor,
+        )
+
+        self.priority = PostPriority()
+        self.comment_worker = CommentSyncWorker(
+            self.comment_copier,
+            CommentQueue(cfg.comments_queue_file),
+            src=src,
+            dest=dst,
+            concurrency=cfg.comments_workers,
+            priority=self.priority,
+        )
+        # TG_COMMENTS_MODE=group: комментарии всех тредов одним проходом по discussion-группе вместо очереди тредов
+        self.discussion: DiscussionHarvester | None = None
+        if cfg.sync_comments and cfg.comments_mode == "group":
+            if source_client is not None:
+                log.warning("%s: TG_COMMENTS_MODE=group needs the live discussion group, replay copies comments "
+                            "thread by thread", cfg.job_name)
+            else:
+                self.discussion = DiscussionHarvester(self.comment_copier, state, src=src, dest=dst)
+
+        # TG_EDITS_RECHECK: правки последних постов источника переносятся в DEST
+        self.edits = EditSync(self.copier, state, src=src, dest=dst, window=cfg.edits_recheck, reader=self.reader,
+                              pool=pool, job=cfg.job_name) if cfg.edits_recheck > 0 else None
+
+        self.scanned = 0
+        self.copied_units = 0
+        self.head_id = last_seen  # последний известный id в источнике (для метрики отставания)
+
+    async def recheck_comments(self) -> None:
+        if self.cfg.sync_comments and self.cfg.comments_recheck and self.discussion is None:
+            await self.comment_worker.recheck(self.state, self.cfg.comments_recheck)
+
+    def note_head(self, msg_id: int) -> None:
+        self.head_id = max(self.head_id, msg_id)
+        self._report_lag(self.last_seen)
+
+    def _report_lag(self, last_seen: int) -> None:
+        SOURCE_LAG.set(max(0, self.head_id - last_seen), job=self.cfg.job_name)
+
+    async def _fetch_head(self) -> None:
+        latest = await read_messages(self.pool, self.reader, self.src, limit=1, ctx="source head",
+                                     policy=self.copier.policy)
+        if latest:
+            self.note_head(latest[0].id)
+
+    async def _history_readers(self) -> SessionPool | None:
+        """
+        Пул для чтения истории и тредов — только у защищённого источника: медиа из него всё равно
+        перезаливаются, а handle сообщений, прочитанных другим аккаунтом, основному не годятся.
+        """
+        if self.pool is None or not getattr(self.src, "noforwards", False):
+            return None
+        return self.pool if await self.pool.covers(self.src) else None
+
+    async def reconcile(self, kind: str) -> None:
+        """Сверка журнала после рестарта: юниты, отправленные до падения, не отправляются повторно."""
+        if self.journal is None:
+            return
+        recovered = await reconcile(self.journal, self.client, self.dst, self.state, job=self.cfg.job_name,
+                                    kind=kind, policy=self.copier.policy)
+        if recovered:
+            log.info("journal | %s | recovered %s %s units sent before restart", self.cfg.job_name, recovered, kind)
+        if kind == "post":
+            self.last_seen = max(self.last_seen, self.state.get_last_seen() or 0)
+
+    def _checkpoint(self) -> None:
+        # записи журнала удаляем только после того, как state их сохранил
+        flushed_at = time.time()
+        self.state.flush()
+        if self.journal is not None:
+            self.journal.prune(self.cfg.job_name, flushed_at)
+
+    async def _on_published(self, res) -> None:
+        # публикация идёт по порядку — src_max_id и есть текущий last_seen
+        self._report_lag(res.src_max_id)
+        # по метаданным replies: у поста без комментариев тред не запрашиваем вовсе
+        if (self.cfg.sync_comments and self.discussion is None
+                and res.comments_max_id > self.state.comment_watermark(res.src_root_post_id)):
+            self.comment_worker.submit(
+                src_post_id=res.src_root_post_id,  # <-- ВАЖНО
+                dest_post_id=res.dest_root_post_id,
+            )
+
+    async def catch_up(self, overlap: int = 0) -> None:
+        """
+        Один проход конвейера постов от текущего watermark до головы канала.
+        Обрезанный на границе прошлого прохода альбом перечитывается по id (state.get_open_album),
+        overlap — дополнительное окно пересканирования назад от watermark (по умолчанию не нужно).
+        """
+        # pending-посты могут остаться только от прошлого прохода: конвейер сейчас не работает
+        await self.reconcile("post")
+        await self._fetch_head()
+        min_id = max(self.last_seen - overlap, 0)
+        reopened = await reopen_album(self.reader, self.src, self.state.get_open_album(), min_id=min_id,
+                                      policy=self.copier.policy)
+        readers = await self._history_readers()
+        self.comment_copier.history = readers
+        pipeline = CopyPipeline(
+            self.reader,
+            self.copier,
+            src=self.src,
+            dest=self.dst,
+            state=self.state,
+            last_seen=self.last_seen,
+            min_id=min_id,
+            limit=self.cfg.limit,
+            workers=self.cfg.workers,
+            depth=self.cfg.queue_depth,
+            on_published=self._on_published,
+            priority=self.priority,
+            scheduler=self.scheduler,
+            name=self.cfg.job_name,
+            reopened=reopened,
+            journal=self.journal,
+            readers=readers,
+            fingerprints=self.edits is not None,
+        )
+        try:
+            await pipeline.run()
+            # проход дочитан до конца — запоминаем, не оборвался ли он на альбоме
+            if pipeline.tail is not None:
+                self.state.set_open_album(pipeline.open_album())
+        finally:
+            self.last_seen = pipeline.last_seen
+            self.scanned += pipeline.scanned
+            self.copied_units += pipeline.copied_units
+            self._report_lag(self.last_seen)
+            self._checkpoint()
+
+    async def harvest_comments(self) -> None:
+        """Проход по discussion-группе (TG_COMMENTS_MODE=group) — после постов, когда их треды уже известны."""
+        if self.discussion is None:
+            return
+        await self.discussion.run(last_seen=self.last_seen, readers=await self._history_readers())
+
+    async def recheck_edits(self) -> None:
+        """Правки уже скопированных постов — после прохода, когда last_seen актуален."""
+        if self.edits is not None:
+            await self.edits.run(last_seen=self.last_seen)
+
+    async def run_once(self) -> None:
+        """
+        Разовый запуск: посты и комментарии параллельно, затем дожидаемся очереди комментариев
+        (с TG_COMMENTS_MODE=group очередь пуста — комментарии копирует проход по группе после постов).
+        """
+        await self.reconcile("comment")
+        await self.recheck_comments()
+        posts = asyncio.ensure_future(self.catch_up(overlap=self.cfg.overlap))
+        try:
+            await self.comment_worker.run(until=posts)
+        finally:
+            if not posts.done():
+                posts.cancel()
+            await asyncio.gather(posts, return_exceptions=True)
+        posts.result()
+        await self.harvest_comments()
+        await self.recheck_edits()
+        self._checkpoint()
+
+    def log_summary(self) -> None:
+        log.info("done | %s | scanned=%s copied_units=%s last_seen=%s",
+                 self.cfg.job_name, self.scanned, self.copied_units, self.last_seen)
+        posts, comments = self.copier.media.stats, self.comment_copier.media.stats
+        log.info("media | %s | posts zero_copy=%s cached=%s reupload=%s | comments zero_copy=%s cached=%s reupload=%s",
+                 self.cfg.job_name, posts.zero_copy_units, posts.cached_units, posts.reupload_units,
+                 comments.zero_copy_units, comments.cached_units, comments.reupload_units)
+        if self.discussion is not None:
+            log.info("discussion | %s | scanned=%s copied=%s skipped=%s", self.cfg.job_name,
+                     self.discussion.scanned, self.discussion.copied, self.discussion.skipped)
+        if self.edits is not None:
+            log.info("edits | %s | checked=%s edited=%s", self.cfg.job_name, self.edits.checked, self.edits.edited)
+        if self.recompressor is not None:
+            log.info("recompress | %s | %s", self.cfg.job_name, self.recompressor.summary())
@@ -3,5 +3,7 @@ from telethon.sessions import StringSession
 from config import Config
 
 
-def create_client(cfg: Config) -> TelegramClient:
-    return TelegramClient(StringSession(cfg.session), cfg.api_id, cfg.api_hash)
+def create_client(cfg: Config, session: str | None = None, **kwargs) -> TelegramClient:
+    """session — StringSession другого аккаунта (см. pool.py), по умолчанию TG_SESSION."""
+    return TelegramClient(StringSession(cfg.session if session is None else session), cfg.api_id, cfg.api_hash,
+                          **kwargs)
@@ -0,0 +1,138 @@
+import asyncio
+
+from telethon.tl import types
+
+from authors import AuthorCache, author_label, author_mention, with_author
+from comments import CommentCopier
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient, SOURCE_ID
+
+
+def _fake():
+    return FakeTelegramClient(ChannelSpec(posts=0, unknown_sender_rate=0), FakeNetwork(latency=0))
+
+
+def _comment(fake, msg_id: int, sender: int, *, on_page: bool = True):
+    m = fake._message(msg_id, SOURCE_ID, "text", sender=sender)
+    if not on_page:
+        m._sender = None  # отправителя не было среди users страницы истории
+    return m
+
+
+def test_author_label():
+    assert author_label(types.User(id=1, username="ann", first_name="Ann")) == "@ann"
+    assert author_label(types.User(id=2, first_name="Ann", last_name="Lee")) == "Ann Lee"
+    assert author_label(types.User(id=3)) == "3"
+    assert author_label(None) == "unknown"
+
+
+def test_primed_senders_need_no_lookup():
+    fake = _fake()
+    cache = AuthorCache()
+    msgs = [_comment(fake, i, 100 + i % 3) for i in range(10)]
+    cache.prime(msgs)
+
+    async def run():
+        return [await cache.label(m) for m in msgs]
+
+    assert asyncio.run(run()) == [author_label(fake.users[m.sender_id]) for m in msgs]
+    assert cache.lookups == 0 and "get_users" not in fake.calls
+
+
+def test_unknown_sender_looked_up_once():
+    fake = _fake()
+    cache = AuthorCache()
+
+    async def run():
+        return [await cache.label(_comment(fake, i, 101, on_page=False)) for i in range(3)]
+
+    labels = asyncio.run(run())
+    assert labels == [author_label(fake.users[101])] * 3
+    assert (cache.lookups, cache.hits) == (1, 2)
+
+
+def test_lru_keeps_recent_senders():
+    fake = _fake()
+    cache = AuthorCache(max_entries=2)
+    cache.prime([_comment(fake, 1, 100), _comment(fake, 2, 101)])
+
+    async def run():
+        await cache.label(_comment(fake, 3, 100, on_page=False))  # 100 использован последним
+        cache.prime([_comment(fake, 4, 102)])                     # вытесняет 101
+        await cache.label(_comment(fake, 5, 101, on_page=False))
+
+    asyncio.run(run())
+    assert cache.lookups == 1 and cache.hits == 1
+    assert list(cache._labels) == [102, 101]
+
+
+def test_labels_survive_restart(tmp_path):
+    fake = _fake()
+    cache = AuthorCache(tmp_path / "authors.db")
+    cache.prime([_comment(fake, 1, 100)])
+    cache.close()
+
+    cache = AuthorCache(tmp_path / "authors.db")
+    assert asyncio.run(cache.label(_comment(fake, 2, 100, on_page=False))) == author_label(fake.users[100])
+    assert cache.lookups == 0
+
+
+def test_with_author_shifts_entities():
+    # эмодзи — две UTF-16 единицы: сдвиг считается в них, а не в символах Python
+    label = "Ann 🙂"
+    text = "see link"
+    link = types.MessageEntityTextUrl(offset=4, length=4, url="https://example.com")
+    out, entities = with_author(label, text, [link])
+
+    assert out == "Ann 🙂:\nsee link"
+    bold, shifted = entities
+    assert (type(bold), bold.offset, bold.length) == (types.MessageEntityBold, 0, 7)
+    assert (shifted.offset, shifted.length, shifted.url) == (4 + 8, 4, link.url)
+    assert link.offset == 4  # исходная сущность не изменена
+
+
+def test_with_author_mention():
+    user = types.InputUser(user_id=7, access_hash=70)
+    out, entities = with_author("Ann", "", [], user=user)
+    assert out == "Ann:"
+    mention = entities[1]
+    assert isinstance(mention, types.InputMessageEntityMentionName)
+    assert (mention.offset, mention.length, mention.user_id) == (0, 3, user)
+
+
+def test_author_mention():
+    fake = _fake()
+    named = _comment(fake, 1, 101)   # у User101 есть username
+    plain = _comment(fake, 2, 102)   # у User102 нет
+    assert fake.users[101].username and not fake.users[102].username
+    assert author_mention(named) is None
+    assert author_mention(plain) == types.InputUser(102, fake.users[102].access_hash)
+
+    plain._sender = types.User(id=102, min=True, first_name="User102")
+    plain._input_chat = types.InputPeerChannel(SOURCE_ID, 1)
+    assert author_mention(plain) == types.InputUserFromMessage(plain._input_chat, 2, 102)
+    assert author_mention(_comment(fake, 3, 102, on_page=False)) is None
+
+
+def test_inline_comment_links_author(tmp_path):
+    fake = FakeTelegramClient(ChannelSpec(posts=10, comments_per_post=6, sticker_every=0, file_size=1000,
+                                          big_file_every=0), FakeNetwork(latency=0))
+    copier = CommentCopier(fake, tmp_dir=tmp_path, cleanup=True, author_style="inline")
+    send_message = fake.send_message
+    sent = []
+
+    async def spy(entity, message="", **kw):
+        sent.append((message, kw.get("formatting_entities") or []))
+        return await send_message(entity, message, **kw)
+
+    fake.send_message = spy
+    # тред, где у кого-то из авторов текстовых комментариев нет username
+    post = next(p for p, cs in fake.comments.items()
+                if any(not c.media and not fake.users[c.sender_id].username for c in cs))
+    asyncio.run(copier.copy_comments_for_post(fake.source, fake.dest, src_post_id=post, dest_post_id=post))
+
+    src = {c.message: c for c in fake.comments[post]}
+    assert any(isinstance(e, types.InputMessageEntityMentionName) for _, entities in sent for e in entities)
+    for text, entities in sent:
+        c = src[text.partition("\n")[2]]
+        mentions = [e for e in entities if isinstance(e, types.InputMessageEntityMentionName)]
+        assert [e.user_id for e in mentions] == ([] if fake.users[c.sender_id].username else [author_mention(c)])
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import comment_queue
+from comment_queue import MAX_ATTEMPTS, CommentJob, CommentQueue, CommentSyncWorker
+from metrics import COMMENT_QUEUE_JOBS, COMMENT_QUEUE_LAG
+
+
+def _copier(job: str, results: dict):
+    """Заглушка CommentCopier: results[src_post_id] — что вернёт копирование треда (по умолчанию True)."""
+    calls: list[int] = []
+
+    async def copy_comments_for_post(src, dest, *, src_post_id, dest_post_id):
+        calls.append(src_post_id)
+        return results.get(src_post_id, True)
+
+    return SimpleNamespace(job=job, priority=None, copy_comments_for_post=copy_comments_for_post, calls=calls)
+
+
+def test_queue_survives_restart(tmp_path):
+    path = tmp_path / "queue.json"
+    q = CommentQueue(path)
+    for post in (1, 2, 3):
+        q.push(CommentJob(src_post_id=post, dest_post_id=post + 100, enqueued_at=time.time()))
+    q.done(q.pending()[0])
+    q.failed(q.pending()[0])
+
+    restored = CommentQueue(path)
+    assert [(j.src_post_id, j.dest_post_id, j.attempts) for j in restored.pending()] == [(2, 102, 1), (3, 103, 0)]
+
+
+def test_worker_restores_pending_jobs(tmp_path):
+    path = tmp_path / "queue.json"
+    CommentQueue(path).push(CommentJob(src_post_id=5, dest_post_id=105, enqueued_at=time.time()))
+    copier = _copier("restore", {})
+    worker = CommentSyncWorker(copier, CommentQueue(path), src=None, dest=None)
+
+    async def run():
+        until = asyncio.ensure_future(asyncio.sleep(0))
+        await worker.run(until)
+
+    asyncio.run(run())
+    assert copier.calls == [5]
+    assert len(CommentQueue(path)) == 0
+
+
+def test_failed_job_retried_then_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(comment_queue, "RETRY_DELAY", 0.0)
+    path = tmp_path / "queue.json"
+    copier = _copier("retry", {1: False})
+    worker = CommentSyncWorker(copier, CommentQueue(path), src=None, dest=None)
+
+    async def run():
+        worker.submit(1, 101)
+        worker.submit(2, 102)
+        # daemon: повторы идут, пока конвейер постов работает
+        until = asyncio.ensure_future(asyncio.sleep(0.1))
+        await worker.run(until)
+
+    asyncio.run(run())
+    assert copier.calls.count(1) == MAX_ATTEMPTS and copier.calls.count(2) == 1
+    assert (worker.done_jobs, worker.failed_jobs) == (1, 1)
+    assert len(CommentQueue(path)) == 0
+
+
+def test_one_shot_run_keeps_failed_job(tmp_path):
+    path = tmp_path / "queue.json"
+    copier = _copier("drain", {1: False})
+    worker = CommentSyncWorker(copier, CommentQueue(path), src=None, dest=None)
+
+    async def run():
+        worker.submit(1, 101)
+        await worker.run(asyncio.ensure_future(asyncio.sleep(0)))
+
+    asyncio.run(run())
+    # разовый запуск не ждёт паузы перед повтором — задание ждёт следующего запуска в файле
+    assert [(j.src_post_id, j.attempts) for j in CommentQueue(path).pending()] == [(1, 1)]
+
+
+def test_queue_metrics_exported(tmp_path):
+    copier = _copier("gauges", {})
+    worker = CommentSyncWorker(copier, CommentQueue(tmp_path / "queue.json"), src=None, dest=None)
+    worker.submit(10, 110)
+    worker.submit(12, 112)
+    worker.submit(15, 115)
+    assert COMMENT_QUEUE_JOBS.values[("gauges",)] == 3
+    assert COMMENT_QUEUE_LAG.values[("gauges",)] == 5
+
+    async def run():
+        await worker.run(asyncio.ensure_future(asyncio.sleep(0)))
+
+    asyncio.run(run())
+    assert COMMENT_QUEUE_JOBS.values[("gauges",)] == 0
+    assert COMMENT_QUEUE_LAG.values[("gauges",)] == 0
@@ -0,0 +1,64 @@
+import asyncio
+
+from copier import FORWARD_BATCH, PostCopier, is_copyable
+from edits import _units
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient
+
+
+def _setup(tmp_path, **spec):
+    fake = FakeTelegramClient(ChannelSpec(comments_every=0, file_size=1000, big_file_every=0, **spec),
+                              FakeNetwork(latency=0))
+    copier = PostCopier(fake, tmp_path, True, False, False, copy_mode="forward")
+    return fake, copier, _units(fake.posts)
+
+
+def test_forward_in_batches(tmp_path):
+    fake, copier, units = _setup(tmp_path, posts=250)
+    results = asyncio.run(copier.forward_units(fake.dest, fake.source, units))
+
+    copyable = sum(1 for m in fake.posts if is_copyable(m))
+    assert fake.calls["forward_messages"] == -(-copyable // FORWARD_BATCH)
+    assert "send_message" not in fake.calls and "send_file" not in fake.calls
+    # альбом не разрезается между пачками
+    assert all(len(set(m.grouped_id for m in fake.dest_posts if m.id in r.id_map.values())) == 1
+               for r in results if r.kind == "album")
+
+
+def test_forward_maps_ids_in_order(tmp_path):
+    fake, copier, units = _setup(tmp_path, posts=40)
+    results = asyncio.run(copier.forward_units(fake.dest, fake.source, units))
+
+    assert len(results) == len(units)
+    src = {m.id: m for m in fake.posts}
+    dest = {m.id: m for m in fake.dest_posts}
+    for unit, res in zip(units, results):
+        assert res.src_max_id == max(m.id for m in unit)
+        assert set(res.id_map) == {m.id for m in unit}
+        for s, d in res.id_map.items():
+            assert dest[d].message == src[s].message and dest[d].media is src[s].media
+
+
+def test_not_forwarded_message_is_copied(tmp_path):
+    fake, copier, units = _setup(tmp_path, posts=10)
+    skipped = units[2][0].id
+    forward = fake.forward_messages
+
+    async def partial(entity, messages, from_peer=None, **kw):
+        # Telegram возвращает None вместо сообщения, которое не удалось переслать
+        out = await forward(entity, [i for i in messages if i != skipped], from_peer, **kw)
+        out.insert(messages.index(skipped), None)
+        return out
+
+    fake.forward_messages = partial
+    results = asyncio.run(copier.forward_units(fake.dest, fake.source, units))
+    assert fake.calls["forward_messages"] == 1
+    assert sum(fake.calls.get(k, 0) for k in ("send_message", "send_file")) == 1
+    assert results[2].id_map[skipped] == fake.dest_posts[-1].id
+
+
+def test_protected_source_falls_back_to_copy(tmp_path):
+    fake, copier, units = _setup(tmp_path, posts=10, protected=True)
+    results = asyncio.run(copier.forward_units(fake.dest, fake.source, units))
+    assert "forward_messages" not in fake.calls
+    assert all(r is not None for r in results)
+    assert [m.message for m in fake.dest_posts if m.message] == [m.message for m in fake.posts if m.message]
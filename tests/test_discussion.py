@@ -0,0 +1,85 @@
+import asyncio
+
+from telethon import errors
+
+from comments import CommentCopier
+from discussion import MAX_FAILURES, DiscussionHarvester
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient
+from state import SqliteStateStore
+
+
+def _setup(tmp_path, publish=True):
+    fake = FakeTelegramClient(ChannelSpec(posts=30, file_size=1000, big_file_every=0), FakeNetwork(latency=0))
+    state = SqliteStateStore(tmp_path / "s.db", source="src")
+    copier = CommentCopier(fake, tmp_dir=tmp_path, cleanup=True, include_author=False, state=state, job="job")
+    if publish:
+        _publish(state, fake.comments)
+    return fake, state, DiscussionHarvester(copier, state, src=fake.source, dest=fake.dest)
+
+
+def _publish(state, posts):
+    # посты назначения получают те же id, что и в источнике
+    for p in posts:
+        state.register_thread(p, p)
+
+
+def test_comments_routed_to_their_threads(tmp_path):
+    fake, state, h = _setup(tmp_path)
+    asyncio.run(h.run(last_seen=fake.posts[-1].id))
+    assert {p: [m.message for m in v] for p, v in fake.dest_comments.items()} == \
+        {p: [m.message for m in v] for p, v in fake.comments.items()}
+    assert state.get_discussion_watermark() == fake.group[-1].id
+    # страница истории на каждые 100 сообщений группы, а не запрос на каждый тред
+    assert fake.calls["get_history"] == -(-len(fake.group) // 100)
+
+    # повторный проход ничего не копирует заново
+    asyncio.run(h.run(last_seen=fake.posts[-1].id))
+    assert sum(len(v) for v in fake.dest_comments.values()) == sum(len(v) for v in fake.comments.values())
+
+
+def test_stops_at_unpublished_post(tmp_path):
+    fake, state, h = _setup(tmp_path, publish=False)
+    posts = sorted(fake.comments)
+    half = posts[len(posts) // 2]
+    _publish(state, [p for p in posts if p < half])
+    asyncio.run(h.run(last_seen=half - 1))
+    assert set(fake.dest_comments) == {p for p in posts if p < half}
+
+    _publish(state, [p for p in posts if p >= half])
+    asyncio.run(h.run(last_seen=fake.posts[-1].id))
+    assert set(fake.dest_comments) == set(posts)
+
+
+def test_failing_comment_is_skipped(tmp_path, monkeypatch):
+    fake, state, h = _setup(tmp_path)
+    bad = next(iter(fake.comments.values()))[0].id
+    copy_unit = h.copier.copy_unit
+
+    async def flaky(src, dest, *, src_post_id, dest_post_id, unit):
+        if unit[0].id == bad:
+            raise ConnectionError("network")
+        return await copy_unit(src, dest, src_post_id=src_post_id, dest_post_id=dest_post_id, unit=unit)
+
+    monkeypatch.setattr(h.copier, "copy_unit", flaky)
+    for _ in range(MAX_FAILURES - 1):
+        asyncio.run(h.run(last_seen=fake.posts[-1].id))
+        assert h.skipped == 0 and state.get_discussion_watermark() < bad
+    asyncio.run(h.run(last_seen=fake.posts[-1].id))
+    assert h.skipped == 1
+    assert state.get_discussion_watermark() == fake.group[-1].id
+
+
+def test_bad_request_skipped_at_once(tmp_path, monkeypatch):
+    fake, state, h = _setup(tmp_path)
+    bad = next(iter(fake.comments.values()))[0].id
+    copy_unit = h.copier.copy_unit
+
+    async def broken(src, dest, *, src_post_id, dest_post_id, unit):
+        if unit[0].id == bad:
+            raise errors.BadRequestError(request=None, message="MEDIA_INVALID")
+        return await copy_unit(src, dest, src_post_id=src_post_id, dest_post_id=dest_post_id, unit=unit)
+
+    monkeypatch.setattr(h.copier, "copy_unit", broken)
+    asyncio.run(h.run(last_seen=fake.posts[-1].id))
+    assert h.skipped == 1
+    assert state.get_discussion_watermark() == fake.group[-1].id
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+
+from copier import PostCopier
+from edits import EditSync, unit_fingerprint
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient, SOURCE_ID, _document
+from pipeline import CopyPipeline
+from state import SqliteStateStore
+
+EDITED = datetime.datetime(2024, 2, 1, tzinfo=datetime.timezone.utc)
+
+
+def _setup(tmp_path):
+    """Источник: 1, 2 — текст, 3 4 — альбом с подписью; всё уже скопировано в DEST с отпечатками."""
+    fake = FakeTelegramClient(ChannelSpec(posts=0), FakeNetwork(latency=0))
+    fake.posts = [fake._message(1, SOURCE_ID, "first"), fake._message(2, SOURCE_ID, "second")]
+    fake.posts += [fake._message(i, SOURCE_ID, "caption" if i == 3 else "", media=_document(i, 1000), grouped_id=9)
+                   for i in (3, 4)]
+    state = SqliteStateStore(tmp_path / "s.db", source="src")
+    for unit in ([fake.posts[0]], [fake.posts[1]], fake.posts[2:]):
+        sent = [fake._out(fake.dest, media=m.media, text=m.message, grouped_id=7 if m.grouped_id else None)
+                for m in unit]
+        state.record_ids("post", {m.id: d.id for m, d in zip(unit, sent)})
+        state.register_thread(unit[0].id, sent[0].id)
+        state.record_fingerprint(unit_fingerprint(unit, sent[0].id))
+    copier = PostCopier(fake, tmp_path, True, False, False)
+    sync = EditSync(copier, state, src=fake.source, dest=fake.dest, window=10, reader=fake, job="job")
+    return fake, state, sync
+
+
+def test_text_edit_propagated(tmp_path):
+    fake, state, sync = _setup(tmp_path)
+    fake.posts[1].message = "second, edited"
+    fake.posts[1].edit_date = EDITED
+    asyncio.run(sync.run(last_seen=4))
+    assert [m.message for m in fake.dest_posts] == ["first", "second, edited", "caption", ""]
+    assert (sync.checked, sync.edited) == (3, 1)
+
+    # отпечаток обновлён — второй проход ничего не правит
+    asyncio.run(sync.run(last_seen=4))
+    assert sync.edited == 1 and fake.calls["edit_message"] == 1
+
+
+def test_same_edit_date_is_not_compared(tmp_path):
+    fake, state, sync = _setup(tmp_path)
+    fake.posts[0].message = "changed without edit_date"
+    asyncio.run(sync.run(last_seen=4))
+    assert "edit_message" not in fake.calls
+
+
+def test_edit_date_without_changes(tmp_path):
+    fake, state, sync = _setup(tmp_path)
+    fake.posts[0].edit_date = EDITED
+    asyncio.run(sync.run(last_seen=4))
+    assert "edit_message" not in fake.calls
+    assert state.fingerprint(1).edit_date == int(EDITED.timestamp())
+
+
+def test_album_caption_and_media(tmp_path):
+    fake, state, sync = _setup(tmp_path)
+    fake.posts[2].message = "new caption"
+    fake.posts[3].media = _document(99, 2000)
+    fake.posts[3].edit_date = EDITED
+    asyncio.run(sync.run(last_seen=4))
+    assert [m.message for m in fake.dest_posts[2:]] == ["new caption", ""]
+    assert fake.dest_posts[3].media.document.id == 99
+    assert fake.calls["edit_message"] == 2
+
+
+def test_unit_without_fingerprint_is_recorded(tmp_path):
+    fake, state, sync = _setup(tmp_path)
+    fake.posts.append(fake._message(5, SOURCE_ID, "old post"))
+    fake._out(fake.dest, text="old post")
+    state.register_thread(5, 5)
+    asyncio.run(sync.run(last_seen=5))
+    assert state.fingerprint(5).text_id == 5
+    assert "edit_message" not in fake.calls
+
+
+def test_pipeline_records_fingerprints_only_for_edit_recheck(tmp_path):
+    for enabled in (False, True):
+        fake = FakeTelegramClient(ChannelSpec(posts=10, comments_every=0, big_file_every=0), FakeNetwork(latency=0))
+        state = SqliteStateStore(tmp_path / f"{enabled}.db", source="src")
+        pipeline = CopyPipeline(fake, PostCopier(fake, tmp_path, True, False, False), src=fake.source,
+                                dest=fake.dest, state=state, last_seen=0, min_id=0, limit=None,
+                                fingerprints=enabled)
+        asyncio.run(pipeline.run())
+        assert pipeline.copied_units > 0
+        recorded = [m.id for m in fake.posts if state.fingerprint(m.id) is not None]
+        assert bool(recorded) is enabled
+        state.close()
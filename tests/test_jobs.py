@@ -0,0 +1,93 @@
+import asyncio
+
+from jobs import FairScheduler
+
+
+async def _publish(sched: FairScheduler, job: str, n: int, order: list):
+    for i in range(n):
+        async with sched.turn(job):
+            order.append(job)
+            await asyncio.sleep(0)
+
+
+def test_round_robin_between_jobs():
+    async def run():
+        sched = FairScheduler(1)
+        order: list = []
+        # у "a" втрое больше публикаций, но "b" и "c" не ждут, пока она закончит
+        await asyncio.gather(_publish(sched, "a", 6, order), _publish(sched, "b", 2, order),
+                             _publish(sched, "c", 2, order))
+        return order
+
+    order = asyncio.run(run())
+    assert order[:6] == ["a", "b", "c", "a", "b", "c"]
+    assert order[6:] == ["a"] * 4
+
+
+def test_concurrency_limit():
+    async def run():
+        sched = FairScheduler(2)
+        busy = peak = 0
+
+        async def one(job):
+            nonlocal busy, peak
+            async with sched.turn(job):
+                busy += 1
+                peak = max(peak, busy)
+                await asyncio.sleep(0.01)
+                busy -= 1
+
+        await asyncio.gather(*(one(f"j{i % 3}") for i in range(9)))
+        return peak, sched._free
+
+    assert asyncio.run(run()) == (2, 2)
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        sched = FairScheduler(1)
+        order: list = []
+        hold = asyncio.Event()
+
+        async def first():
+            async with sched.turn("a"):
+                await hold.wait()
+
+        async def waiter(job):
+            async with sched.turn(job):
+                order.append(job)
+
+        t_a = asyncio.create_task(first())
+        await asyncio.sleep(0)
+        t_b = asyncio.create_task(waiter("b"))
+        t_c = asyncio.create_task(waiter("c"))
+        await asyncio.sleep(0)
+        t_b.cancel()
+        await asyncio.gather(t_b, return_exceptions=True)
+        hold.set()
+        await asyncio.gather(t_a, t_c)
+        return order, sched._free, list(sched._ring)
+
+    assert asyncio.run(run()) == (["c"], 1, [])
+
+
+def test_cancel_after_slot_granted_passes_it_on():
+    async def run():
+        sched = FairScheduler(1)
+        order: list = []
+
+        async def waiter(job):
+            async with sched.turn(job):
+                order.append(job)
+
+        turn = sched.turn("a")
+        await turn.__aenter__()
+        t_b = asyncio.create_task(waiter("b"))
+        t_c = asyncio.create_task(waiter("c"))
+        await asyncio.sleep(0)
+        await turn.__aexit__(None, None, None)  # слот передан "b", но "b" ещё не проснулась
+        t_b.cancel()
+        await asyncio.gather(t_b, t_c, return_exceptions=True)
+        return order, sched._free
+
+    assert asyncio.run(run()) == (["c"], 1)
@@ -0,0 +1,75 @@
+import asyncio
+
+from fake_telegram import ChannelSpec, DEST_ID, FakeNetwork, FakeTelegramClient, SOURCE_ID, _document
+from journal import Entry, Journal, _match, media_sig, reconcile, unit_key
+from state import SqliteStateStore
+
+
+def _fake():
+    return FakeTelegramClient(ChannelSpec(posts=0), FakeNetwork(latency=0))
+
+
+def _entry(unit, kind="post") -> Entry:
+    media = [m for m in unit if m.media]
+    return Entry(kind=kind, src_id=unit[0].id, thread=0, dest_thread=0, src_ids=[m.id for m in unit],
+                 root=unit[0].id, key=unit_key(unit), media=len(media), status="pending",
+                 sigs=[media_sig(m) for m in media])
+
+
+def test_short_text_matches_whole_message_only():
+    fake = _fake()
+    e = _entry([fake._message(1, SOURCE_ID, "+")])
+    candidates = [fake._message(i, DEST_ID, text) for i, text in ((10, "a + b"), (11, "++"), (12, "Ann:\n+"))]
+    assert _match(e, candidates, 0) == ({1: 12}, 3)  # 12 — тот же текст с подписью автора inline
+    assert _match(e, candidates[:2], 0) is None
+
+
+def test_long_text_matches_prefix():
+    fake = _fake()
+    text = "x" * 5000
+    e = _entry([fake._message(1, SOURCE_ID, text)])
+    # длинный пост ушёл несколькими сообщениями — узнаётся по первому
+    candidates = [fake._message(20, DEST_ID, text[:4096]), fake._message(21, DEST_ID, text[4096:])]
+    assert _match(e, candidates, 0) == ({1: 20}, 1)
+
+
+def test_media_matched_by_signature():
+    fake = _fake()
+    e = _entry([fake._message(1, SOURCE_ID, "", media=_document(1, 500, "report.pdf"))])
+    candidates = [
+        fake._message(30, DEST_ID, "", media=_document(2, 500, "other.pdf")),
+        fake._message(31, DEST_ID, "", media=_document(3, 400, "report.pdf")),
+        fake._message(32, DEST_ID, "", media=_document(4, 500, "report.pdf")),  # перезалит: новый id
+    ]
+    assert _match(e, candidates, 0) == ({1: 32}, 3)
+    assert _match(e, candidates, 3) is None
+
+
+def test_album_maps_every_item():
+    fake = _fake()
+    unit = [fake._message(i, SOURCE_ID, "caption" if i == 1 else "", media=_document(i, 100 * i), grouped_id=5)
+            for i in (1, 2, 3)]
+    e = _entry(unit)
+    album = [fake._message(40 + i, DEST_ID, "caption" if i == 1 else "", media=_document(i, 100 * i),
+                           grouped_id=77) for i in (1, 2, 3)]
+    candidates = [fake._message(40, DEST_ID, "caption")] + album  # тот же текст, но без медиа — не он
+    assert _match(e, candidates, 0) == ({1: 41, 2: 42, 3: 43}, 4)
+
+
+def test_reconcile_recovers_sent_prefix(tmp_path):
+    fake = _fake()
+    units = [[fake._message(i, SOURCE_ID, f"post {i}")] for i in (1, 2, 3)]
+    journal = Journal(tmp_path / "j.db")
+    state = SqliteStateStore(tmp_path / "s.db", source="src")
+
+    async def run():
+        for unit in units:
+            journal.begin("job", "post", unit, dest=fake.dest)
+        # упали после отправки первых двух, до commit
+        for unit in units[:2]:
+            await fake.send_message(fake.dest, unit[0].message)
+        return await reconcile(journal, fake, fake.dest, state, job="job", kind="post")
+
+    assert asyncio.run(run()) == 2
+    assert [state.dest_id("post", i) for i in (1, 2, 3)] == [1, 2, None]
+    assert journal.entries("job", "post", "pending") == []
@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+from telethon import errors
+from telethon.tl import types
+
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient
+from media import MediaSender
+
+
+def _fake(**spec):
+    return FakeTelegramClient(ChannelSpec(comments_every=0, big_file_every=0, **spec), FakeNetwork(latency=0))
+
+
+def _sender(fake, tmp_path, **kw):
+    return MediaSender(fake, tmp_dir=tmp_path / "tmp", cleanup=True, force_document=False, **kw)
+
+
+def _media_post(fake):
+    return next(m for m in fake.posts if m.grouped_id is None and isinstance(m.media, types.MessageMediaDocument))
+
+
+def _downloads(fake) -> int:
+    return sum(fake.calls.get(k, 0) for k in ("download", "download_part"))
+
+
+def test_sent_by_handle_without_download(tmp_path):
+    fake = _fake(posts=20, file_size=1000)
+    sender = _sender(fake, tmp_path)
+    m = _media_post(fake)
+    sent = asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    assert sent.media.document.id == m.media.document.id
+    assert _downloads(fake) == 0 and "upload" not in fake.calls
+    assert (sender.stats.zero_copy_units, sender.stats.reupload_units) == (1, 0)
+
+
+def test_rejected_handle_falls_back_to_reupload(tmp_path):
+    fake = _fake(posts=20, file_size=1000)
+    sender = _sender(fake, tmp_path)
+    m = _media_post(fake)
+    send_file = fake.send_file
+
+    async def no_handles(entity, file, **kw):
+        if isinstance(file, types.MessageMediaDocument):
+            raise errors.FileReferenceExpiredError(request=None)
+        return await send_file(entity, file, **kw)
+
+    fake.send_file = no_handles
+    sent = asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    assert fake.calls["download"] == 1
+    assert sent.media.document.id != m.media.document.id
+    assert sent.media.document.size == m.media.document.size
+    assert (sender.stats.zero_copy_units, sender.stats.reupload_units) == (0, 1)
+    assert os.listdir(tmp_path / "tmp") == []  # скачанный файл и его каталог удалены
+
+
+def test_protected_source_is_not_sent_by_handle(tmp_path):
+    fake = _fake(posts=20, file_size=1000, protected=True)
+    sender = _sender(fake, tmp_path)
+    m = _media_post(fake)
+    send_file = fake.send_file
+    handles = []
+
+    async def spy(entity, file, **kw):
+        handles.append(isinstance(file, types.MessageMediaDocument))
+        return await send_file(entity, file, **kw)
+
+    fake.send_file = spy
+    asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    assert handles == [False]
+    assert fake.calls["download"] == 1
+
+
+def test_memory_mode_small_file_skips_disk(tmp_path):
+    fake = _fake(posts=20, file_size=1000, protected=True)
+    sender = _sender(fake, tmp_path, transfer_mode="memory")
+    m = _media_post(fake)
+    sent = asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    assert (fake.calls["download"], fake.calls["upload"]) == (1, 1)
+    assert sent.media.document.size == m.media.document.size
+    assert not (tmp_path / "tmp").exists()
+
+
+def test_memory_mode_streams_large_file(tmp_path):
+    size = 3 * 1024 * 1024 + 100
+    fake = _fake(posts=20, file_size=size, protected=True)
+    sender = _sender(fake, tmp_path, transfer_mode="memory", stream_small=1024 * 1024, stream_buffer=1024 * 1024)
+    m = _media_post(fake)
+    sent = asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    # части идут из iter_download прямо в saveFilePart: ни download_media, ни файла на диске
+    assert "download" not in fake.calls
+    assert fake.calls["download_part"] == fake.calls["upload_part"] == 7
+    assert sent.media.document.size == size
+    assert not (tmp_path / "tmp").exists()
+
+
+def _album(fake):
+    gid = next(m.grouped_id for m in fake.posts if m.grouped_id is not None)
+    return [m for m in fake.posts if m.grouped_id == gid]
+
+
+def _album_downloads(tmp_path, concurrency: int):
+    fake = FakeTelegramClient(ChannelSpec(posts=20, comments_every=0, big_file_every=0, file_size=1000,
+                                          album_size=4, protected=True, repeat_rate=0),
+                              FakeNetwork(latency=0.02))
+    sender = _sender(fake, tmp_path, item_concurrency=concurrency)
+    download = fake.download_media
+    busy = peak = 0
+
+    async def counting(message, file=None, **kw):
+        nonlocal busy, peak
+        busy += 1
+        peak = max(peak, busy)
+        try:
+            return await download(message, file, **kw)
+        finally:
+            busy -= 1
+
+    fake.download_media = counting
+    album = _album(fake)
+    sent = asyncio.run(sender.send(fake.dest, album, ctx="t"))
+    return peak, album, sent
+
+
+def test_album_items_downloaded_concurrently(tmp_path):
+    peak, album, sent = _album_downloads(tmp_path, 4)
+    assert peak == len(album) == 4
+    # порядок элементов альбома не зависит от того, какой файл скачался первым
+    assert [s.file.name for s in sent] == [m.file.name for m in album]
+
+
+def test_album_concurrency_limit(tmp_path):
+    peak, album, sent = _album_downloads(tmp_path, 1)
+    assert peak == 1
+    assert [s.file.name for s in sent] == [m.file.name for m in album]
@@ -0,0 +1,81 @@
+import asyncio
+
+from metrics import Registry, serve
+
+
+def _registry():
+    reg = Registry()
+    units = reg.counter("t_units_total", "Units", ("job", "kind"))
+    lag = reg.gauge("t_lag", "Lag", ("job",))
+    calls = reg.histogram("t_call_seconds", "Calls", ("kind",), buckets=(0.1, 1.0))
+    return reg, units, lag, calls
+
+
+def test_render_text_format():
+    reg, units, lag, calls = _registry()
+    units.inc(job="news", kind="post")
+    units.inc(2, job="news", kind="post")
+    units.inc(job='a "b"\n', kind="comment")
+    lag.set(5, job="news")
+    for v in (0.05, 0.5, 3.0):
+        calls.observe(v, kind="send_file")
+
+    assert reg.render().splitlines() == [
+        "# HELP t_units_total Units",
+        "# TYPE t_units_total counter",
+        't_units_total{job="a \\"b\\"\\n",kind="comment"} 1',
+        't_units_total{job="news",kind="post"} 3',
+        "# HELP t_lag Lag",
+        "# TYPE t_lag gauge",
+        't_lag{job="news"} 5',
+        "# HELP t_call_seconds Calls",
+        "# TYPE t_call_seconds histogram",
+        't_call_seconds_bucket{kind="send_file",le="0.1"} 1',
+        't_call_seconds_bucket{kind="send_file",le="1"} 2',
+        't_call_seconds_bucket{kind="send_file",le="+Inf"} 3',
+        't_call_seconds_sum{kind="send_file"} 3.55',
+        't_call_seconds_count{kind="send_file"} 3',
+    ]
+
+
+def test_histogram_quantile():
+    _, _, _, calls = _registry()
+    for v in [0.05] * 98 + [0.5, 5.0]:
+        calls.observe(v, kind="x")
+    assert calls.quantile(0.5, kind="x") == 0.1
+    assert calls.quantile(0.99, kind="x") == 1.0
+    assert calls.quantile(1.0, kind="x") == float("inf")
+    assert calls.quantile(0.5, kind="missing") == 0.0
+
+
+def test_gauge_function_read_on_render():
+    reg = Registry()
+    value = [1]
+    reg.gauge("t_fn", "Fn").set_function(lambda: value[0])
+    value[0] = 7
+    assert "t_fn 7" in reg.render().splitlines()
+
+
+def test_http_endpoint():
+    reg, units, _, _ = _registry()
+    units.inc(job="news", kind="post")
+
+    async def get(server, path: str) -> bytes:
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        body = await reader.read()
+        writer.close()
+        return body
+
+    async def run():
+        server = await serve("127.0.0.1", 0, reg)
+        try:
+            return await get(server, "/metrics"), await get(server, "/other")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    ok, missing = asyncio.run(run())
+    assert ok.startswith(b"HTTP/1.1 200 OK") and b't_units_total{job="news",kind="post"} 1' in ok
+    assert missing.startswith(b"HTTP/1.1 404")
@@ -0,0 +1,123 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telethon import errors
+from telethon.tl.types import PeerChannel
+
+import pool
+from pool import MAX_FAILURES, PoolSession, SessionPool
+from retry import RetryPolicy
+
+CHAT = PeerChannel(5)
+PEER_ID = -1000000000005
+
+
+class HistoryClient:
+    """iter_messages по ids; после fail_after выданных сообщений — FloodWait (один раз)."""
+
+    def __init__(self, ids: list[int], fail_after: int | None = None, seconds: int = 60):
+        self.ids = ids
+        self.fail_after = fail_after
+        self.seconds = seconds
+        self.calls: list[int] = []
+
+    async def iter_messages(self, chat, *, min_id: int, limit, reverse: bool):
+        self.calls.append(min_id)
+        for n, i in enumerate(x for x in self.ids if x > min_id):
+            if n == limit:
+                return
+            if n == self.fail_after:
+                self.fail_after = None
+                raise errors.FloodWaitError(request=None, capture=self.seconds)
+            yield SimpleNamespace(id=i)
+
+
+def _pool(*clients) -> SessionPool:
+    return SessionPool([
+        PoolSession(name=f"r{i}", client=c, policy=RetryPolicy(max_retries=0, flood_sleep_max=10), chats={PEER_ID: CHAT})
+        for i, c in enumerate(clients)
+    ])
+
+
+def test_acquire_round_robin():
+    p = _pool(None, None, None)
+
+    async def run():
+        return [(await p.acquire()).name for _ in range(4)]
+
+    assert asyncio.run(run()) == ["r0", "r1", "r2", "r0"]
+    assert [s.calls for s in p.sessions] == [2, 1, 1]
+
+
+def test_flood_moves_call_to_next_session():
+    p = _pool(None, None)
+
+    async def fn(s, chat):
+        if s.name == "r0":
+            raise errors.FloodWaitError(request=None, capture=30)
+        return s.name
+
+    assert asyncio.run(p.run(PEER_ID, fn, ctx="t")) == "r1"
+    r0, r1 = p.sessions
+    assert r0.flood_waits == 1 and not r0.available(pool.time.monotonic())
+    assert p.available_count() == 1
+
+    async def names():
+        return [(await p.acquire()).name for _ in range(3)]
+
+    assert asyncio.run(names()) == ["r1"] * 3
+
+
+def test_network_failures_put_session_on_cooldown():
+    p = _pool(None, None)
+    r0, r1 = p.sessions
+
+    async def fn(s, chat):
+        if s.name == "r0":
+            raise ConnectionError("reset")
+        return s.name
+
+    async def run():
+        return [await p.run(PEER_ID, fn, ctx="t") for _ in range(MAX_FAILURES)]
+
+    assert asyncio.run(run()) == ["r1"] * MAX_FAILURES
+    assert r0.failures == MAX_FAILURES and not r0.available(pool.time.monotonic())
+    assert r1.failures == 0
+
+
+def test_all_sessions_failing_raises():
+    p = _pool(None, None)
+
+    async def fn(s, chat):
+        raise ConnectionError("reset")
+
+    # cooldown не ждём: сессии сразу возвращаются в ротацию
+    p.sessions[0].available = p.sessions[1].available = lambda now: True
+    with pytest.raises(ConnectionError):
+        asyncio.run(p.run(PEER_ID, fn, ctx="t"))
+
+
+def test_iter_history_continues_on_next_session_after_flood():
+    ids = list(range(1, 11))
+    first, second = HistoryClient(ids, fail_after=4), HistoryClient(ids)
+    p = _pool(first, second)
+
+    async def run():
+        return [m.id async for m in p.iter_history(CHAT)]
+
+    assert asyncio.run(run()) == ids
+    assert first.calls == [0] and second.calls == [4]
+    assert p.sessions[0].flood_waits == 1
+
+
+def test_iter_history_limit_spans_sessions():
+    ids = list(range(1, 11))
+    first, second = HistoryClient(ids, fail_after=3), HistoryClient(ids)
+    p = _pool(first, second)
+
+    async def run():
+        return [m.id async for m in p.iter_history(CHAT, min_id=2, limit=5)]
+
+    assert asyncio.run(run()) == [3, 4, 5, 6, 7]
+    assert second.calls == [5]
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient
+from ratelimit import RateLimiter, TokenBucket, paced_history
+
+
+def test_slow_down_halves_rate_down_to_floor():
+    b = TokenBucket(10, min_factor=0.1)
+    b.slow_down()
+    assert b.rate == 5
+    for _ in range(10):
+        b.slow_down()
+    assert b.rate == b.min_rate == 1
+
+
+def test_speed_up_recovers_additively_up_to_max():
+    b = TokenBucket(10, recover_calls=50)
+    b.slow_down()
+    b.speed_up()
+    assert b.rate == 5 + b.step
+    for _ in range(100):
+        b.speed_up()
+    assert b.rate == b.max_rate == 10
+
+
+def test_flood_slows_only_its_kind_and_holds_all():
+    limiter = RateLimiter({"send_message": 10, "get_history": 10})
+    limiter.on_flood("send_message", 5)
+    assert limiter.buckets["send_message"].rate == 5
+    assert limiter.buckets["get_history"].rate == 10
+    assert limiter.resume_at > time.monotonic() + 4
+    assert limiter.flood_waits == 1
+
+
+def test_acquire_waits_for_hold():
+    b = TokenBucket(1000)
+    b.hold(time.monotonic() + 0.2)
+
+    async def run():
+        t0 = time.monotonic()
+        await b.acquire()
+        return time.monotonic() - t0
+
+    assert asyncio.run(run()) >= 0.15
+
+
+def test_history_flood_pauses_limiter_and_repeats_page():
+    # как у публикующего клиента в main: FloodWait не пересыпается внутри клиента
+    fake = FakeTelegramClient(ChannelSpec(posts=150, comments_every=0),
+                              FakeNetwork(latency=0, read_flood_rate=0.3, flood_seconds=0),
+                              flood_sleep_threshold=-1)
+    limiter = RateLimiter({"get_history": 1000})
+
+    async def run():
+        return [m.id async for m in paced_history(fake.iter_messages(fake.source, reverse=True), limiter)]
+
+    assert asyncio.run(run()) == [m.id for m in fake.posts]
+    assert fake.flood_waits > 0
+    assert limiter.flood_waits == fake.flood_waits
+    assert limiter.buckets["get_history"].rate < 1000
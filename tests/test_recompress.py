@@ -0,0 +1,107 @@
+import asyncio
+import dataclasses
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from telethon.tl import types
+
+from fake_telegram import _DATE, _document, _sticker
+from recompress import RecompressOptions, Recompressor, media_kind, recompress_file, recompressed_media
+
+OPTS = RecompressOptions(min_size=1000, quality=60, max_side=800, strip_metadata=True, video_max=0, video_crf=28)
+
+
+def _msg(media) -> types.Message:
+    return types.Message(id=1, peer_id=types.PeerChannel(1001), date=_DATE, message="", media=media)
+
+
+def _photo() -> types.MessageMediaPhoto:
+    return types.MessageMediaPhoto(photo=types.Photo(id=1, access_hash=1, file_reference=b"ref", date=_DATE,
+                                                     sizes=[types.PhotoSize("x", 1, 1, 1)], dc_id=2))
+
+
+def _doc(mime: str, *attributes) -> types.MessageMediaDocument:
+    media = _document(7, 100_000, "pic.png")
+    media.document.mime_type = mime
+    media.document.attributes += list(attributes)
+    return media
+
+
+def _image(path, mode="RGB", size=(2000, 1200)) -> str:
+    Image = pytest.importorskip("PIL.Image")
+    # шум сжимается плохо, градиент — хорошо: картинка «как фото», крупная в PNG
+    img = Image.linear_gradient("L").resize(size).convert(mode)
+    img.putpixel((0, 0), (255,) * len(mode))
+    img.save(path, "PNG")
+    return str(path)
+
+
+def test_media_kind():
+    video = types.DocumentAttributeVideo(duration=1, w=10, h=10)
+    assert media_kind(_msg(_photo())) == "image"
+    assert media_kind(_msg(_doc("image/png"))) == "image"
+    assert media_kind(_msg(_doc("video/mp4", video))) == "video"
+    assert media_kind(_msg(_doc("video/mp4", types.DocumentAttributeVideo(duration=1, w=1, h=1,
+                                                                           round_message=True)))) is None
+    assert media_kind(_msg(_doc("video/mp4", video, types.DocumentAttributeAnimated()))) is None
+    assert media_kind(_msg(_doc("application/zip"))) is None
+    assert media_kind(_msg(_sticker(1))) is None
+
+
+def test_image_becomes_smaller_jpeg(tmp_path):
+    src = _image(tmp_path / "pic.png")
+    rc = recompress_file("image", src, str(tmp_path / "out"), OPTS)
+    assert rc.path.endswith(".jpg")
+    assert (rc.width, rc.height) == (800, 480)
+    assert os.path.getsize(rc.path) < os.path.getsize(src)
+
+
+def test_transparent_image_stays_png(tmp_path):
+    src = _image(tmp_path / "pic.png", mode="RGBA", size=(400, 300))
+    rc = recompress_file("image", src, str(tmp_path / "out"), OPTS)
+    assert rc.path.endswith(".png") and (rc.width, rc.height) == (400, 300)
+
+
+def test_apply_recompresses_and_counts(tmp_path):
+    src = _image(tmp_path / "pic.png")
+    msg = _msg(_doc("image/png", types.DocumentAttributeImageSize(2000, 1200)))
+    with ThreadPoolExecutor(1) as pool:
+        r = Recompressor(pool, OPTS)
+        rc = asyncio.run(r.apply(msg, src, ctx="t"))
+    assert rc is not None and r.stats.files == 1
+    assert r.stats.bytes_saved == os.path.getsize(src) - os.path.getsize(rc.path)
+
+    media = recompressed_media(msg, object(), rc, force_document=False)
+    assert media.mime_type == "image/jpeg"
+    names = [a.file_name for a in media.attributes if isinstance(a, types.DocumentAttributeFilename)]
+    sizes = [(a.w, a.h) for a in media.attributes if isinstance(a, types.DocumentAttributeImageSize)]
+    assert names == ["pic.jpg"] and sizes == [(800, 480)]
+
+
+def test_apply_keeps_original_without_gain(tmp_path):
+    pytest.importorskip("PIL")
+    # уже сжатый JPEG того же качества и размера меньше не станет
+    first = recompress_file("image", _image(tmp_path / "pic.png", size=(800, 480)), str(tmp_path / "a"), OPTS)
+    with ThreadPoolExecutor(1) as pool:
+        r = Recompressor(pool, dataclasses.replace(OPTS, min_size=0))
+        rc = asyncio.run(r.apply(_msg(_doc("image/jpeg")), first.path, ctx="t"))
+    assert rc is None and r.stats.skipped == 1
+    assert sorted(os.listdir(tmp_path)) == ["a.jpg", "pic.png"]
+
+
+def test_apply_sends_original_on_failure_or_small_file(tmp_path):
+    pytest.importorskip("PIL")
+    broken = tmp_path / "pic.png"
+    broken.write_bytes(b"not an image" * 1000)
+    small = tmp_path / "small.png"
+    small.write_bytes(b"x" * 10)
+    msg = _msg(_doc("image/png"))
+    with ThreadPoolExecutor(1) as pool:
+        r = Recompressor(pool, OPTS)
+        assert asyncio.run(r.apply(msg, str(small), ctx="t")) is None
+        assert asyncio.run(r.apply(msg, str(broken), ctx="t")) is None
+        # стикер не пересжимается вовсе
+        assert asyncio.run(r.apply(_msg(_sticker(1)), str(broken), ctx="t")) is None
+    assert r.stats.failed == 1 and r.stats.files == 0
+    assert sorted(os.listdir(tmp_path)) == ["pic.png", "small.png"]
@@ -0,0 +1,96 @@
+import sqlite3
+import time
+
+import pytest
+
+from state import EnvStateStore, Fingerprint, SqliteStateStore, StateDb, StateStore
+
+
+def test_env_store_keeps_discussion_watermark_in_memory(tmp_path):
+    state = EnvStateStore(tmp_path / ".env")
+    assert state.get_discussion_watermark() == 0
+    state.set_discussion_watermark(42)
+    assert state.get_discussion_watermark() == 42
+    assert not (tmp_path / ".env").exists()  # в .env не пишется
+
+
+def _committed(path, source: str, kind: str = "post") -> int:
+    # что видит другой процесс: только закоммиченное
+    with sqlite3.connect(str(path)) as conn:
+        return conn.execute("SELECT COUNT(*) FROM id_map WHERE source = ? AND kind = ?", (source, kind)).fetchone()[0]
+
+
+def test_incomplete_backend_fails_on_creation():
+    class NoThreads(StateStore):
+        def get_last_seen(self):
+            return None
+
+    with pytest.raises(TypeError):
+        NoThreads()
+
+
+def test_writes_committed_in_batches(tmp_path):
+    path = tmp_path / "s.db"
+    state = SqliteStateStore(path, source="a", commit_every=10, commit_interval=3600)
+    for i in range(1, 10):
+        state.record_ids("post", {i: i + 100})
+    assert _committed(path, "a") == 0
+    assert state.dest_id("post", 5) == 105  # своё соединение видит незакоммиченное
+
+    state.record_ids("post", {10: 110})
+    assert _committed(path, "a") == 10
+
+    state.record_ids("post", {11: 111})
+    state.flush()
+    assert _committed(path, "a") == 11
+    state.close()
+
+
+def test_commit_interval(tmp_path, monkeypatch):
+    path = tmp_path / "s.db"
+    state = SqliteStateStore(path, source="a", commit_every=1000, commit_interval=2.0)
+    now = [time.monotonic()]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    state.record_ids("post", {1: 101})
+    assert _committed(path, "a") == 0
+    now[0] += 2.5
+    state.record_ids("post", {2: 102})
+    assert _committed(path, "a") == 2
+    state.close()
+
+
+def test_state_survives_reopen(tmp_path):
+    path = tmp_path / "s.db"
+    state = SqliteStateStore(path, source="a")
+    fp = Fingerprint(unit_id=3, text_id=103, edit_date=7, text_hash="h", media="- -")
+    state.update_last_seen(12)
+    state.record_ids("comment", {50: 150})
+    state.register_thread(3, 103)
+    state.update_comment_watermark(3, 50)
+    state.set_open_album((9, 12))
+    state.record_fingerprint(fp)
+    state.set_discussion_watermark(77)
+    state.close()
+
+    state = SqliteStateStore(path, source="a")
+    assert state.get_last_seen() == 12
+    assert state.dest_id("comment", 50) == 150
+    assert state.recent_threads(10) == [(3, 103, 50)]
+    assert state.get_open_album() == (9, 12)
+    assert state.fingerprint(3) == fp
+    assert state.get_discussion_watermark() == 77
+    state.close()
+
+
+def test_shared_db_keeps_sources_apart(tmp_path):
+    path = tmp_path / "s.db"
+    db = StateDb(path, commit_every=1000)
+    a = SqliteStateStore(path, source="a", db=db)
+    b = SqliteStateStore(path, source="b", db=db)
+    a.record_ids("post", {1: 101})
+    b.record_ids("post", {1: 201})
+    a.update_last_seen(1)
+    a.close()  # общее соединение не закрывается и коммитит изменения обеих пар
+    assert (a.dest_id("post", 1), b.dest_id("post", 1), b.get_last_seen()) == (101, 201, None)
+    assert (_committed(path, "a"), _committed(path, "b")) == (1, 1)
+    db.close()
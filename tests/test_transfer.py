@@ -0,0 +1,139 @@
+import asyncio
+import gc
+import hashlib
+import os
+import warnings
+from types import SimpleNamespace
+
+import pytest
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import InputFile, InputFileBig
+
+import transfer
+from transfer import PART_SIZE, download_parallel, stream_media, upload_parallel
+
+
+class PartsClient:
+    """
+    Клиент с файлом data: iter_download отдаёт части (первые — с задержкой, чтобы они приходили
+    не по порядку), saveFilePart/saveBigFilePart складываются в uploaded по номеру части.
+    """
+
+    def __init__(self, data: bytes, *, short_part: int | None = None, upload_ok: bool = True):
+        self.data = data
+        self.short_part = short_part
+        self.upload_ok = upload_ok
+        self.uploaded: dict[int, bytes] = {}
+        self.requests: list = []
+        self.active = 0
+        self.peak = 0
+
+    async def iter_download(self, media, *, offset: int, limit: int, request_size: int):
+        index = offset // request_size
+        await asyncio.sleep(0.01 * max(0, 3 - index))
+        chunk = self.data[offset: offset + request_size]
+        yield chunk[:-1] if index == self.short_part else chunk
+
+    async def __call__(self, request):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.005)
+        self.active -= 1
+        self.requests.append(type(request))
+        self.uploaded[request.file_part] = request.bytes
+        return self.upload_ok
+
+    def upload(self) -> bytes:
+        return b"".join(self.uploaded[i] for i in sorted(self.uploaded))
+
+
+def _msg(size: int):
+    return SimpleNamespace(id=1, media=None, file=SimpleNamespace(name="f.bin", size=size, ext=".bin"))
+
+
+DATA = os.urandom(3 * PART_SIZE + 123)
+
+
+def test_download_parts_assembled_in_order():
+    client = PartsClient(DATA)
+    out = asyncio.run(download_parallel(client, _msg(len(DATA)), size=len(DATA), parts=4, ctx="t"))
+    assert out == DATA
+
+
+def test_download_to_file_through_mmap(tmp_path):
+    path = str(tmp_path / "f.bin")
+    client = PartsClient(DATA)
+    out = asyncio.run(download_parallel(client, _msg(len(DATA)), size=len(DATA), parts=2, ctx="t", path=path))
+    assert out == path
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_short_part_fails_download(tmp_path):
+    client = PartsClient(DATA, short_part=1)
+    with pytest.raises(RuntimeError, match="part 1"):
+        asyncio.run(download_parallel(client, _msg(len(DATA)), size=len(DATA), parts=4, ctx="t",
+                                      path=str(tmp_path / "f.bin")))
+
+
+def test_file_closed_when_mmap_fails(tmp_path, monkeypatch):
+    def no_mmap(*args, **kw):
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(transfer.mmap, "mmap", no_mmap)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        with pytest.raises(OSError):
+            asyncio.run(download_parallel(PartsClient(DATA), _msg(len(DATA)), size=len(DATA), parts=2, ctx="t",
+                                          path=str(tmp_path / "f.bin")))
+        gc.collect()
+    assert not [w for w in caught if issubclass(w.category, ResourceWarning)]
+
+
+def test_stream_media_roundtrip():
+    client = PartsClient(DATA)
+    f = asyncio.run(stream_media(client, _msg(len(DATA)), size=len(DATA), buffer_bytes=2 * PART_SIZE, ctx="t",
+                                 parts=2, upload_concurrency=2))
+    assert isinstance(f, InputFile) and f.parts == 4
+    assert client.upload() == DATA
+
+
+def test_stream_media_leaves_no_tasks_on_failure():
+    client = PartsClient(DATA, upload_ok=False)
+
+    async def run():
+        with pytest.raises(RuntimeError, match="not saved"):
+            await stream_media(client, _msg(len(DATA)), size=len(DATA), buffer_bytes=PART_SIZE, ctx="t", parts=2)
+        return asyncio.all_tasks() - {asyncio.current_task()}
+
+    assert asyncio.run(run()) == set()
+
+
+def test_upload_bytes_small_file_has_md5():
+    client = PartsClient(b"")
+    f = asyncio.run(upload_parallel(client, DATA, size=len(DATA), name="f.bin", parts=2, ctx="t"))
+    assert isinstance(f, InputFile) and f.parts == 4
+    assert f.md5_checksum == hashlib.md5(DATA).hexdigest()
+    assert client.upload() == DATA
+    assert set(client.requests) == {SaveFilePartRequest}
+    assert client.peak <= 2
+
+
+def test_upload_file_through_mmap_as_big_file(tmp_path, monkeypatch):
+    # порог большого файла уменьшен, чтобы не гонять 10 МБ
+    monkeypatch.setattr(transfer, "BIG_FILE_SIZE", PART_SIZE)
+    path = tmp_path / "f.bin"
+    path.write_bytes(DATA)
+    client = PartsClient(b"")
+    f = asyncio.run(upload_parallel(client, str(path), size=len(DATA), name="f.bin", parts=3, ctx="t"))
+    assert isinstance(f, InputFileBig) and f.parts == 4
+    assert client.upload() == DATA
+    assert set(client.requests) == {SaveBigFilePartRequest}
+    assert 1 < client.peak <= 3
+
+
+def test_upload_size_mismatch_fails(tmp_path):
+    path = tmp_path / "f.bin"
+    path.write_bytes(DATA)
+    with pytest.raises(RuntimeError, match="expected"):
+        asyncio.run(upload_parallel(PartsClient(b""), str(path), size=len(DATA) + 1, name="f.bin", parts=2, ctx="t"))
@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+from telethon import errors
+from telethon.tl import types
+
+from fake_telegram import ChannelSpec, FakeNetwork, FakeTelegramClient, SOURCE_ID, _document
+from media import MediaSender
+from upload_cache import UploadCache, bytes_digest
+
+
+def _fake(**spec):
+    return FakeTelegramClient(ChannelSpec(posts=0, **spec), FakeNetwork(latency=0))
+
+
+def _sent(fake, doc_id: int):
+    return fake._out(fake.dest, media=_document(doc_id, 1000))
+
+
+def test_hit_by_source_id_and_digest():
+    fake = _fake()
+    cache = UploadCache(None)
+    m = fake._message(1, SOURCE_ID, "", media=_document(10, 1000))
+    digest = bytes_digest(b"content")
+    cache.store(m, _sent(fake, 500), digest)
+
+    same_file = fake._message(2, SOURCE_ID, "", media=_document(10, 1000))
+    h = cache.lookup(same_file, force_document=False)
+    assert isinstance(h, types.InputMediaDocument) and h.id.id == 500
+    assert cache.lookup_digest(digest, False, size=1000).id.id == 500
+    assert cache.lookup(fake._message(3, SOURCE_ID, "", media=_document(11, 1000)), False) is None
+    assert (cache.stats.hits, cache.stats.misses, cache.stats.bytes_saved) == (2, 1, 2000)
+
+
+def test_evict_drops_every_key_of_the_file():
+    fake = _fake()
+    cache = UploadCache(None)
+    m = fake._message(1, SOURCE_ID, "", media=_document(10, 1000))
+    cache.store(m, _sent(fake, 500), "sha256:x")
+    cache.evict("sha256:x")
+    assert cache.lookup(m, False) is None
+
+
+def test_ttl_and_lru(monkeypatch):
+    fake = _fake()
+    cache = UploadCache(None, max_entries=2, ttl=100)
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    msgs = [fake._message(i, SOURCE_ID, "", media=_document(10 + i, 1000)) for i in range(3)]
+
+    cache.store(msgs[0], _sent(fake, 500))
+    now[0] += 1
+    cache.store(msgs[1], _sent(fake, 501))
+    now[0] += 1
+    assert cache.lookup(msgs[0], False) is not None  # msgs[0] теперь использован последним
+    now[0] += 1
+    cache.store(msgs[2], _sent(fake, 502))
+    assert [cache.lookup(m, False) is not None for m in msgs] == [True, False, True]
+
+    now[0] += 200
+    assert cache.lookup(msgs[2], False) is None
+
+
+def test_photo_handle_not_used_as_document():
+    fake = _fake()
+    cache = UploadCache(None)
+    photo = fake._dest_media(types.InputMediaUploadedPhoto(file=None))
+    m = fake._message(1, SOURCE_ID, "", media=photo)
+    cache.store(m, fake._out(fake.dest, media=photo))
+    assert isinstance(cache.lookup(m, force_document=False), types.InputMediaPhoto)
+    assert cache.lookup(m, force_document=True) is None
+
+
+def _protected_sender(fake, tmp_path, cache):
+    return MediaSender(fake, tmp_dir=tmp_path, cleanup=True, force_document=False, upload_cache=cache)
+
+
+def test_repeated_file_uploaded_once(tmp_path):
+    fake = _fake(protected=True)
+    cache = UploadCache(None)
+    sender = _protected_sender(fake, tmp_path, cache)
+    first, again = (fake._message(i, SOURCE_ID, "", media=_document(10, 1000)) for i in (1, 2))
+
+    asyncio.run(sender.send(fake.dest, [first], ctx="t"))
+    sent = asyncio.run(sender.send(fake.dest, [again], ctx="t"))
+    assert fake.calls["download"] == 1
+    assert sent.media.document.id == fake.dest_posts[0].media.document.id
+    assert sender.stats.cached_units == 1
+
+
+def test_stale_cached_handle_is_reuploaded(tmp_path):
+    fake = _fake(protected=True)
+    cache = UploadCache(None)
+    sender = _protected_sender(fake, tmp_path, cache)
+    m = fake._message(1, SOURCE_ID, "", media=_document(10, 1000))
+    asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    send_file = fake.send_file
+
+    async def stale(entity, file, **kw):
+        if isinstance(file, types.InputMediaDocument):
+            raise errors.FileReferenceExpiredError(request=None)
+        return await send_file(entity, file, **kw)
+
+    fake.send_file = stale
+    asyncio.run(sender.send(fake.dest, [m], ctx="t"))
+    assert fake.calls["download"] == 2
+    # в кэше теперь новый handle
+    assert cache.lookup(m, False).id.id == fake.dest_posts[-1].media.document.id
@@ -0,0 +1,253 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import logging
+import mmap
+import random
+
+from telethon import TelegramClient
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import (
+    DocumentAttributeFilename,
+    InputFile,
+    InputFileBig,
+    InputMediaUploadedDocument,
+    InputMediaUploadedPhoto,
+    MessageMediaPhoto,
+)
+
+from metrics import BYTES_DOWNLOADED, BYTES_UPLOADED
+from retry import safe_call, RetryPolicy
+
+log = logging.getLogger("tg_sync.transfer")
+
+# Максимальный размер части и для upload.getFile, и для upload.saveFilePart
+PART_SIZE = 512 * 1024
+# Начиная с этого размера Telegram требует saveBigFilePart
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+
+def media_size(msg) -> int | None:
+    f = msg.file
+    return f.size if f else None
+
+
+def media_name(msg) -> str:
+    f = msg.file
+    if f and f.name:
+        return f.name
+    ext = (f.ext if f else None) or ""
+    return f"{'photo' if isinstance(msg.media, MessageMediaPhoto) else 'file'}_{msg.id}{ext}"
+
+
+def uploaded_media(msg, input_file, force_document: bool):
+    """InputMedia для уже загруженного файла с атрибутами исходного сообщения (длительность, имя, mime...)."""
+    if isinstance(msg.media, MessageMediaPhoto) and not force_document:
+        return InputMediaUploadedPhoto(file=input_file)
+
+    doc = getattr(msg.media, "document", None)
+    if doc is not None:
+        return InputMediaUploadedDocument(
+            file=input_file,
+            mime_type=doc.mime_type,
+            attributes=list(doc.attributes),
+            force_file=force_document or None,
+        )
+
+    return InputMediaUploadedDocument(
+        file=input_file,
+        mime_type=(msg.file.mime_type if msg.file else None) or "application/octet-stream",
+        attributes=[DocumentAttributeFilename(media_name(msg))],
+        force_file=True,
+    )
+
+
+async def download_part(client: TelegramClient, media, index: int) -> bytes:
+    """Одна часть файла (PART_SIZE байт, последняя — меньше); каждую часть можно ретраить отдельно."""
+    chunks = [c async for c in client.iter_download(media, offset=index * PART_SIZE, limit=1, request_size=PART_SIZE)]
+    return b"".join(chunks)
+
+
+async def _fetch_part(client: TelegramClient, msg, index: int, *, size: int, total: int, ctx: str,
+                      policy: RetryPolicy | None) -> bytes:
+    # каждая часть ретраится отдельно: сбой одной не перезапускает весь файл
+    part = await safe_call(
+        lambda: download_part(client, msg.media, index),
+        ctx=f"{ctx} download_part {index + 1}/{total}",
+        policy=policy,
+        kind="download",
+    )
+    expected = min(PART_SIZE, size - index * PART_SIZE)
+    if len(part) != expected:
+        raise RuntimeError(f"{ctx}: part {index} has {len(part)} bytes, expected {expected}")
+    BYTES_DOWNLOADED.inc(len(part))
+    return part
+
+
+async def download_parallel(client: TelegramClient, msg, *, size: int, parts: int, ctx: str,
+                            policy: RetryPolicy | None = None, path: str | None = None):
+    """
+    Скачивание крупного файла частями по PART_SIZE, до parts запросов одновременно
+    (Telethon мультиплексирует их по соединению с DC файла).
+    С path части пишутся по своему смещению в заранее выделенный файл через mmap и возвращается path,
+    без path — собираются в bytes. Каждая часть проверяется по длине, в конце — что пришли все.
+    """
+    total = (size + PART_SIZE - 1) // PART_SIZE
+    done = [False] * total
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(total):
+        queue.put_nowait(index)
+
+    async def worker(buf):
+        while not queue.empty():
+            index = queue.get_nowait()
+            part = await _fetch_part(client, msg, index, size=size, total=total, ctx=ctx, policy=policy)
+            buf[index * PART_SIZE: index * PART_SIZE + len(part)] = part
+            done[index] = True
+
+    async def fill(buf):
+        workers = [asyncio.ensure_future(worker(buf)) for _ in range(max(1, min(parts, total)))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        missing = done.count(False)
+        if missing:
+            raise RuntimeError(f"{ctx}: {missing}/{total} parts missing")
+
+    if path is None:
+        buf = bytearray(size)
+        await fill(buf)
+        return bytes(buf)
+
+    with open(path, "wb") as f:
+        f.truncate(size)
+    with open(path, "r+b") as f, mmap.mmap(f.fileno(), size) as buf:
+        await fill(buf)
+        buf.flush()
+    return path
+
+
+async def _save_part(client: TelegramClient, file_id: int, index: int, total: int, part: bytes, *, is_big: bool,
+                     ctx: str, policy: RetryPolicy | None) -> None:
+    req = SaveBigFilePartRequest(file_id, index, total, part) if is_big else SaveFilePartRequest(file_id, index, part)
+    # каждая часть ретраится отдельно: сбой одной не перезапускает всю загрузку
+    ok = await safe_call(lambda: client(req), ctx=f"{ctx} upload_part {index + 1}/{total}",
+                         policy=policy, kind="upload")
+    if not ok:
+        raise RuntimeError(f"{ctx}: part {index} was not saved")
+    BYTES_UPLOADED.inc(len(part))
+
+
+async def upload_parts(client: TelegramClient, parts, *, size: int, name: str, ctx: str,
+                       policy: RetryPolicy | None = None, concurrency: int = 1):
+    """
+    Загружает файл из асинхронного итератора частей по PART_SIZE байт,
+    до concurrency частей одновременно (Telegram принимает части в любом порядке).
+    Возвращает InputFile/InputFileBig для send_file.
+    """
+    file_id = random.randrange(-2 ** 63, 2 ** 63)
+    total = (size + PART_SIZE - 1) // PART_SIZE
+    is_big = size > BIG_FILE_SIZE
+    md5 = hashlib.md5()
+
+    index = 0
+    in_flight: set[asyncio.Future] = set()
+    try:
+        async for part in parts:
+            if not is_big:
+                md5.update(part)
+            in_flight.add(asyncio.ensure_future(
+                _save_part(client, file_id, index, total, part, is_big=is_big, ctx=ctx, policy=policy)))
+            index += 1
+            if len(in_flight) >= max(1, concurrency):
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    t.result()
+        if in_flight:
+            await asyncio.gather(*in_flight)
+            in_flight = set()
+    finally:
+        for t in in_flight:
+            t.cancel()
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+    if index != total:
+        raise RuntimeError(f"{ctx}: uploaded {index}/{total} parts")
+
+    if is_big:
+        return InputFileBig(file_id, total, name)
+    return InputFile(file_id, total, name, md5.hexdigest())
+
+
+async def upload_parallel(client: TelegramClient, source, *, size: int, name: str, parts: int, ctx: str,
+                          policy: RetryPolicy | None = None):
+    """
+    Загрузка крупного файла (путь или bytes) частями, до parts частей одновременно.
+    Файл с диска читается через mmap: каждая часть — один срез отображения, без буферов чтения.
+    Возвращает InputFile/InputFileBig.
+    """
+    async def chunks(buf):
+        for offset in range(0, size, PART_SIZE):
+            # срез mmap/bytes — сразу bytes (их и ждёт TL-сериализация Telethon), одна копия на часть
+            yield buf[offset: offset + PART_SIZE]
+
+    if not isinstance(source, str):
+        return await upload_parts(client, chunks(source), size=size, name=name, ctx=ctx, policy=policy,
+                                  concurrency=parts)
+
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if len(buf) != size:
+            raise RuntimeError(f"{ctx}: {source} has {len(buf)} bytes, expected {size}")
+        return await upload_parts(client, chunks(buf), size=size, name=name, ctx=ctx, policy=policy,
+                                  concurrency=parts)
+
+
+async def stream_media(client: TelegramClient, msg, *, size: int, buffer_bytes: int, ctx: str,
+                       policy: RetryPolicy | None = None, parts: int = 1, upload_concurrency: int = 1,
+                       reader: TelegramClient | None = None, reader_policy: RetryPolicy | None = None):
+    """
+    Перекачка файла без диска: части скачиваются в ограниченную очередь (buffer_bytes)
+    и сразу уходят в upload. Возвращает InputFile/InputFileBig.
+    parts — сколько частей качается одновременно (в очередь они всё равно встают по порядку),
+    upload_concurrency — сколько частей одновременно загружается.
+    reader/reader_policy — чем качать части (аккаунт пула), по умолчанию client/policy.
+    """
+    total = (size + PART_SIZE - 1) // PART_SIZE
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, buffer_bytes // PART_SIZE))
+    window = max(1, min(parts, queue.maxsize))
+
+    async def produce():
+        in_flight: list[asyncio.Future] = []
+        try:
+            for index in range(total):
+                in_flight.append(asyncio.ensure_future(
+                    _fetch_part(reader or client, msg, index, size=size, total=total, ctx=ctx,
+                                policy=reader_policy or policy)))
+                if len(in_flight) >= window:
+                    await queue.put(await in_flight.pop(0))
+            while in_flight:
+                await queue.put(await in_flight.pop(0))
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            for t in in_flight:
+                t.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    async def queued_parts():
+        for _ in range(total):
+            item = await queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        return await upload_parts(client, queued_parts(), size=size, name=media_name(msg), ctx=ctx, policy=policy,
+                                  concurrency=upload_concurrency)
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
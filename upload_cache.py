@@ -0,0 +1,161 @@
+from __future__ import annotations
+import hashlib
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from telethon.tl.types import (
+    InputDocument,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputPhoto,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+)
+
+from transfer import media_size
+
+log = logging.getLogger("tg_sync.upload_cache")
+
+
+def source_key(msg) -> str | None:
+    """Ключ по id документа/фото в источнике: одинаковый файл в разных постах имеет один id."""
+    return media_key(msg.media)
+
+
+def media_key(media) -> str | None:
+    """source_key по самому MessageMedia (например, в iter_download)."""
+    if isinstance(media, MessageMediaDocument) and media.document:
+        return f"doc:{media.document.id}"
+    if isinstance(media, MessageMediaPhoto) and media.photo:
+        return f"photo:{media.photo.id}"
+    return None
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return "sha256:" + h.hexdigest()
+
+
+def bytes_digest(data: bytes) -> str:
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0         # файл отправлен по handle из кэша
+    misses: int = 0       # файл пришлось загрузить (и он запомнен в кэше)
+    bytes_saved: int = 0  # сколько байт не пришлось загружать
+
+
+class UploadCache:
+    """
+    Кэш уже загруженных в Telegram файлов: ключ источника (id документа/фото) или хэш содержимого
+    -> handle файла в назначении (id, access_hash, file_reference). Повторная отправка того же файла
+    идёт по handle без скачивания (по id) или хотя бы без загрузки (по хэшу). Вытеснение — LRU (max_entries)
+    и TTL; протухший file_reference вызывающая сторона выкидывает через evict() и перезаливает файл.
+    """
+
+    def __init__(self, path: Path | None, *, max_entries: int = 10000, ttl: float = 72 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+        self._db = sqlite3.connect(str(path) if path else ":memory:")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                key            TEXT PRIMARY KEY,
+                kind           TEXT    NOT NULL,
+                id             INTEGER NOT NULL,
+                access_hash    INTEGER NOT NULL,
+                file_reference BLOB    NOT NULL,
+                size           INTEGER NOT NULL DEFAULT 0,
+                created        REAL    NOT NULL,
+                last_used      REAL    NOT NULL
+            )
+            """
+        )
+        self._db.commit()
+
+    def lookup(self, msg, force_document: bool):
+        key = source_key(msg)
+        return self._get(key, force_document, size=media_size(msg)) if key else None
+
+    def lookup_digest(self, digest: str, force_document: bool, size: int | None = None):
+        return self._get(digest, force_document, size=size)
+
+    def store(self, msg, sent, digest: str | None = None) -> None:
+        """Запоминает handle из отправленного сообщения sent для msg (и для хэша содержимого, если он есть)."""
+        media = getattr(sent, "media", None)
+        if isinstance(media, MessageMediaPhoto) and media.photo:
+            kind, obj = "photo", media.photo
+        elif isinstance(media, MessageMediaDocument) and media.document:
+            kind, obj = "document", media.document
+        else:
+            return
+
+        now = time.time()
+        row = (kind, obj.id, obj.access_hash, obj.file_reference, media_size(msg) or 0, now, now)
+        keys = [k for k in (source_key(msg), digest) if k]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO uploads (key, kind, id, access_hash, file_reference, size, created, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(k, *row) for k in keys],
+        )
+        self._evict_overflow()
+        self._db.commit()
+        self.stats.misses += 1
+
+    def evict(self, key: str) -> None:
+        """Забывает handle по ключу вместе со всеми ключами, указывающими на тот же файл."""
+        self._db.execute(
+            "DELETE FROM uploads WHERE id IN (SELECT id FROM uploads WHERE key = ?)", (key,)
+        )
+        self._db.commit()
+        log.info("upload cache: evicted %s", key)
+
+    def summary(self) -> str:
+        return f"hits={self.stats.hits} misses={self.stats.misses} saved_mb={self.stats.bytes_saved / 1024 / 1024:.1f}"
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _get(self, key: str, force_document: bool, size: int | None):
+        row = self._db.execute(
+            "SELECT kind, id, access_hash, file_reference, created FROM uploads WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+
+        if row is not None and now - row[4] > self.ttl:
+            self._db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+            self._db.commit()
+            row = None
+        # фото нельзя отправить «как файл» по handle фото
+        if row is None or (force_document and row[0] == "photo"):
+            return None
+
+        self._db.execute("UPDATE uploads SET last_used = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        self.stats.hits += 1
+        self.stats.bytes_saved += size or 0
+
+        kind, id_, access_hash, file_reference, _ = row
+        if kind == "photo":
+            return InputMediaPhoto(id=InputPhoto(id_, access_hash, file_reference))
+        return InputMediaDocument(id=InputDocument(id_, access_hash, file_reference))
+
+    def _evict_overflow(self) -> None:
+        self._db.execute(
+            "DELETE FROM uploads WHERE key IN ("
+            "  SELECT key FROM uploads ORDER BY last_used DESC LIMIT -1 OFFSET ?"
+            ")",
+            (self.max_entries,),
+        )